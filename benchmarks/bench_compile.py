@@ -0,0 +1,73 @@
+# vqgan's training step run eagerly versus with --compile (torch.compile of
+# synth, cutouts and CLIP's image encoder), on the stand-in models from
+# stubs.py. Reports the first compiled iteration separately, as that's where
+# compiling happens, and how many steady-state iterations it takes to win that
+# time back. Needs pytorch 2.0+ (and a C++ compiler for the CPU). E.g.:
+#   python benchmarks/bench_compile.py -s 256 256 -i 30
+#   python benchmarks/bench_compile.py -cd cuda:0 --cut-method original
+
+import os
+import time
+
+import common
+
+
+def run(vqgan, generator, args, compile):
+    import torch
+    import stubs
+    argv = ['-s', str(args.size[0]), str(args.size[1]), '-i', str(args.iterations),
+            '-se', str(args.iterations + 1), '-cuts', str(args.cutn),
+            '-cutm', args.cut_method, '-cd', args.cuda_device]
+    job = vqgan.parse_args(argv + (['-cmp'] if compile else []))
+    make_cutouts, z, z_orig, pMs, opt, scaler = stubs.vqgan_training_job(vqgan, generator, job, args.seed)
+
+    sync = torch.cuda.synchronize if generator.device.type == 'cuda' else (lambda: None)
+    times = []
+    losses = []
+    for i in range(1, args.iterations + 1):
+        sync()
+        start = time.perf_counter()
+        loss = generator.train(job, make_cutouts, opt, z, z_orig, pMs, i, scaler)
+        sync()
+        times.append(time.perf_counter() - start)
+        losses.append(loss.item())
+
+    steady = times[min(args.warmup, len(times) - 1):]
+    return {
+        'first_iteration': times[0],
+        'step': {'runs': len(steady), 'mean': sum(steady) / len(steady), 'min': min(steady), 'max': max(steady)},
+        'total': sum(times),
+        'losses': losses,
+    }
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('vqgan training step: eager vs. torch.compile (--compile), including compile time')
+    parser.add_argument("-s", nargs=2, type=int, help="image size", default=[256, 256], dest='size')
+    parser.add_argument("-i", type=int, help="iterations per mode", default=30, dest='iterations')
+    parser.add_argument("--warmup", type=int, help="iterations left out of the steady-state timing", default=3, dest='warmup')
+    parser.add_argument("--cutn", type=int, help="cutouts per iteration", default=32, dest='cutn')
+    parser.add_argument("--cut-method", type=str, help="vqgan cut method", default='latest', dest='cut_method')
+    parser.add_argument("--seed", type=int, help="seed for the latent and prompts", default=1234, dest='seed')
+    parser.add_argument("-cd", type=str, help="device", default="cpu", dest='cuda_device')
+    args = parser.parse_args()
+
+    if args.cuda_device == 'cpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    import vqgan
+    import stubs
+
+    generator = stubs.vqgan_generator(vqgan, args.cuda_device)
+    eager = run(vqgan, generator, args, False)
+    compiled = run(vqgan, generator, args, True)
+
+    results = {'size': args.size, 'cutn': args.cutn, 'cut_method': args.cut_method, 'device': str(generator.device),
+               'eager': eager, 'compiled': compiled,
+               # fell back to eager (see the warning above the results)
+               'compile_failed': generator.compiled_step is None or generator.compiled_step.compiled is None}
+    saved = eager['step']['mean'] - compiled['step']['mean']
+    results['speedup'] = eager['step']['mean'] / compiled['step']['mean']
+    # iterations until the compile time is paid back, None if it never is
+    results['break_even_iterations'] = (compiled['first_iteration'] - eager['first_iteration']) / saved if saved > 0 else None
+    common.write_results('compile', results, args.json)
@@ -0,0 +1,150 @@
+# Counts the host syncs in diffusion's cond_fn (ClipGuidance). On a GPU (the
+# default when there is one) torch's sync debug mode reports every operation
+# that makes the CPU wait for the GPU, copies to and from the device included.
+# On every device, each read of a tensor's value back on the host (.item(),
+# bool(), int(), float(), .tolist(), .numpy()) is counted too, by file:line.
+# On the CPU that's the only count, since copies don't wait for anything
+# there, so only a GPU run shows a step is free of syncs. Syncs made by
+# torchvision's augmentations (which draw their parameters on the CPU and
+# upload small transform matrices) are listed separately; --skip-augs leaves
+# the augmentations out. Uses the stand-in models from stubs.py and exits with
+# status 1 if any other code syncs. E.g.:
+#   python benchmarks/bench_cond_fn_syncs.py --steps 20
+#   python benchmarks/bench_cond_fn_syncs.py -cd cuda:0 --batch-size 4
+#   python benchmarks/bench_cond_fn_syncs.py -cd cpu
+
+import os
+import sys
+import time
+import warnings
+
+import common
+
+# the Tensor methods that hand a value back to Python
+READS = ['item', 'tolist', 'numpy', '__bool__', '__int__', '__float__', '__index__']
+
+
+# site of a sync as file:line, and whether torchvision made it
+def site_of(filename, lineno):
+    return os.path.basename(filename) + ':' + str(lineno), os.sep + 'torchvision' + os.sep in filename
+
+
+# counts (by file:line) the reads of tensor values made while it's active,
+# keeping the ones from inside torchvision apart
+class HostReadCounter():
+    def __init__(self):
+        self.sites = {}
+        self.torchvision_sites = {}
+        self.saved = {}
+
+    def count(self):
+        return sum(self.sites.values())
+
+    def __wrap(self, original):
+        def read(tensor, *args, **kwargs):
+            caller = sys._getframe(1)
+            site, torchvision = site_of(caller.f_code.co_filename, caller.f_lineno)
+            sites = self.torchvision_sites if torchvision else self.sites
+            sites[site] = sites.get(site, 0) + 1
+            return original(tensor, *args, **kwargs)
+        return read
+    def __enter__(self):
+        import torch
+        for name in READS:
+            self.saved[name] = torch.Tensor.__dict__.get(name)
+            setattr(torch.Tensor, name, self.__wrap(getattr(torch.Tensor, name)))
+        return self
+
+    def __exit__(self, *exc):
+        import torch
+        for name, original in self.saved.items():
+            if original is None:
+                delattr(torch.Tensor, name)
+            else:
+                setattr(torch.Tensor, name, original)
+
+
+if __name__ == '__main__':
+    parser = common.make_parser("diffusion cond_fn: host syncs per guidance step")
+    parser.add_argument("-s", type=int, help="image size (square)", default=128, dest='size')
+    parser.add_argument("--steps", type=int, help="guidance steps to run", default=10, dest='steps')
+    parser.add_argument("--batch-size", type=int, help="images per step", default=1, dest='batch_size')
+    parser.add_argument("--cutn-batches", type=int, help="cut batches per step", default=2, dest='cutn_batches')
+    parser.add_argument("--skip-augs", action='store_true', help="leave out the cutout augmentations", dest='skip_augs')
+    parser.add_argument("-cd", type=str, help="device (default: cuda:0 if there is a GPU)", default=None, dest='cuda_device')
+    args = parser.parse_args()
+
+    if args.cuda_device == 'cpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    import torch
+    import diffusion
+    import stubs
+
+    if args.cuda_device is None:
+        args.cuda_device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(args.cuda_device)
+    clip_model = stubs.TinyCLIP().to(device).eval().requires_grad_(False)
+    model_stats = [{'clip_model': clip_model,
+                    'target_embeds': torch.randn([2, 512], device=device),
+                    'weights': torch.tensor([0.5, 0.5], device=device)}]
+    secondary_model = diffusion.SecondaryDiffusionImageNet2().to(device).eval().requires_grad_(False)
+    guidance_args = stubs.guidance_args(cutn_batches=args.cutn_batches, skip_augs=args.skip_augs)
+    guidance = diffusion.ClipGuidance(guidance_args, stubs.diffusion_schedule(),
+                                      None, secondary_model, None, model_stats, device)
+    x = torch.randn([args.batch_size, 3, args.size, args.size], device=device)
+
+    # one warm-up step, so lazy initialisation doesn't count
+    guidance.cur_t = 999
+    guidance(x, torch.full([args.batch_size], 999, device=device))
+
+    sync = torch.cuda.synchronize if device.type == 'cuda' else (lambda: None)
+    cuda_sync_sites = {}
+    torchvision_cuda_sync_sites = {}
+    sync()
+    start = time.perf_counter()
+    with HostReadCounter() as counter, warnings.catch_warnings(record=True) as caught:
+        if device.type == 'cuda':
+            warnings.simplefilter('always')
+            torch.cuda.set_sync_debug_mode('warn')
+        for step in range(args.steps):
+            guidance.cur_t = 998 - step
+            guidance(x, torch.full([args.batch_size], guidance.cur_t, device=device))
+        if device.type == 'cuda':
+            torch.cuda.set_sync_debug_mode('default')
+            for w in caught:
+                if 'synchroniz' in str(w.message):
+                    site, torchvision = site_of(w.filename, w.lineno)
+                    sites = torchvision_cuda_sync_sites if torchvision else cuda_sync_sites
+                    sites[site] = sites.get(site, 0) + 1
+    sync()
+    seconds = time.perf_counter() - start
+    cuda_syncs = sum(cuda_sync_sites.values())
+
+    results = {
+        'size': args.size,
+        'batch_size': args.batch_size,
+        'cutn_batches': args.cutn_batches,
+        'skip_augs': args.skip_augs,
+        'device': str(device),
+        # only a GPU run sees syncs from copies between the host and the device
+        'sync_debug_mode': device.type == 'cuda',
+        'steps': args.steps,
+        'seconds_per_step': seconds / args.steps,
+        'host_reads': counter.count(),
+        'host_reads_per_step': counter.count() / args.steps,
+        'host_read_sites': counter.sites,
+        'cuda_syncs': cuda_syncs if device.type == 'cuda' else None,
+        'cuda_sync_sites': cuda_sync_sites,
+        'torchvision_host_read_sites': counter.torchvision_sites,
+        'torchvision_cuda_sync_sites': torchvision_cuda_sync_sites,
+        # reading the logged losses back is one sync, after sampling
+        'logged_losses': len(guidance.loss_history()),
+    }
+    common.write_results('cond_fn_syncs', results, args.json)
+
+    if device.type != 'cuda':
+        print('No GPU: only reads of tensor values were counted; run with -cd cuda:0 to check for every sync')
+    if counter.count() > 0 or cuda_syncs > 0:
+        print(f'cond_fn synced {counter.count() + cuda_syncs} times in {args.steps} steps')
+        sys.exit(1)
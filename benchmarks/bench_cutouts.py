@@ -0,0 +1,174 @@
+# Timings for making CLIP cutouts: the per-cutout loop the cutout classes used
+# to run (slice, Lanczos prefilter and bicubic resize for each cutout) versus
+# cutouts.resample_boxes, which crops and resamples every cutout with one
+# banded gather per axis, and versus the dense [cutn, out, in] resampling
+# matrices it first used (checking the two give the same cutouts). Times the
+# forward pass and forward + backward (as in a training step), and also times
+# the full vqgan cutout classes. For the pooling cutouts ('latest', the
+# default) it compares the old pool-cutn-times loop with pooling once, and
+# checks both give exactly the same cutouts for the same seed. Exits with
+# status 1 if the banded and dense cutouts differ. Runs on the CPU unless given
+# a device; diffusion pads a 512px image to 768px before cutting, so on a GPU
+# try e.g.:
+#   python benchmarks/bench_cutouts.py -s 512 512 --cutn 32 64
+#   python benchmarks/bench_cutouts.py -cd cuda:0 -s 768 768 --cutn 16 64
+
+import os
+import sys
+
+import common
+
+
+# the loop from the old MakeCutoutsOrig/MakeCutoutsUpdate/MakeCutoutsNRUpdate
+def loop_cutouts(resample, input, cutn, cut_size, cut_pow=1.):
+    import torch
+    sideY, sideX = input.shape[2:4]
+    max_size = min(sideX, sideY)
+    min_size = min(sideX, sideY, cut_size)
+    cutouts = []
+    for _ in range(cutn):
+        size = int(torch.rand([])**cut_pow * (max_size - min_size) + min_size)
+        offsetx = torch.randint(0, sideX - size + 1, ())
+        offsety = torch.randint(0, sideY - size + 1, ())
+        cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
+        cutouts.append(resample(cutout, (cut_size, cut_size)))
+    return torch.cat(cutouts, dim=0)
+
+
+def batched_cutouts(input, cutn, cut_size, cut_pow=1.):
+    from cutouts import random_boxes, resample_boxes
+    sideY, sideX = input.shape[2:4]
+    boxes = random_boxes(cutn, sideX, sideY, cut_size, cut_pow)
+    return resample_boxes(input, boxes, (cut_size, cut_size))
+
+
+# resample_boxes as it was first written: a dense matrix per cutout and axis
+# with a weight for every pixel of the image, applied with two batched matmuls
+def dense_resample_boxes(input, boxes, size, a=2):
+    import torch
+    from cutouts import sinc
+
+    def weights(start, length, in_size, out_size):
+        start = start.to(input.device, torch.float32)[:, None, None]
+        length = length.to(input.device, torch.float32)[:, None, None]
+        scale = length / out_size
+        support = scale.clamp(min=1)
+        centres = start + (torch.arange(out_size, device=input.device)[None, :, None] + 0.5) * scale
+        pixels = torch.arange(in_size, device=input.device, dtype=torch.float32)[None, None, :]
+        x = (pixels + 0.5 - centres) / support
+        w = torch.where(x.abs() < a, sinc(x) * sinc(x / a), x.new_zeros([]))
+        w = w * ((pixels >= start) & (pixels < start + length))
+        return (w / w.sum(dim=2, keepdim=True)).to(input.dtype)
+
+    b, c, h, w = input.shape
+    weights_y = weights(boxes[:, 1], boxes[:, 3], h, size[0])
+    weights_x = weights(boxes[:, 0], boxes[:, 2], w, size[1])
+    out = torch.matmul(weights_y[:, None, None], input[None])
+    out = torch.matmul(out, weights_x.transpose(1, 2)[:, None, None])
+    return out.reshape([len(boxes) * b, c, size[0], size[1]])
+
+
+def dense_cutouts(input, cutn, cut_size, cut_pow=1.):
+    from cutouts import random_boxes
+    sideY, sideX = input.shape[2:4]
+    boxes = random_boxes(cutn, sideX, sideY, cut_size, cut_pow)
+    return dense_resample_boxes(input, boxes, (cut_size, cut_size))
+
+
+# MakeCutouts.forward as it was, pooling cutn times
+def loop_pooled_forward(make_cutouts, input):
+    import torch
+    cutouts = []
+    for _ in range(make_cutouts.cutn):
+        cutout = (make_cutouts.av_pool(input) + make_cutouts.max_pool(input))/2
+        cutouts.append(cutout)
+    batch = make_cutouts.augs(torch.cat(cutouts, dim=0))
+    if make_cutouts.noise_fac:
+        facs = batch.new_empty([make_cutouts.cutn, 1, 1, 1]).uniform_(0, make_cutouts.noise_fac)
+        batch = batch + facs * torch.randn_like(batch)
+    return batch
+
+
+def same_for_seed(a, b, seed=1234):
+    import torch
+    torch.manual_seed(seed)
+    x = a()
+    torch.manual_seed(seed)
+    y = b()
+    return bool(torch.equal(x, y))
+
+
+def with_backward(fn, input):
+    def step():
+        input.grad = None
+        fn().sum().backward()
+    return step
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('CLIP cutouts: per-cutout loop vs. one batched crop-and-resample')
+    parser.add_argument("-s", nargs=2, type=int, help="image size", default=[512, 512], dest='size')
+    parser.add_argument("--cutn", nargs='+', type=int, help="cutout counts to time", default=[32, 64], dest='cutn')
+    parser.add_argument("--cut-size", type=int, help="cutout size (CLIP input resolution)", default=224, dest='cut_size')
+    parser.add_argument("--repeat", type=int, help="timed runs per case", default=5, dest='repeat')
+    parser.add_argument("-cd", type=str, help="device", default="cpu", dest='cuda_device')
+    args = parser.parse_args()
+
+    # cutouts run on the GPU for real jobs; on the CPU keep this a like-for-like comparison
+    if args.cuda_device == 'cpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    import torch
+    import cutouts
+    import vqgan
+
+    device = torch.device(args.cuda_device)
+    sync = torch.cuda.synchronize if device.type == 'cuda' else None
+    torch.manual_seed(0)
+    image = torch.rand([1, 3, args.size[1], args.size[0]], device=device, requires_grad=True)
+
+    results = {'size': args.size, 'cut_size': args.cut_size, 'device': str(device), 'cases': []}
+    for cutn in args.cutn:
+        loop = lambda: loop_cutouts(cutouts.resample, image, cutn, args.cut_size)
+        batched = lambda: batched_cutouts(image, cutn, args.cut_size)
+        dense = lambda: dense_cutouts(image, cutn, args.cut_size)
+        case = {
+            'cutn': cutn,
+            'loop_forward': common.timed(loop, args.repeat, sync=sync),
+            'batched_forward': common.timed(batched, args.repeat, sync=sync),
+            'dense_forward': common.timed(dense, args.repeat, sync=sync),
+            'loop_backward': common.timed(with_backward(loop, image), args.repeat, sync=sync),
+            'batched_backward': common.timed(with_backward(batched, image), args.repeat, sync=sync),
+            'dense_backward': common.timed(with_backward(dense, image), args.repeat, sync=sync),
+        }
+        case['speedup_forward'] = case['loop_forward']['mean'] / case['batched_forward']['mean']
+        case['speedup_backward'] = case['loop_backward']['mean'] / case['batched_backward']['mean']
+        case['speedup_over_dense'] = case['dense_backward']['mean'] / case['batched_backward']['mean']
+        boxes = cutouts.random_boxes(cutn, args.size[0], args.size[1], args.cut_size)
+        with torch.no_grad():
+            banded = cutouts.resample_boxes(image, boxes, (args.cut_size, args.cut_size))
+            case['dense_max_abs_diff'] = (banded - dense_resample_boxes(image, boxes, (args.cut_size, args.cut_size))).abs().max().item()
+
+        # the vqgan cutout classes as a job uses them, augments and all
+        classes = {
+            'original': vqgan.MakeCutoutsOrig(args.cut_size, cutn),
+            'updated': vqgan.MakeCutoutsUpdate(args.cut_size, cutn),
+            'nrupdated': vqgan.MakeCutoutsNRUpdate(args.cut_size, cutn),
+        }
+        for name, make_cutouts in classes.items():
+            case['class_' + name] = common.timed(with_backward(lambda: make_cutouts(image), image), args.repeat, sync=sync)
+
+        pooled = vqgan.MakeCutouts(args.cut_size, cutn)
+        loop = lambda: loop_pooled_forward(pooled, image)
+        once = lambda: pooled(image)
+        case['pooled_loop'] = common.timed(with_backward(loop, image), args.repeat, sync=sync)
+        case['pooled_once'] = common.timed(with_backward(once, image), args.repeat, sync=sync)
+        case['pooled_speedup'] = case['pooled_loop']['mean'] / case['pooled_once']['mean']
+        case['pooled_bit_identical'] = same_for_seed(loop, once)
+        results['cases'].append(case)
+
+    common.write_results('cutouts', results, args.json)
+
+    if any(case['dense_max_abs_diff'] > 1e-4 for case in results['cases']):
+        print('the banded cutouts differ from the dense ones')
+        sys.exit(1)
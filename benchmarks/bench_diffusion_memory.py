@@ -0,0 +1,91 @@
+# Leak check for the resident diffusion engine: renders many small jobs on the
+# CPU with one DiffusionEngine (the way a resident worker does) and records the
+# process memory after each job. Once the first few jobs have loaded the CLIP
+# models and warmed up the allocator, memory should stay flat; exits with
+# status 1 if it keeps growing by more than --max-growth MB.
+# Needs the diffusion checkpoints in content/models, e.g.:
+#   python benchmarks/bench_diffusion_memory.py --jobs 50 -s 64 64 -i 5
+
+import os
+import sys
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# keep torch off the GPU so the numbers only reflect host memory
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import common
+
+
+# current resident set size in MB (Linux), peak RSS elsewhere (NaN on Windows)
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('Host memory across many jobs rendered by one resident DiffusionEngine')
+    parser.add_argument("--jobs", type=int, help="number of jobs to render", default=50, dest='jobs')
+    parser.add_argument("--warmup", type=int, help="jobs to run before measuring growth", default=5, dest='warmup')
+    parser.add_argument("--max-growth", type=float, help="allowed RSS growth after warmup, in MB", default=64, dest='max_growth')
+    parser.add_argument("-s", nargs=2, type=int, help="image size", default=[64, 64], dest='size')
+    parser.add_argument("-i", type=int, help="steps per job", default=5, dest='steps')
+    args = parser.parse_args()
+
+    import torch
+    import diffusion
+
+    outdir = os.path.join('output', 'bench-diffusion-memory')
+    job_args = []
+    for n in range(args.jobs):
+        argv = ['-s', str(args.size[0]), str(args.size[1]),
+                '-i', str(args.steps),
+                '-p', 'a red apple | watercolor',
+                '-sd', str(n + 1),
+                '-cuts', '1',
+                '-dvitb16', 'no', '-drn50', 'no',
+                '-o', outdir + '/job-' + str(n) + '.png']
+        job_args.append(argv)
+
+    engine = None
+    rss = []
+    peak = []
+    for argv in job_args:
+        job = diffusion.build_args(diffusion.parser.parse_args(argv))
+        if engine is None:
+            engine = diffusion.DiffusionEngine(torch.device('cpu'), job.diffusion_model, job.use_checkpoint)
+        engine.generate(job)
+        rss.append(rss_mb())
+        peak.append(peak_rss_mb())
+
+    warmup = min(args.warmup, args.jobs - 1)
+    growth = rss[-1] - rss[warmup]
+    results = {
+        'jobs': args.jobs,
+        'size': args.size,
+        'steps': args.steps,
+        'rss_mb': rss,
+        'peak_rss_mb': peak,
+        'rss_after_warmup_mb': rss[warmup],
+        'rss_growth_after_warmup_mb': growth,
+        'peak_growth_after_warmup_mb': peak[-1] - peak[warmup],
+        'growth_per_job_kb': growth * 1024 / max(args.jobs - 1 - warmup, 1),
+    }
+    common.write_results('diffusion_memory', results, args.json)
+
+    if growth > args.max_growth:
+        print(f'Memory grew by {growth:.1f} MB after warmup (limit {args.max_growth} MB)')
+        sys.exit(1)
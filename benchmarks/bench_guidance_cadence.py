@@ -0,0 +1,44 @@
+# Time versus quality for CLIP-guided diffusion's guidance cadence (diffusion.py
+# -ge): each schedule guides only every k-th step and reuses the last gradient
+# in between. Runs on the CPU with the stand-in models from stubs.py (see
+# bench_samplers.py), all from the same noise; quality is how close the final
+# image stays to guiding every step (as RMSE and PSNR), and the speedup is
+# against guiding every step too. Needs the guided-diffusion repo. E.g.:
+#   python benchmarks/bench_guidance_cadence.py --steps 100
+#   python benchmarks/bench_guidance_cadence.py --sampler plms --schedules 2 3 "[1]*500+[3]*500"
+
+import os
+
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import common
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('CLIP-guided diffusion: time and quality of guiding only every k-th step')
+    parser.add_argument("-s", type=int, help="image size (square)", default=64, dest='size')
+    parser.add_argument("--sampler", type=str, help="sampler to run (ddim or plms)", default='ddim', dest='sampler')
+    parser.add_argument("--steps", type=int, help="sampling steps", default=100, dest='steps')
+    parser.add_argument("--schedules", nargs='+', type=str, help="guidance schedules to compare with guiding every step",
+                        default=['2', '4', '[1]*400+[2]*600', '[1]*400+[2]*300+[4]*300'], dest='schedules')
+    parser.add_argument("--seed", type=int, help="seed for the starting noise and stand-in models", default=1234, dest='seed')
+    args = parser.parse_args()
+
+    import torch
+    import diffusion
+    from bench_samplers import distance, sample, stand_ins
+
+    noise = torch.randn([1, 3, args.size, args.size], generator=torch.Generator().manual_seed(args.seed))
+
+    unet, guidance_for = stand_ins(args.seed)
+    reference, reference_seconds = sample(args.sampler, args.steps, unet, guidance_for, noise)
+    results = {'size': args.size, 'sampler': args.sampler, 'steps': args.steps,
+               'every_step': {'seconds': reference_seconds}, 'cases': []}
+    for schedule in args.schedules:
+        unet, guidance_for = stand_ins(args.seed, guidance_every=diffusion.step_schedule(schedule))
+        image, seconds = sample(args.sampler, args.steps, unet, guidance_for, noise)
+        case = {'schedule': schedule, 'seconds': seconds, 'speedup': reference_seconds / seconds}
+        case.update(distance(image, reference))
+        results['cases'].append(case)
+
+    common.write_results('guidance_cadence', results, args.json)
@@ -0,0 +1,198 @@
+# Times the per-iteration hot paths of the generators on the CPU, using the
+# small stand-in networks from stubs.py so no GPU or checkpoints are needed:
+# vector_quantize, synth, every cutout class, resample, spherical_dist_loss,
+# diffusion's cond_fn (ClipGuidance), perlin_ms, and make_art's PNG to JPEG
+# post-processing and prompt file parsing. Results are JSON; keep them around
+# to compare versions:
+#   python benchmarks/bench_hot_paths.py --json hot_paths.json
+#   python benchmarks/bench_hot_paths.py --only cutouts.vqgan.latest cond_fn
+
+import os
+import shutil
+import tempfile
+
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import common
+
+
+def bench_vqgan(args, cases):
+    import torch
+    import cutouts
+    import vqgan
+    import stubs
+
+    generator = stubs.vqgan_generator(vqgan)
+    toks = args.size // generator.f
+    z = torch.randn([1, generator.e_dim, toks, toks], requires_grad=True)
+
+    def quantize_backward():
+        vqgan.vector_quantize(z.movedim(1, 3), generator.codebook).sum().backward()
+
+    def synth_backward():
+        generator.synth(z).sum().backward()
+
+    cases['vector_quantize'] = lambda: vqgan.vector_quantize(z.movedim(1, 3), generator.codebook)
+    cases['vector_quantize.backward'] = quantize_backward
+    cases['synth'] = lambda: generator.synth(z)
+    cases['synth.backward'] = synth_backward
+
+    image = torch.rand([1, 3, args.size, args.size], requires_grad=True)
+    classes = {
+        'latest': vqgan.MakeCutouts(generator.cut_size, args.cutn),
+        'original': vqgan.MakeCutoutsOrig(generator.cut_size, args.cutn),
+        'updated': vqgan.MakeCutoutsUpdate(generator.cut_size, args.cutn),
+        'nrupdated': vqgan.MakeCutoutsNRUpdate(generator.cut_size, args.cutn),
+        'updatedpooling': vqgan.MakeCutoutsPoolingUpdate(generator.cut_size, args.cutn),
+    }
+    for name, make_cutouts in classes.items():
+        cases['cutouts.vqgan.' + name] = lambda make_cutouts=make_cutouts: make_cutouts(image)
+
+    crop = torch.rand([1, 3, args.size * 3 // 4, args.size * 3 // 4])
+    cases['resample'] = lambda: cutouts.resample(crop, (generator.cut_size, generator.cut_size))
+
+
+def bench_diffusion(args, cases):
+    import torch
+    import diffusion
+    import stubs
+
+    clip_model = stubs.TinyCLIP().eval().requires_grad_(False)
+    cut_size = clip_model.visual.input_resolution
+    image = torch.rand([1, 3, args.size, args.size])
+
+    make_cutouts = diffusion.MakeCutouts(cut_size, args.cutn)
+    cases['cutouts.diffusion.image_prompt'] = lambda: make_cutouts(image.mul(2).sub(1))
+    dango = diffusion.MakeCutoutsDango(cut_size, IC_Size_Pow=1)
+    cases['cutouts.diffusion.dango'] = lambda: dango(image, Overview=4, InnerCrop=12, IC_Grey_P=0.2)
+    # building the cutout maker (and its augments) for every call, as cond_fn
+    # used to for every step, CLIP model and cut batch
+    cases['cutouts.diffusion.dango.per_call'] = lambda: diffusion.MakeCutoutsDango(
+        cut_size, Overview=4, InnerCrop=12, IC_Size_Pow=1, IC_Grey_P=0.2)(image)
+
+    embeds = torch.randn([args.cutn, 1, 512])
+    targets = torch.randn([1, 4, 512])
+    cases['spherical_dist_loss'] = lambda: diffusion.spherical_dist_loss(embeds, targets)
+
+    model_stats = [{'clip_model': clip_model,
+                    'target_embeds': torch.randn([2, 512]),
+                    'weights': torch.tensor([0.5, 0.5])}]
+    schedule = stubs.diffusion_schedule()
+    secondary_model = diffusion.SecondaryDiffusionImageNet2().eval().requires_grad_(False)
+    guidance = diffusion.ClipGuidance(stubs.guidance_args(), schedule, None, secondary_model, None, model_stats, torch.device('cpu'))
+    guidance.cur_t = 500
+    x = torch.randn([1, 3, args.size, args.size])
+    t = torch.tensor([500])
+    cases['cond_fn'] = lambda: guidance(x, t)
+    # a batch of 4 images in one call, as with !DIFFUSION_BATCH = 4
+    x4 = torch.randn([4, 3, args.size, args.size])
+    cases['cond_fn.batch4'] = lambda: guidance(x4, t)
+
+    octaves = [1.5**-i*0.5 for i in range(12)]
+    cases['perlin_ms'] = lambda: diffusion.perlin_ms(octaves, 1, 1, False)
+
+
+def bench_make_art(args, cases):
+    from PIL import Image
+    import numpy as np
+    import journal
+    import make_art
+    from make_art import DEFAULT_SETTINGS, Job, Worker
+
+    folder = tempfile.mkdtemp(prefix='bench-hot-paths-')
+    source = os.path.join(folder, 'source.png')
+    Image.fromarray(np.random.randint(0, 255, (args.size, args.size, 3), dtype=np.uint8)).save(source)
+    target = os.path.join(folder, 'image.png')
+    job = Job(DEFAULT_SETTINGS, 'a red apple | watercolor', 1234, target)
+    command = make_art.command_line(job.argv('', target))
+    worker = Worker(job)
+
+    cases['worker.save_jpg'] = (lambda: worker.save_jpg(command, target, 60),
+                                lambda: shutil.copyfile(source, target))
+
+    # reading a big generated prompt file and queueing its jobs, as at startup
+    # and on the reload hotkey
+    prompt_file = os.path.join(folder, 'prompts.txt')
+    with open(prompt_file, 'w') as f:
+        f.write('[subjects]\n!PROCESS = vqgan\n')
+        f.writelines('a red apple number ' + str(n) + '\n' for n in range(args.prompt_lines))
+        f.write('\n[styles]\nwatercolor\noil painting # a comment\n')
+        f.write('\n[prefixes]\na painting of\n\n[suffixes]\nby an old master\n')
+    control = object.__new__(make_art.Controller)
+    control.prompt_file_name = prompt_file
+    control.residents = None
+
+    control.shuffle = False
+    control.journal = journal.Journal(prompt_file + '.journal')
+
+    def read_and_queue():
+        control.settings = DEFAULT_SETTINGS
+        control.read_prompt_file()
+        control.init_work_queue()
+
+    # jobs are made as they're taken, so time taking the first thousand too
+    def take_jobs(shuffle):
+        def take():
+            control.shuffle = shuffle
+            read_and_queue()
+            for _ in range(min(1000, len(control.work_queue))):
+                control.next_job()
+        return take
+
+    cases['controller.read_prompt_file'] = control.read_prompt_file
+    cases['controller.read_and_queue'] = read_and_queue
+    cases['controller.take_1000_jobs'] = take_jobs(False)
+    cases['controller.take_1000_jobs.shuffled'] = take_jobs(True)
+
+    # a unique output name in a folder that already has lots of images with
+    # the same name: probing the disk for each candidate as make_art used to,
+    # vs. a fresh name index (one folder listing)
+    names_folder = os.path.join(folder, 'names')
+    os.makedirs(names_folder)
+    for n in range(1, args.existing_outputs + 1):
+        open(os.path.join(names_folder, 'a-red-apple' + ('-' + str(n) if n > 1 else '') + '.jpg'), 'w').close()
+    name = os.path.join(names_folder, 'a-red-apple.png')
+
+    def probe():
+        x = 1
+        path = name
+        while os.path.exists(path.replace('.png', '.jpg')):
+            x += 1
+            path = name.replace('.png', '') + '-' + str(x) + '.png'
+        return path
+
+    cases['output_name.probe'] = probe
+    cases['output_name.index'] = lambda: make_art.OutputNames().take(name)
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('Per-iteration hot paths of the generators, on the CPU with stand-in models')
+    parser.add_argument("-s", type=int, help="image size (square)", default=256, dest='size')
+    parser.add_argument("--cutn", type=int, help="cutouts per iteration", default=32, dest='cutn')
+    parser.add_argument("--existing-outputs", type=int, help="images already in the output folder with the same name", default=1000, dest='existing_outputs')
+    parser.add_argument("--prompt-lines", type=int, help="subject lines in the generated prompt file", default=10000, dest='prompt_lines')
+    parser.add_argument("--repeat", type=int, help="timed runs per case", default=5, dest='repeat')
+    parser.add_argument("--only", nargs='+', help="only run cases whose names start with one of these", default=None, dest='only')
+    args = parser.parse_args()
+
+    import torch
+    torch.manual_seed(0)
+
+    # case name -> fn, or (fn, untimed setup)
+    cases = {}
+    skipped = {}
+    for name, add_cases in (('vqgan', bench_vqgan), ('diffusion', bench_diffusion), ('make_art', bench_make_art)):
+        try:
+            add_cases(args, cases)
+        except ImportError as e:
+            # e.g. diffusion.py's extra requirements aren't installed
+            skipped[name] = str(e)
+
+    results = {'size': args.size, 'cutn': args.cutn, 'threads': torch.get_num_threads(), 'cases': {}, 'skipped': skipped}
+    for name, case in cases.items():
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        fn, setup = case if isinstance(case, tuple) else (case, None)
+        results['cases'][name] = common.timed(fn, args.repeat, setup=setup)
+
+    common.write_results('hot_paths', results, args.json)
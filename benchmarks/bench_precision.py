@@ -0,0 +1,81 @@
+# Iterations per second of vqgan's training step in each --precision, and how
+# far its loss curve drifts from fp32's for the same seed. Runs on the CPU with
+# the stand-in models from stubs.py, where autocast only does bf16 (fp16 is
+# only timed with -cd on a GPU, using the same stand-ins). E.g.:
+#   python benchmarks/bench_precision.py -s 256 256 -i 50
+#   python benchmarks/bench_precision.py -cd cuda:0 --precision fp32 fp16 bf16
+
+import os
+import time
+
+import common
+
+
+def run(vqgan, generator, args, precision):
+    import torch
+    import stubs
+    job = vqgan.parse_args(['-s', str(args.size[0]), str(args.size[1]), '-i', str(args.iterations),
+                            '-se', str(args.iterations + 1), '-cuts', str(args.cutn),
+                            '-cutm', args.cut_method, '-cd', args.cuda_device, '-pr', precision])
+    make_cutouts, z, z_orig, pMs, opt, scaler = stubs.vqgan_training_job(vqgan, generator, job, args.seed)
+
+    sync = torch.cuda.synchronize if generator.device.type == 'cuda' else (lambda: None)
+    losses = []
+    times = []
+    for i in range(1, args.iterations + 1):
+        sync()
+        start = time.perf_counter()
+        loss = generator.train(job, make_cutouts, opt, z, z_orig, pMs, i, scaler)
+        sync()
+        times.append(time.perf_counter() - start)
+        losses.append(loss.item())
+
+    # the first iterations pay for warm-up, leave them out of the timing
+    times = times[min(args.warmup, len(times) - 1):]
+    return {
+        'iterations_per_second': len(times) / sum(times),
+        'step': {'runs': len(times), 'mean': sum(times) / len(times), 'min': min(times), 'max': max(times)},
+        'final_loss': losses[-1],
+        'losses': losses,
+    }
+
+
+# relative difference of a loss curve from the fp32 one, per iteration
+def drift(losses, reference):
+    diffs = [abs(a - b) / max(abs(b), 1e-12) for a, b in zip(losses, reference)]
+    return {'mean': sum(diffs) / len(diffs), 'max': max(diffs), 'final': diffs[-1]}
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('vqgan training step: iterations per second and loss drift for each --precision')
+    parser.add_argument("-s", nargs=2, type=int, help="image size", default=[256, 256], dest='size')
+    parser.add_argument("-i", type=int, help="iterations per precision", default=30, dest='iterations')
+    parser.add_argument("--warmup", type=int, help="iterations left out of the timing", default=3, dest='warmup')
+    parser.add_argument("--cutn", type=int, help="cutouts per iteration", default=32, dest='cutn')
+    parser.add_argument("--cut-method", type=str, help="vqgan cut method", default='latest', dest='cut_method')
+    parser.add_argument("--precision", nargs='+', type=str, help="precisions to compare with fp32", default=None, dest='precision')
+    parser.add_argument("--seed", type=int, help="seed for the latent and prompts", default=1234, dest='seed')
+    parser.add_argument("-cd", type=str, help="device", default="cpu", dest='cuda_device')
+    args = parser.parse_args()
+
+    if args.cuda_device == 'cpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    import vqgan
+    import stubs
+
+    generator = stubs.vqgan_generator(vqgan, args.cuda_device)
+    device = generator.device
+    precisions = args.precision or (['bf16'] if device.type == 'cpu' else ['fp16', 'bf16'])
+
+    results = {'size': args.size, 'cutn': args.cutn, 'cut_method': args.cut_method, 'device': str(device), 'precisions': {}}
+    reference = run(vqgan, generator, args, 'fp32')
+    results['precisions']['fp32'] = reference
+    for precision in precisions:
+        if precision == 'fp32':
+            continue
+        result = run(vqgan, generator, args, precision)
+        result['speedup'] = result['iterations_per_second'] / reference['iterations_per_second']
+        result['loss_drift'] = drift(result['losses'], reference['losses'])
+        results['precisions'][precision] = result
+    common.write_results('precision', results, args.json)
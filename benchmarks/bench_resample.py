@@ -0,0 +1,67 @@
+# Micro-benchmark for cutouts.resample() on the CPU: building the Lanczos
+# kernels the old way (ramp filled element by element, rebuilt on every call)
+# versus the vectorised ramp and the kernel cache, and resample() itself on a
+# typical crop with a cold and a warm kernel cache. Also times the batched
+# cutouts' resample_weights() for a batch of crops with a cold and a warm grid
+# cache. E.g.:
+#   python benchmarks/bench_resample.py --crop 400 --cut-size 224
+
+import math
+import os
+
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import common
+
+
+# ramp() as it was, filling the tensor in a Python loop
+def loop_ramp(ratio, width):
+    import torch
+    n = math.ceil(width / ratio + 1)
+    out = torch.empty([n])
+    cur = 0
+    for i in range(out.shape[0]):
+        out[i] = cur
+        cur += ratio
+    return torch.cat([-out[1:].flip([0]), out])[1:-1]
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('resample(): Lanczos kernel construction and caching')
+    parser.add_argument("--crop", type=int, help="crop size being resampled", default=400, dest='crop')
+    parser.add_argument("--cut-size", type=int, help="output size (CLIP input resolution)", default=224, dest='cut_size')
+    parser.add_argument("--cutn", type=int, help="crops per batch for resample_weights", default=32, dest='cutn')
+    parser.add_argument("--repeat", type=int, help="timed runs per case", default=100, dest='repeat')
+    args = parser.parse_args()
+
+    import torch
+    import cutouts
+
+    ratio = args.cut_size / args.crop
+    device = torch.device('cpu')
+    crop = torch.rand([1, 3, args.crop, args.crop])
+
+    def cold_resample():
+        cutouts.lanczos_kernels.clear()
+        cutouts.resample(crop, (args.cut_size, args.cut_size))
+
+    boxes = cutouts.random_boxes(args.cutn, args.crop, args.crop, args.cut_size)
+    weights = lambda: cutouts.resample_weights(boxes[:, 0], boxes[:, 2], args.crop, args.cut_size, device=device)
+
+    def cold_weights():
+        cutouts.resample_grids.clear()
+        weights()
+
+    results = {
+        'crop': args.crop,
+        'cut_size': args.cut_size,
+        'kernel_loop_ramp': common.timed(lambda: cutouts.lanczos(loop_ramp(ratio, 2), 2).to(device, torch.float32), args.repeat),
+        'kernel_vectorised_ramp': common.timed(lambda: cutouts.lanczos(cutouts.ramp(ratio, 2), 2).to(device, torch.float32), args.repeat),
+        'kernel_cached': common.timed(lambda: cutouts.lanczos_kernel(ratio, 2, device, torch.float32), args.repeat),
+        'resample_cold_cache': common.timed(cold_resample, args.repeat),
+        'resample_warm_cache': common.timed(lambda: cutouts.resample(crop, (args.cut_size, args.cut_size)), args.repeat),
+        'weights_cold_cache': common.timed(cold_weights, args.repeat),
+        'weights_warm_cache': common.timed(weights, args.repeat),
+        'ramp_max_abs_diff': (loop_ramp(ratio, 2) - cutouts.ramp(ratio, 2)).abs().max().item(),
+    }
+    common.write_results('resample', results, args.json)
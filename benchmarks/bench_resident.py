@@ -0,0 +1,67 @@
+# Time per VQGAN job when every job starts a new "python vqgan.py" process (how
+# make_art.py ran jobs before resident workers) versus feeding the same jobs to
+# one resident worker process that keeps its models loaded.
+# Needs a GPU (or patience) and the default VQGAN checkpoint, e.g.:
+#   python benchmarks/bench_resident.py --jobs 5 -s 128 128 -i 50
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+from make_art import ResidentProcess
+
+
+def job_argv(args, outdir, n):
+    return ['-s', str(args.size[0]), str(args.size[1]),
+            '-i', str(args.iterations),
+            '-p', 'a red apple | watercolor',
+            '-sd', str(n + 1),
+            '-cd', args.cuda_device,
+            '-o', os.path.join(outdir, 'job-' + str(n) + '.png')]
+
+
+def summarize(times):
+    return {
+        'per_job': times,
+        'first_job': times[0],
+        'mean_after_first': sum(times[1:]) / max(len(times) - 1, 1),
+        'total': sum(times),
+    }
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('VQGAN time per job: new process per job vs. resident worker')
+    parser.add_argument("--jobs", type=int, help="number of jobs to run in each mode", default=5, dest='jobs')
+    parser.add_argument("-s", nargs=2, type=int, help="image size", default=[128, 128], dest='size')
+    parser.add_argument("-i", type=int, help="iterations per job", default=50, dest='iterations')
+    parser.add_argument("-cd", type=str, help="cuda device", default="cuda:0", dest='cuda_device')
+    args = parser.parse_args()
+
+    outdir = tempfile.mkdtemp(prefix='bench-resident-')
+
+    subprocess_times = []
+    for n in range(args.jobs):
+        start = time.perf_counter()
+        subprocess.call([sys.executable, 'vqgan.py'] + job_argv(args, outdir, n))
+        subprocess_times.append(time.perf_counter() - start)
+
+    resident_times = []
+    resident = ResidentProcess('vqgan')
+    for n in range(args.jobs):
+        start = time.perf_counter()
+        resident.run(job_argv(args, outdir, n))
+        resident_times.append(time.perf_counter() - start)
+    resident.stop()
+
+    results = {
+        'jobs': args.jobs,
+        'size': args.size,
+        'iterations': args.iterations,
+        'subprocess': summarize(subprocess_times),
+        'resident': summarize(resident_times),
+        'speedup_per_job': sum(subprocess_times) / sum(resident_times),
+    }
+    common.write_results('resident_worker', results, args.json)
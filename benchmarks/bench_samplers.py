@@ -0,0 +1,106 @@
+# Quality versus time for CLIP-guided diffusion's samplers (diffusion.py -sm)
+# at different step counts, on the CPU with the stand-in UNet, CLIP and
+# secondary models from stubs.py. Every run starts from the same noise and is
+# guided by diffusion's own cond_fn (ClipGuidance, with deterministic cutouts);
+# quality is how close the final image gets to a many-step ddim reference (as
+# RMSE and PSNR). ddim runs with eta 0 here so it's deterministic too (jobs use
+# 0.8, which adds fresh noise every step). Needs the guided-diffusion repo
+# (see the setup instructions). E.g.:
+#   python benchmarks/bench_samplers.py --steps 25 50 100
+#   python benchmarks/bench_samplers.py -s 128 --reference-steps 500
+
+import math
+import os
+import time
+
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import common
+
+
+def make_diffusion(steps):
+    from guided_diffusion.script_util import create_gaussian_diffusion
+    # the same respacing diffusion.py uses for a step count
+    return create_gaussian_diffusion(steps=(1000//steps)*steps if steps < 1000 else steps,
+                                     learn_sigma=True, noise_schedule='linear', use_kl=False,
+                                     predict_xstart=False, rescale_timesteps=True,
+                                     rescale_learned_sigmas=True, timestep_respacing=f'ddim{steps}')
+
+
+# the final image of one sampling run, and how long it took
+def sample(sampler, steps, unet, guidance_for, noise):
+    diffusion = make_diffusion(steps)
+    cond_fn = guidance_for(diffusion)
+    cur_t = diffusion.num_timesteps - 1
+    cond_fn.cur_t = cur_t
+    kwargs = dict(clip_denoised=False, model_kwargs={}, cond_fn=cond_fn, progress=False,
+                  noise=noise, randomize_class=False)
+    if sampler == 'plms':
+        samples = diffusion.plms_sample_loop_progressive(unet, noise.shape, order=2, **kwargs)
+    else:
+        samples = diffusion.ddim_sample_loop_progressive(unet, noise.shape, eta=0., **kwargs)
+
+    start = time.perf_counter()
+    # do_run keeps cond_fn's step in line with the sampler's the same way
+    for sample in samples:
+        cur_t -= 1
+        cond_fn.cur_t = cur_t
+        image = sample['pred_xstart']
+    seconds = time.perf_counter() - start
+    return image.clamp(-1, 1), seconds
+
+
+# the stand-in UNet, and a function that makes a cond_fn for a diffusion;
+# guidance uses overview cutouts only and no augmentations, so it's the same
+# for every run
+def stand_ins(seed, **guidance_overrides):
+    import torch
+    import diffusion
+    import stubs
+    torch.manual_seed(seed)
+    schedule = stubs.diffusion_schedule()
+    unet = stubs.TinyUNet(schedule.sqrt_alphas_cumprod**2).eval().requires_grad_(False)
+    clip_model = stubs.TinyCLIP().eval().requires_grad_(False)
+    secondary_model = diffusion.SecondaryDiffusionImageNet2().eval().requires_grad_(False)
+    model_stats = [{'clip_model': clip_model,
+                    'target_embeds': torch.randn([2, 512]),
+                    'weights': torch.tensor([0.5, 0.5])}]
+    guidance_args = stubs.guidance_args(skip_augs=True, cutn_batches=1, cut_overview=[4]*1000,
+                                        cut_innercut=[0]*1000, cut_icgray_p=[0]*1000, **guidance_overrides)
+    guidance_for = lambda d: diffusion.ClipGuidance(guidance_args, d, unet, secondary_model, None,
+                                                    model_stats, torch.device('cpu'))
+    return unet, guidance_for
+
+
+def distance(image, reference):
+    rmse = (image - reference).square().mean().sqrt().item()
+    # images are in [-1, 1], a range of 2
+    psnr = 20 * math.log10(2 / rmse) if rmse > 0 else float('inf')
+    return {'rmse': rmse, 'psnr': psnr}
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('CLIP-guided diffusion: image quality versus time for each sampler and step count')
+    parser.add_argument("-s", type=int, help="image size (square)", default=64, dest='size')
+    parser.add_argument("--samplers", nargs='+', type=str, help="samplers to compare", default=['ddim', 'plms'], dest='samplers')
+    parser.add_argument("--steps", nargs='+', type=int, help="step counts to run each sampler at", default=[25, 50, 100, 250], dest='steps')
+    parser.add_argument("--reference-steps", type=int, help="steps of the ddim reference run", default=1000, dest='reference_steps')
+    parser.add_argument("--seed", type=int, help="seed for the starting noise and stand-in models", default=1234, dest='seed')
+    args = parser.parse_args()
+
+    import torch
+
+    unet, guidance_for = stand_ins(args.seed)
+    noise = torch.randn([1, 3, args.size, args.size], generator=torch.Generator().manual_seed(args.seed))
+
+    reference, reference_seconds = sample('ddim', args.reference_steps, unet, guidance_for, noise)
+    results = {'size': args.size, 'reference': {'sampler': 'ddim', 'steps': args.reference_steps, 'seconds': reference_seconds},
+               'cases': []}
+    for sampler in args.samplers:
+        for steps in args.steps:
+            image, seconds = sample(sampler, steps, unet, guidance_for, noise)
+            case = {'sampler': sampler, 'steps': steps, 'seconds': seconds}
+            case.update(distance(image, reference))
+            results['cases'].append(case)
+
+    common.write_results('samplers', results, args.json)
@@ -0,0 +1,104 @@
+# Latency and peak memory of vector_quantize (forward + backward, as in synth)
+# against the version it replaced, which built the full [tokens, n_e] distance
+# matrix and a one-hot matrix of the same size. Peak memory is the allocator's
+# peak on CUDA; on the CPU each version runs in a fresh process and the growth
+# of its peak RSS is reported instead. E.g.:
+#   python benchmarks/bench_vector_quantize.py -s 512 512
+#   python benchmarks/bench_vector_quantize.py -s 512 512 -cd cuda:0
+
+import json
+import os
+import subprocess
+import sys
+
+import common
+
+
+# vector_quantize as it was
+def one_hot_quantize(x, codebook):
+    import torch.nn.functional as F
+    import vqgan
+    d = x.pow(2).sum(dim=-1, keepdim=True) + codebook.pow(2).sum(dim=1) - 2 * x @ codebook.T
+    indices = d.argmin(-1)
+    x_q = F.one_hot(indices, codebook.shape[0]).to(d.dtype) @ codebook
+    return vqgan.replace_grad(x_q, x)
+
+
+def setup(args):
+    import torch
+    torch.manual_seed(0)
+    device = torch.device(args.cuda_device)
+    codebook = torch.randn([args.n_e, args.e_dim], device=device)
+    norms = codebook.pow(2).sum(dim=1)
+    z = torch.randn([1, args.size[1] // 16, args.size[0] // 16, args.e_dim], device=device, requires_grad=True)
+    return device, codebook, norms, z
+
+
+def step_for(name, codebook, norms, z):
+    import vqgan
+    if name == 'one_hot':
+        quantize = lambda: one_hot_quantize(z, codebook)
+    elif name == 'indexed':
+        quantize = lambda: vqgan.vector_quantize(z, codebook)
+    else:
+        quantize = lambda: vqgan.vector_quantize(z, codebook, norms)
+
+    def step():
+        z.grad = None
+        quantize().sum().backward()
+    return step
+
+
+# runs one version in this (fresh) process and returns its peak RSS growth in MB
+def measure_rss(args, name):
+    import resource
+    device, codebook, norms, z = setup(args)
+    step = step_for(name, codebook, norms, z)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    step()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return (after - before) / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('vector_quantize: one-hot matmul vs. chunked indexed lookup')
+    parser.add_argument("-s", nargs=2, type=int, help="image size", default=[512, 512], dest='size')
+    parser.add_argument("--n-e", type=int, help="codebook size", default=16384, dest='n_e')
+    parser.add_argument("--e-dim", type=int, help="code size", default=256, dest='e_dim')
+    parser.add_argument("--repeat", type=int, help="timed runs per version", default=10, dest='repeat')
+    parser.add_argument("-cd", type=str, help="device", default="cpu", dest='cuda_device')
+    parser.add_argument("--measure-rss", type=str, help="internal: measure one version's peak RSS", default=None, dest='measure_rss')
+    args = parser.parse_args()
+
+    if args.measure_rss:
+        print(json.dumps(measure_rss(args, args.measure_rss)))
+        sys.exit(0)
+
+    import torch
+    device, codebook, norms, z = setup(args)
+    sync = torch.cuda.synchronize if device.type == 'cuda' else None
+
+    results = {'size': args.size, 'tokens': z.shape[1] * z.shape[2], 'n_e': args.n_e, 'device': str(device), 'versions': {}}
+    for name in ('one_hot', 'indexed', 'indexed_cached_norms'):
+        step = step_for(name, codebook, norms, z)
+        result = {'latency': common.timed(step, args.repeat, sync=sync)}
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+            step()
+            sync()
+            result['peak_mb'] = (torch.cuda.max_memory_allocated(device) - base) / 2**20
+        elif os.name != 'nt':
+            output = subprocess.check_output([sys.executable, os.path.join(common.ROOT, 'benchmarks', 'bench_vector_quantize.py'), '--measure-rss', name,
+                                              '-s', str(args.size[0]), str(args.size[1]),
+                                              '--n-e', str(args.n_e), '--e-dim', str(args.e_dim)])
+            result['peak_rss_growth_mb'] = json.loads(output.decode().strip().splitlines()[-1])
+        results['versions'][name] = result
+
+    # both versions should pick the same codes (bar exact distance ties)
+    import vqgan
+    with torch.no_grad():
+        same = (one_hot_quantize(z, codebook) == vqgan.vector_quantize(z, codebook, norms)).all(dim=-1)
+    results['same_codes'] = same.float().mean().item()
+    common.write_results('vector_quantize', results, args.json)
@@ -0,0 +1,81 @@
+# Time per image when a resident VQGAN worker runs jobs one at a time versus
+# optimising them together in one batch (what make_art.py does with
+# !VQGAN_BATCH over 1), and how far the batched images drift from the
+# one-at-a-time ones for the same seeds (mean/max absolute pixel difference).
+# Needs a GPU (or patience) and the default VQGAN checkpoint, e.g.:
+#   python benchmarks/bench_vqgan_batch.py --batch 4 -s 128 128 -i 50
+
+import os
+import tempfile
+import time
+
+import common
+
+PROMPTS = ['a red apple | watercolor', 'a lighthouse at night | oil painting',
+           'a fox in the snow | pencil sketch', 'a city skyline | pixel art']
+
+
+def job_argv(args, outdir, name, n):
+    return ['-s', str(args.size[0]), str(args.size[1]),
+            '-i', str(args.iterations),
+            '-se', str(args.iterations),
+            '-p', PROMPTS[n % len(PROMPTS)],
+            '-sd', str(n + 1),
+            '-cd', args.cuda_device,
+            '-o', os.path.join(outdir, name + '-' + str(n) + '.png')]
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('VQGAN time per image: one job at a time vs. one batch of jobs')
+    parser.add_argument("--batch", type=int, help="number of jobs in the batch", default=4, dest='batch')
+    parser.add_argument("-s", nargs=2, type=int, help="image size", default=[128, 128], dest='size')
+    parser.add_argument("-i", type=int, help="iterations per job", default=50, dest='iterations')
+    parser.add_argument("-cd", type=str, help="cuda device", default="cuda:0", dest='cuda_device')
+    args = parser.parse_args()
+
+    import numpy as np
+    import torch
+    from PIL import Image
+    import vqgan
+
+    outdir = tempfile.mkdtemp(prefix='bench-vqgan-batch-')
+    single_jobs = [vqgan.parse_args(job_argv(args, outdir, 'single', n)) for n in range(args.batch)]
+    batch_jobs = [vqgan.parse_args(job_argv(args, outdir, 'batch', n)) for n in range(args.batch)]
+    first = single_jobs[0]
+    generator = vqgan.VQGANGenerator(first.vqgan_config, first.vqgan_checkpoint, first.clip_model, first.cuda_device)
+    sync = torch.cuda.synchronize if generator.device.type == 'cuda' else None
+
+    # warm up kernels and the embedding cache so neither mode pays for them
+    generator.generate(vqgan.parse_args(job_argv(args, outdir, 'warmup', 0)))
+
+    if sync:
+        sync()
+    start = time.perf_counter()
+    for job in single_jobs:
+        generator.generate(job)
+    if sync:
+        sync()
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    generator.generate_batch(batch_jobs)
+    if sync:
+        sync()
+    batch_time = time.perf_counter() - start
+
+    diffs = []
+    for single, batched in zip(single_jobs, batch_jobs):
+        a = np.asarray(Image.open(single.output), dtype=np.float32)
+        b = np.asarray(Image.open(batched.output), dtype=np.float32)
+        diffs.append({'mean': float(np.abs(a - b).mean()), 'max': float(np.abs(a - b).max())})
+
+    results = {
+        'batch': args.batch,
+        'size': args.size,
+        'iterations': args.iterations,
+        'single_per_image': single_time / args.batch,
+        'batch_per_image': batch_time / args.batch,
+        'speedup': single_time / batch_time,
+        'pixel_diff': diffs,
+    }
+    common.write_results('vqgan_batch', results, args.json)
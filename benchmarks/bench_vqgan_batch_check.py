@@ -0,0 +1,114 @@
+# Checks that optimising VQGAN jobs together in one batch (generate_batch /
+# train_batch, what make_art.py's resident workers do with a run of VQGAN
+# jobs) gives the same images as running them one at a time with generate, on
+# the CPU with the stand-in models from stubs.py. Every job has its own seed
+# and prompt; the final latents and the last saved images of the two runs are
+# compared, and the script exits with status 1 if any job differs by more than
+# the tolerance (as a mean absolute difference). E.g.:
+#   python benchmarks/bench_vqgan_batch_check.py --jobs 4 -i 20
+
+import os
+import sys
+import tempfile
+import time
+
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import common
+
+PROMPTS = ['a red apple | watercolor', 'a lighthouse at night | oil painting',
+           'a fox in the snow | pencil sketch', 'a city skyline | pixel art']
+
+
+def job_argv(args, outdir, name, n):
+    return ['-s', str(args.size[0]), str(args.size[1]),
+            '-i', str(args.iterations),
+            '-se', str(args.iterations),
+            '-cuts', str(args.cutn),
+            '-p', PROMPTS[n % len(PROMPTS)],
+            '-sd', str(args.seed + n),
+            '-cd', 'cpu',
+            '-o', os.path.join(outdir, name + '-' + str(n) + '.png')]
+
+
+# runs jobs through run(jobs), returning each job's final latent and last
+# saved image (in job order) and how long it took
+def final_images(generator, jobs, run):
+    latents = {}
+    images = {}
+
+    # instead of saving, keep the job's latent (which is optimised in place,
+    # so it ends up the final one) and a copy of the image
+    def checkin(args, z, i, losses, out=None):
+        if out is None:
+            out = generator.synth(z)
+        latents[args.output] = z
+        images[args.output] = out.detach().float().clone()
+
+    generator.checkin = checkin
+    start = time.perf_counter()
+    run(jobs)
+    seconds = time.perf_counter() - start
+    del generator.checkin
+    return [latents[job.output].detach().clone() for job in jobs], [images[job.output] for job in jobs], seconds
+
+
+def difference(a, b):
+    diff = (a - b).abs()
+    return {'mean': diff.mean().item(), 'max': diff.max().item()}
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('VQGAN: batched jobs versus the same jobs one at a time')
+    parser.add_argument("--jobs", type=int, help="number of jobs in the batch", default=4, dest='jobs')
+    parser.add_argument("-s", nargs=2, type=int, help="image size", default=[64, 64], dest='size')
+    parser.add_argument("-i", type=int, help="iterations per job", default=10, dest='iterations')
+    parser.add_argument("-cuts", type=int, help="cutouts per iteration", default=8, dest='cutn')
+    parser.add_argument("--seed", type=int, help="seed of the first job (and the stand-in models)", default=1234, dest='seed')
+    parser.add_argument("--tolerance", type=float, help="largest mean absolute difference allowed per job", default=1e-3, dest='tolerance')
+    args = parser.parse_args()
+
+    import torch
+    import vqgan
+    import stubs
+
+    torch.manual_seed(args.seed)
+    generator = stubs.vqgan_generator(vqgan)
+    outdir = tempfile.mkdtemp(prefix='bench-vqgan-batch-check-')
+    single_jobs = [vqgan.parse_args(job_argv(args, outdir, 'single', n)) for n in range(args.jobs)]
+    batch_jobs = [vqgan.parse_args(job_argv(args, outdir, 'batch', n)) for n in range(args.jobs)]
+    if vqgan.VQGANGenerator.batch_key(batch_jobs[0]) is None:
+        print('These jobs can only run one at a time')
+        sys.exit(1)
+    # generate_batch checks the jobs' models against the generator's
+    generator.key = vqgan.VQGANGenerator.key_for(batch_jobs[0])
+
+    single_latents, single_images, single_seconds = final_images(
+        generator, single_jobs, lambda jobs: [generator.generate(job) for job in jobs])
+    batch_latents, batch_images, batch_seconds = final_images(generator, batch_jobs, generator.generate_batch)
+
+    cases = []
+    mismatched = []
+    for n in range(args.jobs):
+        case = {'seed': single_jobs[n].seed,
+                'latent_diff': difference(single_latents[n], batch_latents[n]),
+                'pixel_diff': difference(single_images[n], batch_images[n])}
+        if case['latent_diff']['mean'] > args.tolerance or case['pixel_diff']['mean'] > args.tolerance:
+            mismatched.append(n)
+        cases.append(case)
+
+    results = {
+        'jobs': args.jobs,
+        'size': args.size,
+        'iterations': args.iterations,
+        'tolerance': args.tolerance,
+        'single_seconds': single_seconds,
+        'batch_seconds': batch_seconds,
+        'cases': cases,
+        'mismatched': mismatched,
+    }
+    common.write_results('vqgan_batch_check', results, args.json)
+
+    if mismatched:
+        print(f'{len(mismatched)} of {args.jobs} batched jobs differ from the same jobs run one at a time')
+        sys.exit(1)
@@ -0,0 +1,77 @@
+# Shared helpers for the benchmark scripts in this directory.
+# Importing this switches to the repo root (the generator modules expect to be
+# run from there to find checkpoints/ and the cloned CLIP/taming repos) and
+# makes the top-level modules importable.
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+# argument parser with the options every benchmark accepts
+def make_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--json", type=str, help="also write the results to this JSON file", default=None, dest='json')
+    return parser
+
+
+# calls fn() warmup times untimed, then repeat times; returns timings in seconds
+# (setup(), if given, runs untimed before every call)
+def timed(fn, repeat=10, warmup=1, sync=None, setup=None):
+    for _ in range(warmup):
+        if setup:
+            setup()
+        fn()
+    if sync:
+        sync()
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+            if sync:
+                sync()
+        start = time.perf_counter()
+        fn()
+        if sync:
+            sync()
+        times.append(time.perf_counter() - start)
+    return {
+        'runs': repeat,
+        'mean': sum(times) / len(times),
+        'min': min(times),
+        'max': max(times),
+    }
+
+
+# prints the results as JSON and optionally writes them to a file, tagged with
+# enough environment info to compare runs between versions
+def write_results(name, results, path=None):
+    env = {'python': platform.python_version(), 'platform': platform.platform()}
+    try:
+        import torch
+        env['torch'] = torch.__version__
+        env['device'] = torch.cuda.get_device_name() if torch.cuda.is_available() else 'cpu'
+    except ImportError:
+        pass
+
+    payload = {
+        'benchmark': name,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'env': env,
+        'results': results,
+    }
+    text = json.dumps(payload, indent=2)
+    print(text)
+    if path:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+    return payload
@@ -0,0 +1,78 @@
+# Runs every CPU benchmark, each in its own process so they don't share caches
+# or allocator state, and collects the results into one JSON file. Pass the
+# file from an earlier version with --compare to see what got slower:
+#   python benchmarks/run_all.py --json after.json --compare before.json
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import common
+
+# the benchmarks that need neither a GPU nor any checkpoints
+CPU_BENCHMARKS = ['bench_hot_paths.py', 'bench_cutouts.py', 'bench_resample.py', 'bench_vector_quantize.py', 'bench_precision.py',
+                  'bench_cond_fn_syncs.py', 'bench_vqgan_batch_check.py']
+
+
+# {path: mean} for every timing (a dict with a 'mean') in a results tree
+def timings(tree, path=''):
+    found = {}
+    if isinstance(tree, dict):
+        if 'mean' in tree and 'runs' in tree:
+            found[path] = tree['mean']
+        else:
+            for key, value in tree.items():
+                found.update(timings(value, path + '/' + str(key)))
+    elif isinstance(tree, list):
+        for n, value in enumerate(tree):
+            found.update(timings(value, path + '/' + str(n)))
+    return found
+
+
+def compare(before, after, threshold):
+    old = timings(before)
+    new = timings(after)
+    slower = 0
+    for path in sorted(set(old) & set(new)):
+        ratio = new[path] / old[path] if old[path] > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  <-- slower'
+            slower += 1
+        print(f'{path}: {old[path] * 1000:.2f} ms -> {new[path] * 1000:.2f} ms ({ratio:.2f}x){flag}')
+    return slower
+
+
+if __name__ == '__main__':
+    parser = common.make_parser('Run all CPU benchmarks and collect their results')
+    parser.add_argument("--compare", type=str, help="results of an earlier run_all to compare against", default=None, dest='compare')
+    parser.add_argument("--threshold", type=float, help="how much slower counts as a regression (0.1 = 10%%)", default=0.1, dest='threshold')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='bench-run-all-')
+    results = {}
+    failed = []
+    for script in CPU_BENCHMARKS:
+        name = script[:-3]
+        path = os.path.join(folder, name + '.json')
+        print('Running ' + script + '...')
+        code = subprocess.call([sys.executable, os.path.join('benchmarks', script), '--json', path])
+        if code != 0 or not os.path.exists(path):
+            failed.append(script)
+            continue
+        with open(path) as f:
+            results[name] = json.load(f)
+
+    common.write_results('run_all', {'benchmarks': results, 'failed': failed}, args.json)
+
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)
+        slower = compare(before['results']['benchmarks'], results, args.threshold)
+        print(str(slower) + ' timings got slower by more than ' + str(round(args.threshold * 100)) + '%')
+        if slower > 0:
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
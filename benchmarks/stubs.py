@@ -0,0 +1,119 @@
+# Small randomly initialised stand-ins for the real networks, so the hot paths
+# can be timed on a CPU-only box without downloading any checkpoints. Tensor
+# shapes follow the real models (a 16384-entry codebook of 256-dim codes, a 16x
+# VQGAN decoder, 224px CLIP input with 512-dim embeddings); only the networks
+# themselves are cut down to a layer or two.
+
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from torch import nn
+
+import embed_cache
+
+
+# the parts of a taming VQModel that VQGANGenerator uses
+class TinyVQGAN(nn.Module):
+    def __init__(self, n_e=16384, e_dim=256, num_resolutions=5):
+        super().__init__()
+        self.quantize = nn.Module()
+        self.quantize.embedding = nn.Embedding(n_e, e_dim)
+        self.quantize.e_dim = e_dim
+        self.quantize.n_e = n_e
+        self.decoder = nn.Sequential(
+            nn.Conv2d(e_dim, 32, 1),
+            nn.Upsample(scale_factor=2**(num_resolutions - 1)),
+            nn.Conv2d(32, 3, 3, padding=1),
+        )
+        self.decoder.num_resolutions = num_resolutions
+
+    def decode(self, z):
+        return self.decoder(z)
+
+
+# the parts of a CLIP model that the generators use
+class TinyCLIP(nn.Module):
+    def __init__(self, input_resolution=224, output_dim=512, patch_size=32):
+        super().__init__()
+        self.visual = nn.Conv2d(3, output_dim, patch_size, stride=patch_size)
+        self.visual.input_resolution = input_resolution
+        self.visual.output_dim = output_dim
+        self.token_embedding = nn.Embedding(49408, output_dim)
+
+    def encode_image(self, image):
+        return self.visual(image).mean(dim=(2, 3))
+
+    def encode_text(self, tokens):
+        return self.token_embedding(tokens).mean(dim=1)
+
+
+# a VQGANGenerator around the stand-in models, without loading anything
+def vqgan_generator(vqgan, device='cpu'):
+    return vqgan.VQGANGenerator('stub', 'stub', 'stub', device,
+                                model=TinyVQGAN().eval().requires_grad_(False), perceptor=TinyCLIP(),
+                                # in memory only, so text prompts are encoded by the stand-in CLIP
+                                cache=embed_cache.EmbeddingCache())
+
+
+# what VQGANGenerator.train needs for a job (parsed vqgan args), with a random
+# starting latent and two random text prompt embeddings instead of real ones
+def vqgan_training_job(vqgan, generator, job, seed):
+    make_cutouts = generator.get_cutouts(job)
+    torch.manual_seed(seed)
+    toksX, toksY = job.size[0] // generator.f, job.size[1] // generator.f
+    z = generator.codebook[torch.randint(generator.n_toks, [toksY * toksX], device=generator.device)]
+    z = z.view([-1, toksY, toksX, generator.e_dim]).permute(0, 3, 1, 2).contiguous()
+    z_orig = z.clone()
+    z.requires_grad_(True)
+    embeds = torch.randn([2, generator.perceptor.visual.output_dim], device=generator.device)
+    pMs = [vqgan.Prompt(embed[None], 1.).to(generator.device) for embed in embeds]
+    opt = vqgan.get_opt(job.optimiser, job.step_size, z)
+    return make_cutouts, z, z_orig, pMs, opt, vqgan.grad_scaler(job)
+
+
+# stands in for guided-diffusion's UNetModel (with learn_sigma): predicts the
+# noise in x at timestep t (on the 1000-step scale, as the rescaled samplers
+# pass it), plus a variance output. The noise prediction is the exact one for
+# images whose pixels are drawn from N(mean, std**2), so samplers have a real
+# trajectory to follow, and a small conv layer adds a network's cost and a
+# little curvature on top.
+class TinyUNet(nn.Module):
+    def __init__(self, alphas_cumprod, mean=0.1, std=0.5, channels=32):
+        super().__init__()
+        self.register_buffer('alphas_cumprod', torch.tensor(alphas_cumprod, dtype=torch.float32))
+        self.mean = mean
+        self.std = std
+        self.inp = nn.Conv2d(3, channels, 3, padding=1)
+        self.out = nn.Conv2d(channels, 6, 3, padding=1)
+        nn.init.normal_(self.out.weight, std=0.01)
+
+    def forward(self, x, t, y=None):
+        a = self.alphas_cumprod[t.long().clamp(0, len(self.alphas_cumprod) - 1)][:, None, None, None]
+        eps = (1 - a).sqrt() * (x - a.sqrt() * self.mean) / (a * self.std**2 + 1 - a)
+        out = self.out(torch.nn.functional.silu(self.inp(x)))
+        return torch.cat([eps + out[:, :3], out[:, 3:]], dim=1)
+
+
+# the noise schedule arrays cond_fn reads from a guided-diffusion GaussianDiffusion
+def diffusion_schedule(steps=1000):
+    betas = np.linspace(0.0001, 0.02, steps, dtype=np.float64)
+    alphas_cumprod = np.cumprod(1.0 - betas)
+    return SimpleNamespace(num_timesteps=steps,
+                           sqrt_alphas_cumprod=np.sqrt(alphas_cumprod),
+                           sqrt_one_minus_alphas_cumprod=np.sqrt(1.0 - alphas_cumprod))
+
+
+# the settings cond_fn reads, with the default cut schedules of diffusion.py
+def guidance_args(**overrides):
+    args = SimpleNamespace(
+        use_secondary_model=True, cutn_batches=4,
+        cut_overview=[12]*400 + [4]*600, cut_innercut=[4]*400 + [12]*600,
+        cut_ic_pow=1, cut_icgray_p=[0.2]*400 + [0]*600,
+        animation_mode='None', skip_augs=False,
+        clip_guidance_scale=5000, tv_scale=0, range_scale=150, sat_scale=0, init_scale=1000,
+        clamp_grad=True, clamp_max=0.05, guidance_every=[1]*1000,
+    )
+    for name, value in overrides.items():
+        setattr(args, name, value)
+    return args
@@ -0,0 +1,148 @@
+# Batched cutouts for CLIP guidance, shared by vqgan.py and diffusion.py.
+# The older cutout classes crop and resample each cutout in a Python loop (a
+# slice, fresh Lanczos kernels, two convolutions and an interpolate per
+# cutout, every iteration). Here all the crop boxes are drawn at once, and
+# every cutout is produced in one go as one weighted gather per axis. Each
+# output pixel of a cutout takes the few input pixels under an antialiasing
+# Lanczos filter scaled to the cutout's own downsampling ratio, limited to its
+# crop box.
+# resample() below is the per-crop Lanczos prefilter and bicubic resize the
+# loop used, kept (once, for both generators) for comparisons.
+
+import math
+
+import torch
+from torch.nn import functional as F
+
+
+def sinc(x):
+    return torch.where(x != 0, torch.sin(math.pi * x) / (math.pi * x), x.new_ones([]))
+
+
+def lanczos(x, a):
+    cond = torch.logical_and(-a < x, x < a)
+    out = torch.where(cond, sinc(x) * sinc(x/a), x.new_zeros([]))
+    return out / out.sum()
+
+
+def ramp(ratio, width):
+    n = math.ceil(width / ratio + 1)
+    out = torch.arange(n, dtype=torch.float64).mul(ratio).float()
+    return torch.cat([-out[1:].flip([0]), out])[1:-1]
+
+
+# Lanczos kernels by (ratio, a, device, dtype); crops come in a limited number
+# of sizes, so each kernel is only built and copied to the device once
+lanczos_kernels = {}
+
+def lanczos_kernel(ratio, a, device, dtype):
+    key = (ratio, a, device, dtype)
+    kernel = lanczos_kernels.get(key)
+    if kernel is None:
+        kernel = lanczos(ramp(ratio, a), a).to(device, dtype)
+        lanczos_kernels[key] = kernel
+    return kernel
+
+
+# Resizes a single crop
+def resample(input, size, align_corners=True):
+    n, c, h, w = input.shape
+    dh, dw = size
+
+    input = input.reshape([n * c, 1, h, w])
+
+    if dh < h:
+        kernel_h = lanczos_kernel(dh / h, 2, input.device, input.dtype)
+        pad_h = (kernel_h.shape[0] - 1) // 2
+        input = F.pad(input, (0, 0, pad_h, pad_h), 'reflect')
+        input = F.conv2d(input, kernel_h[None, None, :, None])
+
+    if dw < w:
+        kernel_w = lanczos_kernel(dw / w, 2, input.device, input.dtype)
+        pad_w = (kernel_w.shape[0] - 1) // 2
+        input = F.pad(input, (pad_w, pad_w, 0, 0), 'reflect')
+        input = F.conv2d(input, kernel_w[None, None, None, :])
+
+    input = input.reshape([n, c, h, w])
+    return F.interpolate(input, size, mode='bicubic', align_corners=align_corners)
+
+
+# random square crop boxes as an [n, 4] tensor of (x, y, width, height), drawn
+# like the original per-cutout loop: size = rand**cut_pow between the cut size
+# (or the image, if smaller) and the short side, at a random offset. Drawing
+# them on the device the image is on saves copying them there (a host sync)
+def random_boxes(n, sideX, sideY, cut_size, cut_pow=1., device=None):
+    max_size = min(sideX, sideY)
+    min_size = min(sideX, sideY, cut_size)
+    sizes = (torch.rand([n], device=device)**cut_pow * (max_size - min_size) + min_size).floor()
+    offsetx = (torch.rand([n], device=device) * (sideX - sizes + 1)).floor()
+    offsety = (torch.rand([n], device=device) * (sideY - sizes + 1)).floor()
+    return torch.stack([offsetx, offsety, sizes, sizes], dim=1)
+
+
+# The output pixel centres and tap offsets resample_weights starts from, by
+# (in_size, out_size, a, device, dtype); every iteration resamples the same
+# image size to the same cut size, so they're only made (on the device) once.
+# A box is at most in_size pixels long, so no output pixel needs more taps than
+# the Lanczos kernel is wide when it's stretched over in_size / out_size pixels
+resample_grids = {}
+
+def resample_grid(in_size, out_size, a, device, dtype):
+    key = (in_size, out_size, a, device, dtype)
+    grid = resample_grids.get(key)
+    if grid is None:
+        # positions are always float32, whatever type the weights end up in
+        taps = math.ceil(2 * a * max(in_size / out_size, 1)) + 2
+        grid = (torch.arange(out_size, device=device, dtype=torch.float32)[None, :, None] + 0.5,
+                torch.arange(taps, device=device, dtype=torch.float32)[None, None, :])
+        resample_grids[key] = grid
+    return grid
+
+
+# the taps that resample the span [start, start + length) of an axis with
+# in_size pixels to out_size pixels: for every box and output pixel, the
+# indices of the input pixels under its Lanczos kernel and their weights (both
+# [n, out_size, taps]). The kernel is widened by the downsampling ratio so small
+# cutouts of big images don't alias; taps past its edge or outside the box get
+# no weight
+def resample_weights(start, length, in_size, out_size, a=2, device=None, dtype=torch.float32):
+    offsets, taps = resample_grid(in_size, out_size, a, device, dtype)
+    start = start.to(device, torch.float32)[:, None, None]
+    length = length.to(device, torch.float32)[:, None, None]
+    scale = length / out_size
+    support = scale.clamp(min=1)
+    centres = start + offsets * scale
+    pixels = (centres - a * support - 0.5).floor() + taps
+    x = (pixels + 0.5 - centres) / support
+    weights = torch.where(x.abs() < a, sinc(x) * sinc(x / a), x.new_zeros([]))
+    # only pixels inside the crop count (like clamping at its edges)
+    inside = (pixels >= start) & (pixels < start + length)
+    weights = weights * inside
+    weights = weights / weights.sum(dim=2, keepdim=True)
+    return pixels.clamp(0, in_size - 1).long(), weights.to(dtype)
+
+
+# crops every box out of input ([b, c, h, w]) and resamples it to size, giving
+# [n * b, c, size[0], size[1]] in the same order as concatenating the cutouts.
+# Each axis is one weighted gather (embedding_bag over the rows of a tensor
+# with that axis first), so the work is a few multiply-adds per output pixel
+# per tap however big the image is
+def resample_boxes(input, boxes, size, a=2):
+    b, c, h, w = input.shape
+    n = len(boxes)
+    index_y, weights_y = resample_weights(boxes[:, 1], boxes[:, 3], h, size[0], a, input.device, input.dtype)
+    index_x, weights_x = resample_weights(boxes[:, 0], boxes[:, 2], w, size[1], a, input.device, input.dtype)
+
+    # the rows of every cutout: [n * size[0], w * b * c]
+    pixels = input.permute(2, 3, 0, 1).reshape([h, w * b * c])
+    rows = F.embedding_bag(index_y.reshape([n * size[0], -1]), pixels, mode='sum',
+                           per_sample_weights=weights_y.reshape([n * size[0], -1]))
+
+    # then their columns, each cutout's own: [n * size[1], size[0] * b * c]
+    rows = rows.reshape([n, size[0], w, b * c]).transpose(1, 2).reshape([n * w, size[0] * b * c])
+    index_x = index_x + torch.arange(n, device=input.device)[:, None, None] * w
+    out = F.embedding_bag(index_x.reshape([n * size[1], -1]), rows, mode='sum',
+                          per_sample_weights=weights_x.reshape([n * size[1], -1]))
+
+    out = out.reshape([n, size[1], size[0], b, c]).permute(0, 3, 4, 2, 1)
+    return out.reshape([n * b, c, size[0], size[1]])
@@ -11,6 +11,7 @@ sys.path.append('./taming-transformers')
 sys.path.append('./latent-diffusion')
 
 import argparse
+import ast
 import unicodedata
 import re
 from datetime import date
@@ -39,7 +40,9 @@ import torchvision.transforms as T
 import torchvision.transforms.functional as TF
 from tqdm.notebook import tqdm
 import clip
-from resize_right import resize
+import embed_cache
+import image_writer
+from cutouts import random_boxes, resample_boxes
 from guided_diffusion.script_util import create_model_and_diffusion, model_and_diffusion_defaults
 from datetime import datetime
 import numpy as np
@@ -62,10 +65,27 @@ import time
 from omegaconf import OmegaConf
 import torch.nn as nn
 import warnings
+import traceback
+from guided_diffusion.script_util import create_gaussian_diffusion
 
 # Supress warnings
 warnings.filterwarnings('ignore')
 
+# a per-step schedule in the format of cut_overview (e.g. "[1]*400+[2]*600"),
+# or one number for every step, as a list of 1000 whole numbers of at least 1
+def step_schedule(text):
+    try:
+        schedule = []
+        for part in text.replace(' ', '').split('+'):
+            values, _, count = part.partition('*')
+            values = ast.literal_eval(values)
+            schedule += (values if isinstance(values, list) else [values]) * int(count or 1)
+    except (ValueError, TypeError, SyntaxError):
+        raise argparse.ArgumentTypeError("expected a number or a schedule like [1]*400+[2]*600, not " + repr(text))
+    if not schedule or any(not isinstance(k, int) or k < 1 for k in schedule):
+        raise argparse.ArgumentTypeError("schedule values must be whole numbers of at least 1: " + repr(text))
+    return (schedule + schedule[-1:] * 1000)[:1000]
+
 parser = argparse.ArgumentParser(description='AI image generation')
 parser.add_argument("-p",        type=str, help="Text prompts", default=None, dest='prompts')
 parser.add_argument("-i",        type=int, help="Number of steps", default=250, dest='max_iterations')
@@ -74,8 +94,14 @@ parser.add_argument("-ii",       type=str, help="Initial image", default=None, d
 parser.add_argument("-ss",       type=int, help="Skip steps", default=-1, dest='skip_steps')
 parser.add_argument("-cuts",     type=int, help="Number of cut batches", default=4, dest='cutn')
 parser.add_argument("-sd",       type=int, help="Seed", default=None, dest='seed')
+parser.add_argument("-ge",       type=step_schedule, help="Apply CLIP guidance every k-th step and reuse its gradient in between: a number, or a schedule like [1]*400+[2]*600 (default: every step)", default="1", dest='guidance_every')
+parser.add_argument("-sm",       type=str, help="Sampler: ddim, or plms for comparable images in fewer (50-100) steps", choices=['ddim', 'plms'], default="ddim", dest='sampler')
 parser.add_argument("-o",        type=str, help="Output path/filename", default="output/output.png", dest='output')
+parser.add_argument("-bs",       type=int, help="Number of images (seeds -sd, -sd + 1, ...) to render together in one batch", default=1, dest='batch_size')
+parser.add_argument("-bo",       type=str, nargs='+', help="Output filenames (in the folder of -o) for the batch's other images (default: the -o name with -2, -3, ... added)", default=None, dest='batch_outputs')
 parser.add_argument("-cd",       type=int, help="Cuda Device to use", default="0", dest='cuda_device')
+parser.add_argument("-jc",       type=str, help="Save the output as a .jpg with this comment in its EXIF data (used by make_art.py)", default=None, dest='jpg_comment')
+parser.add_argument("-ja",       type=str, help="Author for the EXIF data of a .jpg output", default="", dest='jpg_author')
 parser.add_argument("-dvitb32",  type=str, help="Use VitB32 CLIP model? yes/no", default="yes", dest='VitB32')
 parser.add_argument("-dvitb16",  type=str, help="Use VitB16 CLIP model? yes/no", default="yes", dest='VitB16')
 parser.add_argument("-dvitl14",  type=str, help="Use VitL14 CLIP model? yes/no", default="no", dest='VitL14')
@@ -85,12 +111,8 @@ parser.add_argument("-drn50x4",  type=str, help="Use RN50x4 CLIP model? yes/no",
 parser.add_argument("-drn50x16", type=str, help="Use RN50x16 CLIP model? yes/no", default="no", dest='RN50x16')
 parser.add_argument("-drn50x64", type=str, help="Use RN50x64 CLIP model? yes/no", default="no", dest='RN50x64')
 
-iargs = parser.parse_args()
-
-device = torch.device(f'cuda:{iargs.cuda_device}' if torch.cuda.is_available() else 'cpu')
-print('Using device:', device)
-
 root_path = 'content'
+model_path = 'content/models'
 model_256_downloaded = False
 model_512_downloaded = False
 model_secondary_downloaded = False
@@ -102,27 +124,8 @@ def createPath(filepath):
     #else:
     #  print(f'filepath {filepath} exists.')
 
-
-output_path = "output"
-output_filename = "output.png"
-
-# support path conventions on both windows/*nix
-if '/' in iargs.output:
-    output_filename = iargs.output[iargs.output.rindex('/')+1:]
-    output_path = iargs.output.replace(output_filename,'')[:-1]
-
-if '\\' in iargs.output:
-    output_filename = iargs.output[iargs.output.rindex('\\')+1:]
-    output_path = iargs.output.replace(output_filename,'')[:-1]
-
-initDirPath = f'{root_path}/init_images'
-createPath(initDirPath)
-#outDirPath = f'{root_path}/images_out'
-outDirPath = output_path
-createPath(outDirPath)
-
-model_path = 'content/models'
-createPath(model_path)
+def get_device(cuda_device):
+    return torch.device(f'cuda:{cuda_device}' if torch.cuda.is_available() else 'cpu')
 
 # Taken from https://github.com/django/django/blob/master/django/utils/text.py
 # Using here to make filesystem-safe directory names
@@ -151,7 +154,7 @@ def perlin(width, height, scale=10, device=None):
     dots += (1 - wx) * (1 - wy) * (-gx[1:, 1:] * (1 - xs) - gy[1:, 1:] * (1 - ys))
     return dots.permute(0, 2, 1, 3).contiguous().view(width * scale, height * scale)
 
-def perlin_ms(octaves, width, height, grayscale, device=device):
+def perlin_ms(octaves, width, height, grayscale, device=None):
     out_array = [0.5] if grayscale else [0.5, 0.5, 0.5]
     # out_array = [0.0] if grayscale else [0.0, 0.0, 0.0]
     for i in range(1 if grayscale else 3):
@@ -166,8 +169,8 @@ def perlin_ms(octaves, width, height, grayscale, device=device):
             oct_height *= 2
     return torch.cat(out_array)
 
-def create_perlin_noise(octaves=[1, 1, 1, 1], width=2, height=2, grayscale=True):
-    out = perlin_ms(octaves, width, height, grayscale)
+def create_perlin_noise(octaves=[1, 1, 1, 1], width=2, height=2, grayscale=True, side_x=512, side_y=512, device=None):
+    out = perlin_ms(octaves, width, height, grayscale, device)
     if grayscale:
         out = TF.resize(size=(side_y, side_x), img=out.unsqueeze(0))
         out = TF.to_pil_image(out.clamp(0, 1)).convert('RGB')
@@ -179,20 +182,21 @@ def create_perlin_noise(octaves=[1, 1, 1, 1], width=2, height=2, grayscale=True)
     out = ImageOps.autocontrast(out)
     return out
 
-def regen_perlin():
-    if perlin_mode == 'color':
-        init = create_perlin_noise([1.5**-i*0.5 for i in range(12)], 1, 1, False)
-        init2 = create_perlin_noise([1.5**-i*0.5 for i in range(8)], 4, 4, False)
-    elif perlin_mode == 'gray':
-        init = create_perlin_noise([1.5**-i*0.5 for i in range(12)], 1, 1, True)
-        init2 = create_perlin_noise([1.5**-i*0.5 for i in range(8)], 4, 4, True)
+def regen_perlin(args, device):
+    size = dict(side_x=args.side_x, side_y=args.side_y, device=device)
+    if args.perlin_mode == 'color':
+        init = create_perlin_noise([1.5**-i*0.5 for i in range(12)], 1, 1, False, **size)
+        init2 = create_perlin_noise([1.5**-i*0.5 for i in range(8)], 4, 4, False, **size)
+    elif args.perlin_mode == 'gray':
+        init = create_perlin_noise([1.5**-i*0.5 for i in range(12)], 1, 1, True, **size)
+        init2 = create_perlin_noise([1.5**-i*0.5 for i in range(8)], 4, 4, True, **size)
     else:
-        init = create_perlin_noise([1.5**-i*0.5 for i in range(12)], 1, 1, False)
-        init2 = create_perlin_noise([1.5**-i*0.5 for i in range(8)], 4, 4, True)
+        init = create_perlin_noise([1.5**-i*0.5 for i in range(12)], 1, 1, False, **size)
+        init2 = create_perlin_noise([1.5**-i*0.5 for i in range(8)], 4, 4, True, **size)
 
     init = TF.to_tensor(init).add(TF.to_tensor(init2)).div(2).to(device).unsqueeze(0).mul(2).sub(1)
     del init2
-    return init.expand(batch_size, -1, -1, -1)
+    return init.expand(args.batch_size, -1, -1, -1)
 
 def fetch(url_or_path):
     if str(url_or_path).startswith('http://') or str(url_or_path).startswith('https://'):
@@ -219,44 +223,6 @@ def parse_prompt(prompt):
     vals = vals + ['', '1'][len(vals):]
     return vals[0], float(vals[1])
 
-def sinc(x):
-    return torch.where(x != 0, torch.sin(math.pi * x) / (math.pi * x), x.new_ones([]))
-
-def lanczos(x, a):
-    cond = torch.logical_and(-a < x, x < a)
-    out = torch.where(cond, sinc(x) * sinc(x/a), x.new_zeros([]))
-    return out / out.sum()
-
-def ramp(ratio, width):
-    n = math.ceil(width / ratio + 1)
-    out = torch.empty([n])
-    cur = 0
-    for i in range(out.shape[0]):
-        out[i] = cur
-        cur += ratio
-    return torch.cat([-out[1:].flip([0]), out])[1:-1]
-
-def resample(input, size, align_corners=True):
-    n, c, h, w = input.shape
-    dh, dw = size
-
-    input = input.reshape([n * c, 1, h, w])
-
-    if dh < h:
-        kernel_h = lanczos(ramp(dh / h, 2), 2).to(input.device, input.dtype)
-        pad_h = (kernel_h.shape[0] - 1) // 2
-        input = F.pad(input, (0, 0, pad_h, pad_h), 'reflect')
-        input = F.conv2d(input, kernel_h[None, None, :, None])
-
-    if dw < w:
-        kernel_w = lanczos(ramp(dw / w, 2), 2).to(input.device, input.dtype)
-        pad_w = (kernel_w.shape[0] - 1) // 2
-        input = F.pad(input, (pad_w, pad_w, 0, 0), 'reflect')
-        input = F.conv2d(input, kernel_w[None, None, None, :])
-
-    input = input.reshape([n, c, h, w])
-    return F.interpolate(input, size, mode='bicubic', align_corners=align_corners)
-
 class MakeCutouts(nn.Module):
     def __init__(self, cut_size, cutn, skip_augs=False):
         super().__init__()
@@ -280,22 +246,23 @@ class MakeCutouts(nn.Module):
         sideY, sideX = input.shape[2:4]
         max_size = min(sideX, sideY)
 
-        cutouts = []
-        for ch in range(self.cutn):
-            if ch > self.cutn - self.cutn//4:
-                cutout = input.clone()
-            else:
-                size = int(max_size * torch.zeros(1,).normal_(mean=.8, std=.3).clip(float(self.cut_size/max_size), 1.))
-                offsetx = torch.randint(0, abs(sideX - size + 1), ())
-                offsety = torch.randint(0, abs(sideY - size + 1), ())
-                cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
-
-            if not self.skip_augs:
-                cutout = self.augs(cutout)
-            cutouts.append(resample(cutout, (self.cut_size, self.cut_size)))
-            del cutout
-
-        cutouts = torch.cat(cutouts, dim=0)
+        # random crops, then the whole image for the last quarter of the cutouts
+        # (all made on the image's device, so nothing is copied there)
+        n_crops = min(self.cutn, self.cutn - self.cutn//4 + 1)
+        sizes = (max_size * torch.zeros(n_crops, device=input.device).normal_(mean=.8, std=.3).clip(float(self.cut_size/max_size), 1.)).floor()
+        offsetx = (torch.rand([n_crops], device=input.device) * (sideX - sizes + 1)).floor()
+        offsety = (torch.rand([n_crops], device=input.device) * (sideY - sizes + 1)).floor()
+        boxes = torch.stack([offsetx, offsety, sizes, sizes], dim=1)
+        whole = torch.zeros([self.cutn - n_crops, 4], device=input.device)
+        whole[:, 2], whole[:, 3] = sideX, sideY
+        cutouts = resample_boxes(input, torch.cat([boxes, whole]), (self.cut_size, self.cut_size))
+
+        # augment each cutout on its own. This used to happen before resampling,
+        # on the full size crop; at the cut size the augmentations are far
+        # cheaper and crops can be resampled in one batch, but the images differ
+        # a little from versions before 2026.10.17
+        if not self.skip_augs:
+            cutouts = torch.cat([self.augs(cutout) for cutout in cutouts.split(len(input))])
         return cutouts
 
 cutout_debug = False
@@ -304,7 +271,8 @@ padargs = {}
 class MakeCutoutsDango(nn.Module):
     def __init__(self, cut_size,
                  Overview=4,
-                 InnerCrop = 0, IC_Size_Pow=0.5, IC_Grey_P = 0.2
+                 InnerCrop = 0, IC_Size_Pow=0.5, IC_Grey_P = 0.2,
+                 animation_mode='None', skip_augs=False
                  ):
         super().__init__()
         self.cut_size = cut_size
@@ -312,7 +280,9 @@ class MakeCutoutsDango(nn.Module):
         self.InnerCrop = InnerCrop
         self.IC_Size_Pow = IC_Size_Pow
         self.IC_Grey_P = IC_Grey_P
-        if args.animation_mode == 'None':
+        self.skip_augs = skip_augs
+        self.gray = T.Grayscale(3)
+        if animation_mode == 'None':
           self.augs = T.Compose([
               T.RandomHorizontalFlip(p=0.5),
               T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
@@ -322,7 +292,7 @@ class MakeCutoutsDango(nn.Module):
               T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
               T.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1),
           ])
-        elif args.animation_mode == 'Video Input':
+        elif animation_mode == 'Video Input':
           self.augs = T.Compose([
               T.RandomHorizontalFlip(p=0.5),
               T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
@@ -334,7 +304,7 @@ class MakeCutoutsDango(nn.Module):
               T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
               # T.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1),
           ])
-        elif  args.animation_mode == '2D':
+        elif  animation_mode == '2D':
           self.augs = T.Compose([
               T.RandomHorizontalFlip(p=0.4),
               T.Lambda(lambda x: x + torch.randn_like(x) * 0.01),
@@ -346,50 +316,50 @@ class MakeCutoutsDango(nn.Module):
           ])
 
 
-    def forward(self, input):
+    # Overview, InnerCrop and IC_Grey_P override the counts given to __init__, so
+    # one instance (and its augments) can follow the cut schedules of a whole job
+    def forward(self, input, Overview=None, InnerCrop=None, IC_Grey_P=None):
+        Overview = self.Overview if Overview is None else Overview
+        InnerCrop = self.InnerCrop if InnerCrop is None else InnerCrop
+        IC_Grey_P = self.IC_Grey_P if IC_Grey_P is None else IC_Grey_P
         cutouts = []
-        gray = T.Grayscale(3)
+        gray = self.gray
         sideY, sideX = input.shape[2:4]
         max_size = min(sideX, sideY)
-        min_size = min(sideX, sideY, self.cut_size)
-        l_size = max(sideX, sideY)
-        output_shape = [1,3,self.cut_size,self.cut_size]
-        output_shape_2 = [1,3,self.cut_size+2,self.cut_size+2]
         pad_input = F.pad(input,((sideY-max_size)//2,(sideY-max_size)//2,(sideX-max_size)//2,(sideX-max_size)//2), **padargs)
-        cutout = resize(pad_input, out_shape=output_shape)
-
-        if self.Overview>0:
-            if self.Overview<=4:
-                if self.Overview>=1:
+        # the whole (padded) image as one box; resize_right would read its
+        # padding back from the GPU on every call
+        whole = torch.zeros([1, 4], device=input.device)
+        whole[:, 2], whole[:, 3] = pad_input.shape[3], pad_input.shape[2]
+        cutout = resample_boxes(pad_input, whole, (self.cut_size, self.cut_size))
+
+        if Overview>0:
+            if Overview<=4:
+                if Overview>=1:
                     cutouts.append(cutout)
-                if self.Overview>=2:
+                if Overview>=2:
                     cutouts.append(gray(cutout))
-                if self.Overview>=3:
+                if Overview>=3:
                     cutouts.append(TF.hflip(cutout))
-                if self.Overview==4:
+                if Overview==4:
                     cutouts.append(gray(TF.hflip(cutout)))
             else:
-                cutout = resize(pad_input, out_shape=output_shape)
-                for _ in range(self.Overview):
+                for _ in range(Overview):
                     cutouts.append(cutout)
 
             if cutout_debug:
                 TF.to_pil_image(cutouts[0].clamp(0, 1).squeeze(0)).save("/content/cutout_overview0.jpg",quality=99)
 
-        if self.InnerCrop >0:
-            for i in range(self.InnerCrop):
-                size = int(torch.rand([])**self.IC_Size_Pow * (max_size - min_size) + min_size)
-                offsetx = torch.randint(0, sideX - size + 1, ())
-                offsety = torch.randint(0, sideY - size + 1, ())
-                cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
-                if i <= int(self.IC_Grey_P * self.InnerCrop):
-                    cutout = gray(cutout)
-                cutout = resize(cutout, out_shape=output_shape)
-                cutouts.append(cutout)
+        if InnerCrop >0:
+            # crop and resample all the inner crops at once; the first ones are grey
+            boxes = random_boxes(InnerCrop, sideX, sideY, self.cut_size, self.IC_Size_Pow, input.device)
+            inner = resample_boxes(input, boxes, (self.cut_size, self.cut_size))
+            n_grey = min(int(IC_Grey_P * InnerCrop) + 1, InnerCrop) * len(input)
+            cutouts.append(torch.cat([gray(inner[:n_grey]), inner[n_grey:]]))
             if cutout_debug:
-                TF.to_pil_image(cutouts[-1].clamp(0, 1).squeeze(0)).save("/content/cutout_InnerCrop.jpg",quality=99)
+                TF.to_pil_image(cutouts[-1][-1].clamp(0, 1)).save("/content/cutout_InnerCrop.jpg",quality=99)
         cutouts = torch.cat(cutouts)
-        if skip_augs is not True: cutouts=self.augs(cutouts)
+        if self.skip_augs is not True: cutouts=self.augs(cutouts)
         return cutouts
 
 def spherical_dist_loss(x, y):
@@ -410,7 +380,154 @@ def range_loss(input):
 
 stop_on_next_loop = False  # Make sure GPU memory doesn't get corrupted from cancelling the run mid-way through, allow a full frame to complete
 
-def do_run():
+# Renders one job (the args built by build_args) with the models held by engine
+# The LPIPS distance to a fixed init image, as lpips_model(x, init) gives it,
+# with the init's normalised VGG features worked out once up front instead of
+# again on every step; only x goes through VGG each time
+class InitFeatures:
+    def __init__(self, lpips_model, init):
+        self.lpips_model = lpips_model
+        self.init = init
+        with torch.no_grad():
+            self.features = self.get_features(init)
+
+    def get_features(self, x):
+        if self.lpips_model.version == '0.1':
+            x = self.lpips_model.scaling_layer(x)
+        return [lpips.normalize_tensor(out) for out in self.lpips_model.net.forward(x)]
+
+    # whether init is the image these are the features of
+    def matches(self, init):
+        if init is self.init:
+            return True
+        return init.shape == self.init.shape and init.device == self.init.device and bool(torch.equal(init, self.init))
+
+    def __call__(self, x):
+        val = 0
+        for lin, feature, init_feature in zip(self.lpips_model.lins, self.get_features(x), self.features):
+            val = val + lin((feature - init_feature)**2).mean([2, 3], keepdim=True)
+        return val
+
+
+# cond_fn for the samplers: the gradient that steers each step towards the
+# prompts (CLIP losses over cutouts, plus TV, range, saturation and LPIPS init
+# losses). do_run keeps cur_t and init_features up to date as sampling goes.
+class ClipGuidance:
+    def __init__(self, args, diffusion, model, secondary_model, lpips_model, model_stats, device):
+        self.args = args
+        self.diffusion = diffusion
+        self.model = model
+        self.secondary_model = secondary_model
+        self.lpips_model = lpips_model
+        self.model_stats = model_stats
+        self.device = device
+        self.cur_t = None
+        # the LPIPS features of the init image (see InitFeatures), if any
+        self.init_features = None
+        # the last gradient and the step it was worked out at, for the steps
+        # that reuse it (see guidance_every)
+        self.last_grad = None
+        self.last_t = None
+        # the CLIP loss of every cut batch, kept on the device (see loss_history)
+        self.loss_values = []
+        # the noise schedule on the device, looked up by step without copying
+        self.alphas = torch.tensor(diffusion.sqrt_alphas_cumprod, device=device, dtype=torch.float32)
+        self.sigmas = torch.tensor(diffusion.sqrt_one_minus_alphas_cumprod, device=device, dtype=torch.float32)
+        # the t the sampler passes in at each step (mapped and scaled the way
+        # guided-diffusion does it), so the cut schedules can be looked up
+        # without reading t back from the GPU
+        steps = np.asarray(getattr(diffusion, 'timestep_map', range(diffusion.num_timesteps)), dtype=np.float32)
+        if getattr(diffusion, 'rescale_timesteps', False):
+            steps = steps * np.float32(1000.0 / getattr(diffusion, 'original_num_steps', diffusion.num_timesteps))
+        self.step_t = [int(step) for step in steps]
+        # one cutout maker per CLIP model for the whole job; each step only
+        # passes it that step's counts from the cut schedules
+        self.make_cutouts = []
+        for model_stat in model_stats:
+            #when using SLIP Base model the dimensions need to be hard coded to avoid AttributeError: 'VisionTransformer' object has no attribute 'input_resolution'
+            try:
+                input_resolution=model_stat["clip_model"].visual.input_resolution
+            except:
+                input_resolution=224
+            self.make_cutouts.append(MakeCutoutsDango(input_resolution, IC_Size_Pow=args.cut_ic_pow,
+                                                      animation_mode=args.animation_mode, skip_augs=args.skip_augs))
+
+    # the logged CLIP losses as floats; this waits for the GPU, so it's only
+    # for after sampling
+    def loss_history(self):
+        return torch.stack(self.loss_values).tolist() if self.loss_values else []
+
+    # between guided steps, the last gradient is reused as is: x barely moves
+    # in a step, and skipping CLIP (and the backward pass through it) saves
+    # most of a step's time
+    def __call__(self, x, t, y=None):
+        every = self.args.guidance_every[1000 - (self.step_t[self.cur_t] + 1)]
+        if every > 1 and self.last_grad is not None and self.last_grad.shape == x.shape and 0 <= self.last_t - self.cur_t < every:
+            return self.last_grad
+        self.last_grad = self.guide(x, t, y)
+        self.last_t = self.cur_t
+        return self.last_grad
+
+    # nothing in here reads a value back from the GPU, so the host never has
+    # to wait for a step to finish before queueing the next
+    def guide(self, x, t, y=None):
+        with torch.enable_grad():
+            x = x.detach().requires_grad_()
+            n = x.shape[0]
+            if self.args.use_secondary_model is True:
+              alpha = self.alphas[self.cur_t]
+              sigma = self.sigmas[self.cur_t]
+              cosine_t = alpha_sigma_to_t(alpha, sigma)
+              out = self.secondary_model(x, cosine_t[None].repeat([n])).pred
+              fac = self.diffusion.sqrt_one_minus_alphas_cumprod[self.cur_t]
+              x_in = out * fac + x * (1 - fac)
+              x_in_grad = torch.zeros_like(x_in)
+            else:
+              my_t = torch.ones([n], device=self.device, dtype=torch.long) * self.cur_t
+              out = self.diffusion.p_mean_variance(self.model, x, my_t, clip_denoised=False, model_kwargs={'y': y})
+              fac = self.diffusion.sqrt_one_minus_alphas_cumprod[self.cur_t]
+              x_in = out['pred_xstart'] * fac + x * (1 - fac)
+              x_in_grad = torch.zeros_like(x_in)
+            t_int = self.step_t[self.cur_t]+1 #errors on last step without +1, need to find source
+            overview = self.args.cut_overview[1000-t_int]
+            innercut = self.args.cut_innercut[1000-t_int]
+            icgray_p = self.args.cut_icgray_p[1000-t_int]
+            for model_stat, cuts in zip(self.model_stats, self.make_cutouts):
+              for i in range(self.args.cutn_batches):
+                  clip_in = normalize(cuts(x_in.add(1).div(2), Overview=overview, InnerCrop=innercut, IC_Grey_P=icgray_p))
+                  image_embeds = model_stat["clip_model"].encode_image(clip_in).float()
+                  dists = spherical_dist_loss(image_embeds.unsqueeze(1), model_stat["target_embeds"].unsqueeze(0))
+                  dists = dists.view([overview+innercut, n, -1])
+                  losses = dists.mul(model_stat["weights"]).sum(2).mean(0)
+                  self.loss_values.append(losses.sum().detach()) # log loss, probably shouldn't do per cutn_batch
+                  x_in_grad += torch.autograd.grad(losses.sum() * self.args.clip_guidance_scale, x_in)[0] / self.args.cutn_batches
+            tv_losses = tv_loss(x_in)
+            if self.args.use_secondary_model is True:
+              range_losses = range_loss(out)
+            else:
+              range_losses = range_loss(out['pred_xstart'])
+            sat_losses = torch.abs(x_in - x_in.clamp(min=-1,max=1)).mean([1, 2, 3])
+            loss = tv_losses.sum() * self.args.tv_scale + range_losses.sum() * self.args.range_scale + sat_losses.sum() * self.args.sat_scale
+            if self.init_features is not None and self.args.init_scale:
+                init_losses = self.init_features(x_in)
+                loss = loss + init_losses.sum() * self.args.init_scale
+            x_in_grad += torch.autograd.grad(loss, x_in)[0]
+            grad = -torch.autograd.grad(x_in, x, x_in_grad)[0]
+        if self.args.clamp_grad:
+            # per image, so each image in a batch is steered as it would be alone
+            magnitude = grad.square().mean([1, 2, 3], keepdim=True).sqrt()
+            grad = grad * magnitude.clamp(max=self.args.clamp_max) / magnitude  #min=-0.02, min=-clamp_max,
+        # an image whose gradient NaN'd gets no guidance this step
+        is_nan = torch.isnan(x_in_grad).flatten(1).any(1)[:, None, None, None]
+        return torch.where(is_nan, torch.zeros_like(grad), grad)
+
+
+def do_run(engine, args):
+  device = engine.device
+  model = engine.model
+  diffusion = engine.get_diffusion(args)
+  secondary_model = engine.secondary_model
+  clip_models = engine.get_clip_models(args)
   seed = args.seed
   #print(range(args.start_frame, args.max_frames))
   for frame_num in range(args.start_frame, args.max_frames):
@@ -450,8 +567,8 @@ def do_run():
 
         if frame_num > 0:
           seed = seed + 1
-          if resume_run and frame_num == start_frame:
-            img_0 = cv2.imread(batchFolder+f"/{batch_name}({batchNum})_{start_frame-1:04}.png")
+          if args.resume_run and frame_num == args.start_frame:
+            img_0 = cv2.imread(args.batchFolder+f"/{args.batch_name}({args.batchNum})_{args.start_frame-1:04}.png")
           else:
             img_0 = cv2.imread('prevFrame.png')
           center = (1*img_0.shape[1]//2, 1*img_0.shape[0]//2)
@@ -476,12 +593,10 @@ def do_run():
 
       if args.animation_mode == "Video Input":
         seed = seed + 1
-        init_image = f'{videoFramesFolder}/{frame_num+1:04}.jpg'
+        init_image = f'{args.videoFramesFolder}/{frame_num+1:04}.jpg'
         init_scale = args.frames_scale
         skip_steps = args.calc_frames_skip_steps
 
-      loss_values = []
-
       if seed is not None:
           np.random.seed(seed)
           random.seed(seed)
@@ -510,7 +625,7 @@ def do_run():
       print(f'Frame Prompt: {frame_prompt}')
 
       model_stats = []
-      for clip_model in clip_models:
+      for clip_name, clip_model in clip_models:
             cutn = 16
             model_stat = {"clip_model":None,"target_embeds":[],"make_cutouts":None,"weights":[]}
             model_stat["clip_model"] = clip_model
@@ -518,7 +633,7 @@ def do_run():
 
             for prompt in frame_prompt:
                 txt, weight = parse_prompt(prompt)
-                txt = clip_model.encode_text(clip.tokenize(prompt).to(device)).float()
+                txt = engine.embed_cache.get(clip_name, prompt, lambda text: clip_model.encode_text(clip.tokenize(text).to(device)).float(), device)
 
                 if args.fuzzy_prompt:
                     for i in range(25):
@@ -529,16 +644,16 @@ def do_run():
                     model_stat["weights"].append(weight)
 
             if image_prompt:
-              model_stat["make_cutouts"] = MakeCutouts(clip_model.visual.input_resolution, cutn, skip_augs=skip_augs)
+              model_stat["make_cutouts"] = MakeCutouts(clip_model.visual.input_resolution, cutn, skip_augs=args.skip_augs)
               for prompt in image_prompt:
                   path, weight = parse_prompt(prompt)
                   img = Image.open(fetch(path)).convert('RGB')
-                  img = TF.resize(img, min(side_x, side_y, *img.size), T.InterpolationMode.LANCZOS)
+                  img = TF.resize(img, min(args.side_x, args.side_y, *img.size), T.InterpolationMode.LANCZOS)
                   batch = model_stat["make_cutouts"](TF.to_tensor(img).to(device).unsqueeze(0).mul(2).sub(1))
                   embed = clip_model.encode_image(normalize(batch)).float()
-                  if fuzzy_prompt:
+                  if args.fuzzy_prompt:
                       for i in range(25):
-                          model_stat["target_embeds"].append((embed + torch.randn(embed.shape).cuda() * rand_mag).clamp(0,1))
+                          model_stat["target_embeds"].append((embed + torch.randn(embed.shape).cuda() * args.rand_mag).clamp(0,1))
                           weights.extend([weight / cutn] * cutn)
                   else:
                       model_stat["target_embeds"].append(embed)
@@ -560,89 +675,35 @@ def do_run():
 
       if args.perlin_init:
           print("Using perlin noise as init image")
+          size = dict(side_x=args.side_x, side_y=args.side_y, device=device)
           if args.perlin_mode == 'color':
-              init = create_perlin_noise([1.5**-i*0.5 for i in range(12)], 1, 1, False)
-              init2 = create_perlin_noise([1.5**-i*0.5 for i in range(8)], 4, 4, False)
+              init = create_perlin_noise([1.5**-i*0.5 for i in range(12)], 1, 1, False, **size)
+              init2 = create_perlin_noise([1.5**-i*0.5 for i in range(8)], 4, 4, False, **size)
           elif args.perlin_mode == 'gray':
-            init = create_perlin_noise([1.5**-i*0.5 for i in range(12)], 1, 1, True)
-            init2 = create_perlin_noise([1.5**-i*0.5 for i in range(8)], 4, 4, True)
+            init = create_perlin_noise([1.5**-i*0.5 for i in range(12)], 1, 1, True, **size)
+            init2 = create_perlin_noise([1.5**-i*0.5 for i in range(8)], 4, 4, True, **size)
           else:
-            init = create_perlin_noise([1.5**-i*0.5 for i in range(12)], 1, 1, False)
-            init2 = create_perlin_noise([1.5**-i*0.5 for i in range(8)], 4, 4, True)
+            init = create_perlin_noise([1.5**-i*0.5 for i in range(12)], 1, 1, False, **size)
+            init2 = create_perlin_noise([1.5**-i*0.5 for i in range(8)], 4, 4, True, **size)
           # init = TF.to_tensor(init).add(TF.to_tensor(init2)).div(2).to(device)
           init = TF.to_tensor(init).add(TF.to_tensor(init2)).div(2).to(device).unsqueeze(0).mul(2).sub(1)
           del init2
 
-      cur_t = None
-
-      def cond_fn(x, t, y=None):
-          with torch.enable_grad():
-              x_is_NaN = False
-              x = x.detach().requires_grad_()
-              n = x.shape[0]
-              if use_secondary_model is True:
-                alpha = torch.tensor(diffusion.sqrt_alphas_cumprod[cur_t], device=device, dtype=torch.float32)
-                sigma = torch.tensor(diffusion.sqrt_one_minus_alphas_cumprod[cur_t], device=device, dtype=torch.float32)
-                cosine_t = alpha_sigma_to_t(alpha, sigma)
-                out = secondary_model(x, cosine_t[None].repeat([n])).pred
-                fac = diffusion.sqrt_one_minus_alphas_cumprod[cur_t]
-                x_in = out * fac + x * (1 - fac)
-                x_in_grad = torch.zeros_like(x_in)
-              else:
-                my_t = torch.ones([n], device=device, dtype=torch.long) * cur_t
-                out = diffusion.p_mean_variance(model, x, my_t, clip_denoised=False, model_kwargs={'y': y})
-                fac = diffusion.sqrt_one_minus_alphas_cumprod[cur_t]
-                x_in = out['pred_xstart'] * fac + x * (1 - fac)
-                x_in_grad = torch.zeros_like(x_in)
-              for model_stat in model_stats:
-                for i in range(args.cutn_batches):
-                    t_int = int(t.item())+1 #errors on last step without +1, need to find source
-                    #when using SLIP Base model the dimensions need to be hard coded to avoid AttributeError: 'VisionTransformer' object has no attribute 'input_resolution'
-                    try:
-                        input_resolution=model_stat["clip_model"].visual.input_resolution
-                    except:
-                        input_resolution=224
-
-                    cuts = MakeCutoutsDango(input_resolution,
-                            Overview= args.cut_overview[1000-t_int],
-                            InnerCrop = args.cut_innercut[1000-t_int], IC_Size_Pow=args.cut_ic_pow, IC_Grey_P = args.cut_icgray_p[1000-t_int]
-                            )
-                    clip_in = normalize(cuts(x_in.add(1).div(2)))
-                    image_embeds = model_stat["clip_model"].encode_image(clip_in).float()
-                    dists = spherical_dist_loss(image_embeds.unsqueeze(1), model_stat["target_embeds"].unsqueeze(0))
-                    dists = dists.view([args.cut_overview[1000-t_int]+args.cut_innercut[1000-t_int], n, -1])
-                    losses = dists.mul(model_stat["weights"]).sum(2).mean(0)
-                    loss_values.append(losses.sum().item()) # log loss, probably shouldn't do per cutn_batch
-                    x_in_grad += torch.autograd.grad(losses.sum() * clip_guidance_scale, x_in)[0] / cutn_batches
-              tv_losses = tv_loss(x_in)
-              if use_secondary_model is True:
-                range_losses = range_loss(out)
-              else:
-                range_losses = range_loss(out['pred_xstart'])
-              sat_losses = torch.abs(x_in - x_in.clamp(min=-1,max=1)).mean()
-              loss = tv_losses.sum() * tv_scale + range_losses.sum() * range_scale + sat_losses.sum() * sat_scale
-              if init is not None and args.init_scale:
-                  init_losses = lpips_model(x_in, init)
-                  loss = loss + init_losses.sum() * args.init_scale
-              x_in_grad += torch.autograd.grad(loss, x_in)[0]
-              if torch.isnan(x_in_grad).any()==False:
-                  grad = -torch.autograd.grad(x_in, x, x_in_grad)[0]
-              else:
-                # print("NaN'd")
-                x_is_NaN = True
-                grad = torch.zeros_like(x)
-          if args.clamp_grad and x_is_NaN == False:
-              magnitude = grad.square().mean().sqrt()
-              return grad * magnitude.clamp(max=args.clamp_max) / magnitude  #min=-0.02, min=-clamp_max,
-          return grad
-
-      if model_config['timestep_respacing'].startswith('ddim'):
+      if init is not None:
+          init = init.expand(args.batch_size, -1, -1, -1)
+
+      cond_fn = ClipGuidance(args, diffusion, model, secondary_model, engine.lpips_model, model_stats, device)
+      cond_fn.init_features = engine.get_init_features(init, args)
+
+      if args.diffusion_sampling_mode == 'plms':
+          sample_fn = diffusion.plms_sample_loop_progressive
+      elif args.timestep_respacing.startswith('ddim'):
           sample_fn = diffusion.ddim_sample_loop_progressive
       else:
           sample_fn = diffusion.p_sample_loop_progressive
 
 
-      image_display = Output()
+      image_display = engine.image_display
       for i in range(args.n_batches):
           if args.animation_mode == 'None':
             display.clear_output(wait=True)
@@ -655,55 +716,84 @@ def do_run():
           torch.cuda.empty_cache()
           cur_t = diffusion.num_timesteps - skip_steps - 1
           total_steps = cur_t
-
-          if perlin_init:
-              init = regen_perlin()
-
-          if model_config['timestep_respacing'].startswith('ddim'):
+          cond_fn.cur_t = cur_t
+
+          if args.perlin_init:
+              init = regen_perlin(args, device)
+              cond_fn.init_features = engine.get_init_features(init, args)
+
+          # a batch of images starts from the noise of seed, seed + 1, ... (one
+          # seed per image); a single image keeps the noise it always had
+          noise = None
+          if args.batch_size > 1:
+              noise = torch.cat([torch.randn([1, 3, args.side_y, args.side_x], device=device,
+                                             generator=torch.Generator(device).manual_seed(seed + k))
+                                 for k in range(args.batch_size)])
+
+          if args.diffusion_sampling_mode == 'plms':
+              # pseudo linear multistep: reuses the noise predictions of the
+              # steps before, so it needs far fewer steps than ddim
+              samples = sample_fn(
+                  model,
+                  (args.batch_size, 3, args.side_y, args.side_x),
+                  clip_denoised=args.clip_denoised,
+                  model_kwargs={},
+                  cond_fn=cond_fn,
+                  progress=True,
+                  skip_timesteps=skip_steps,
+                  init_image=init,
+                  noise=noise,
+                  randomize_class=args.randomize_class,
+                  order=2,
+              )
+          elif args.timestep_respacing.startswith('ddim'):
               samples = sample_fn(
                   model,
-                  (batch_size, 3, args.side_y, args.side_x),
-                  clip_denoised=clip_denoised,
+                  (args.batch_size, 3, args.side_y, args.side_x),
+                  clip_denoised=args.clip_denoised,
                   model_kwargs={},
                   cond_fn=cond_fn,
                   progress=True,
                   skip_timesteps=skip_steps,
                   init_image=init,
-                  randomize_class=randomize_class,
-                  eta=eta,
+                  noise=noise,
+                  randomize_class=args.randomize_class,
+                  eta=args.eta,
               )
           else:
               samples = sample_fn(
                   model,
-                  (batch_size, 3, args.side_y, args.side_x),
-                  clip_denoised=clip_denoised,
+                  (args.batch_size, 3, args.side_y, args.side_x),
+                  clip_denoised=args.clip_denoised,
                   model_kwargs={},
                   cond_fn=cond_fn,
                   progress=True,
                   skip_timesteps=skip_steps,
                   init_image=init,
-                  randomize_class=randomize_class,
+                  noise=noise,
+                  randomize_class=args.randomize_class,
               )
 
 
           # with run_display:
           # display.clear_output(wait=True)
-          imgToSharpen = None
+          imgsToSharpen = []
           for j, sample in enumerate(samples):
             cur_t -= 1
+            cond_fn.cur_t = cur_t
             intermediateStep = False
             if args.steps_per_checkpoint is not None:
-                if j % steps_per_checkpoint == 0 and j > 0:
+                if j % args.steps_per_checkpoint == 0 and j > 0:
                   intermediateStep = True
             elif j in args.intermediate_saves:
               intermediateStep = True
             with image_display:
 
-              # base the final filename on the input args
-              final_image_path = output_path + '/' + output_filename
-
               if j % args.display_rate == 0 or cur_t == -1 or intermediateStep == True:
                   for k, image in enumerate(sample['pred_xstart']):
+                      # base the final filename on the input args
+                      output_filename = args.output_filenames[k]
+                      final_image_path = args.output_path + '/' + output_filename
                       # tqdm.write(f'Batch {i}, step {j}, output {k}:')
                       current_time = datetime.now().strftime('%y%m%d-%H%M%S_%f')
                       percent = math.ceil(j/total_steps*100)
@@ -711,7 +801,7 @@ def do_run():
                         #if intermediates are saved to the subfolder, don't append a step or percentage to the name
                         p_filename = output_filename.replace('.png','')
                         if cur_t == -1 and args.intermediates_in_subfolder is True:
-                          save_num = f'{frame_num:04}' if animation_mode != "None" else i
+                          save_num = f'{frame_num:04}' if args.animation_mode != "None" else i
                           #filename = f'{args.batch_name}({args.batchNum})_{save_num}.png'
                           filename = f'{p_filename}_{save_num}.png'
                         else:
@@ -733,109 +823,119 @@ def do_run():
                           if args.intermediates_in_subfolder is True:
                             #image.save(f'{partialFolder}/{filename}')
                             im = image.convert('RGB')
-                            im.save((partialFolder+'/'+filename).replace('.png','.jpg'), quality=80)
+                            im.save((args.partialFolder+'/'+filename).replace('.png','.jpg'), quality=80)
                           else:
-                            image.save(f'{batchFolder}/{filename}')
+                            image.save(f'{args.batchFolder}/{filename}')
                       else:
                         if j in args.intermediate_saves:
                           if args.intermediates_in_subfolder is True:
                             #image.save(f'{partialFolder}/{filename}')
                             im = image.convert('RGB')
-                            im.save((partialFolder+'/'+filename).replace('.png','.jpg'), quality=80)
+                            im.save((args.partialFolder+'/'+filename).replace('.png','.jpg'), quality=80)
                           else:
-                            image.save(f'{batchFolder}/{filename}')
+                            image.save(f'{args.batchFolder}/{filename}')
                       if cur_t == -1:
                         #if frame_num == 0:
                           #save_settings(final_image_path)
                         if args.animation_mode != "None":
                           image.save('prevFrame.png')
-                        if args.sharpen_preset != "Off" and animation_mode == "None":
-                          imgToSharpen = image
+                        if args.sharpen_preset != "Off" and args.animation_mode == "None":
+                          imgsToSharpen.append((image, final_image_path, filename))
                           if args.keep_unsharp is True:
-                            image.save(f'{unsharpenFolder}/{filename}')
+                            image.save(f'{args.unsharpenFolder}/{filename}')
                         else:
                           #image.save(f'{batchFolder}/{filename}')
                           if final_image_path != '':
-                              image.save(final_image_path)
+                              save_output(args, image, final_image_path)
                           else:
-                              image.save(f'{batchFolder}/{filename}')
+                              image.save(f'{args.batchFolder}/{filename}')
 
                         # if frame_num != args.max_frames-1:
                         #   display.clear_output()
 
+          # the CLIP losses are only read back once the batch has been
+          # sampled, so the steps themselves never wait on them
+          losses = cond_fn.loss_history()
+          cond_fn.loss_values = []
+          if losses:
+            print(f'CLIP loss: {losses[0]:.4f} at the first guided step, {losses[-1]:.4f} at the last ({len(losses)} logged)')
+
           with image_display:
-            if args.sharpen_preset != "Off" and animation_mode == "None":
+            if args.sharpen_preset != "Off" and args.animation_mode == "None":
               print('Starting Diffusion Sharpening...')
               #do_superres(imgToSharpen, f'{batchFolder}/{filename}')
-              if final_image_path != '':
-                  do_superres(imgToSharpen, final_image_path)
-              else:
-                  do_superres(imgToSharpen, f'{batchFolder}/{filename}')
+              for imgToSharpen, final_image_path, filename in imgsToSharpen:
+                if final_image_path != '':
+                    do_superres(engine.get_sr_model(), args, imgToSharpen, final_image_path)
+                else:
+                    do_superres(engine.get_sr_model(), args, imgToSharpen, f'{args.batchFolder}/{filename}')
 
               display.clear_output()
 
-          plt.plot(np.array(loss_values), 'r')
+          # (the loss curve used to be plotted here with plt.plot(), which
+          # grows the current matplotlib figure on every image in a resident
+          # worker and is never displayed outside of a notebook)
 
-def save_settings(final_name):
+def save_settings(args, final_name):
   setting_list = {
-    'text_prompts': text_prompts,
-    'image_prompts': image_prompts,
-    'clip_guidance_scale': clip_guidance_scale,
-    'tv_scale': tv_scale,
-    'range_scale': range_scale,
-    'sat_scale': sat_scale,
+    'text_prompts': args.text_prompts,
+    'image_prompts': args.image_prompts,
+    'clip_guidance_scale': args.clip_guidance_scale,
+    'tv_scale': args.tv_scale,
+    'range_scale': args.range_scale,
+    'sat_scale': args.sat_scale,
     # 'cutn': cutn,
-    'cutn_batches': cutn_batches,
-    'max_frames': max_frames,
-    'interp_spline': interp_spline,
+    'cutn_batches': args.cutn_batches,
+    'max_frames': args.max_frames,
+    'interp_spline': args.interp_spline,
     # 'rotation_per_frame': rotation_per_frame,
-    'init_image': init_image,
-    'init_scale': init_scale,
-    'skip_steps': skip_steps,
+    'init_image': args.init_image,
+    'init_scale': args.init_scale,
+    'skip_steps': args.skip_steps,
     # 'zoom_per_frame': zoom_per_frame,
-    'frames_scale': frames_scale,
-    'frames_skip_steps': frames_skip_steps,
-    'perlin_init': perlin_init,
-    'perlin_mode': perlin_mode,
-    'skip_augs': skip_augs,
-    'randomize_class': randomize_class,
-    'clip_denoised': clip_denoised,
-    'clamp_grad': clamp_grad,
-    'clamp_max': clamp_max,
-    'seed': seed,
-    'fuzzy_prompt': fuzzy_prompt,
-    'rand_mag': rand_mag,
-    'eta': eta,
-    'width': width_height[0],
-    'height': width_height[1],
-    'diffusion_model': diffusion_model,
-    'use_secondary_model': use_secondary_model,
-    'steps': steps,
-    'diffusion_steps': diffusion_steps,
-    'ViTB32': ViTB32,
-    'ViTB16': ViTB16,
-    'ViTL14': ViTL14,
-    'RN101': RN101,
-    'RN50': RN50,
-    'RN50x4': RN50x4,
-    'RN50x16': RN50x16,
-    'RN50x64': RN50x64,
-    'cut_overview': str(cut_overview),
-    'cut_innercut': str(cut_innercut),
-    'cut_ic_pow': cut_ic_pow,
-    'cut_icgray_p': str(cut_icgray_p),
-    'key_frames': key_frames,
-    'max_frames': max_frames,
-    'angle': angle,
-    'zoom': zoom,
-    'translation_x': translation_x,
-    'translation_y': translation_y,
-    'video_init_path':video_init_path,
-    'extract_nth_frame':extract_nth_frame,
+    'frames_scale': args.frames_scale,
+    'frames_skip_steps': args.frames_skip_steps,
+    'perlin_init': args.perlin_init,
+    'perlin_mode': args.perlin_mode,
+    'skip_augs': args.skip_augs,
+    'randomize_class': args.randomize_class,
+    'clip_denoised': args.clip_denoised,
+    'clamp_grad': args.clamp_grad,
+    'clamp_max': args.clamp_max,
+    'seed': args.seed,
+    'fuzzy_prompt': args.fuzzy_prompt,
+    'rand_mag': args.rand_mag,
+    'eta': args.eta,
+    'width': args.width_height[0],
+    'height': args.width_height[1],
+    'diffusion_model': args.diffusion_model,
+    'use_secondary_model': args.use_secondary_model,
+    'steps': args.steps,
+    'diffusion_steps': args.diffusion_steps,
+    'ViTB32': args.ViTB32,
+    'ViTB16': args.ViTB16,
+    'ViTL14': args.ViTL14,
+    'RN101': args.RN101,
+    'RN50': args.RN50,
+    'RN50x4': args.RN50x4,
+    'RN50x16': args.RN50x16,
+    'RN50x64': args.RN50x64,
+    'cut_overview': str(args.cut_overview),
+    'cut_innercut': str(args.cut_innercut),
+    'cut_ic_pow': args.cut_ic_pow,
+    'cut_icgray_p': str(args.cut_icgray_p),
+    'key_frames': args.key_frames,
+    'max_frames': args.max_frames,
+    'angle': args.angle,
+    'zoom': args.zoom,
+    'translation_x': args.translation_x,
+    'translation_y': args.translation_y,
+    'video_init_path':args.video_init_path,
+    'extract_nth_frame':args.extract_nth_frame,
   }
   # print('Settings:', setting_list)
   if final_name=='':
-    with open(f"{batchFolder}/{batch_name}({batchNum})_settings.txt", "w+") as f:   #save settings
+    with open(f"{args.batchFolder}/{args.batch_name}({args.batchNum})_settings.txt", "w+") as f:   #save settings
       json.dump(setting_list, f, ensure_ascii=False, indent=4)
   else:
     with open(final_name.replace('png','txt'), "w+") as f:   #save settings
@@ -1435,14 +1535,17 @@ def make_convolutional_sample(batch, model, mode="vanilla", custom_steps=None, e
     return log
 
 sr_diffMode = 'superresolution'
-sr_model = get_model('superresolution')
-
-
-
-
 
+# Saves a finished image. Jobs from make_art.py (run with -jc) go straight to
+# their final .jpg with the job's details in its EXIF data, encoded on a
+# background thread; anything else is saved as is.
+def save_output(args, image, path):
+    if args.jpg_comment is not None:
+        image_writer.get_writer().save_jpg(image, image_writer.jpg_path(path), args.jpg_comment, args.jpg_author, time.time() - args.start_time)
+    else:
+        image.save(path)
 
-def do_superres(img, filepath):
+def do_superres(sr_model, args, img, filepath):
 
   if args.sharpen_preset == 'Faster':
       sr_diffusion_steps = "25"
@@ -1521,69 +1624,11 @@ def do_superres(img, filepath):
     a = a.resize((width_og, height_og), aliasing)
 
   display.display(a)
-  a.save(filepath)
+  save_output(args, a, filepath)
   return
   print(f'Processing finished!')
 
 
-
-
-
-  #@markdown ####**Models Settings:**
-diffusion_model = "512x512_diffusion_uncond_finetune_008100" #@param ["256x256_diffusion_uncond", "512x512_diffusion_uncond_finetune_008100"]
-use_secondary_model = True #@param {type: 'boolean'}
-
-timestep_respacing = '50' # param ['25','50','100','150','250','500','1000','ddim25','ddim50', 'ddim75', 'ddim100','ddim150','ddim250','ddim500','ddim1000']
-diffusion_steps = 1000 # param {type: 'number'}
-use_checkpoint = True #@param {type: 'boolean'}
-ViTB32 = True #@param{type:"boolean"}
-if iargs.VitB32 and iargs.VitB32.lower()[:1] == 'y':
-    ViTB32 = True
-else:
-    ViTB32 = False
-
-ViTB16 = True #@param{type:"boolean"}
-if iargs.VitB16 and iargs.VitB16.lower()[:1] == 'y':
-    ViTB16 = True
-else:
-    ViTB16 = False
-
-ViTL14 = False #@param{type:"boolean"}
-if iargs.VitL14 and iargs.VitL14.lower()[:1] == 'y':
-    ViTL14 = True
-else:
-    ViTL14 = False
-
-RN101 = False #@param{type:"boolean"}
-if iargs.RN101 and iargs.RN101.lower()[:1] == 'y':
-    RN101 = True
-else:
-    RN101 = False
-
-RN50 = True #@param{type:"boolean"}
-if iargs.RN50 and iargs.RN50.lower()[:1] == 'y':
-    RN50 = True
-else:
-    RN50 = False
-
-RN50x4 = False #@param{type:"boolean"}
-if iargs.RN50x4 and iargs.RN50x4.lower()[:1] == 'y':
-    RN50x4 = True
-else:
-    RN50x4 = False
-
-RN50x16 = False #@param{type:"boolean"}
-if iargs.RN50x16 and iargs.RN50x16.lower()[:1] == 'y':
-    RN50x16 = True
-else:
-    RN50x16 = False
-
-RN50x64 = False #@param{type:"boolean"}
-if iargs.RN50x64 and iargs.RN50x64.lower()[:1] == 'y':
-    RN50x64 = True
-else:
-    RN50x64 = False
-
 # not implemented
 SLIPB16 = False # param{type:"boolean"}
 SLIPL16 = False # param{type:"boolean"}
@@ -1604,196 +1649,6 @@ model_512_path = f'{model_path}/512x512_diffusion_uncond_finetune_008100.pt'
 model_secondary_path = f'{model_path}/secondary_model_imagenet_2.pth'
 
 
-
-model_config = model_and_diffusion_defaults()
-if diffusion_model == '512x512_diffusion_uncond_finetune_008100':
-    model_config.update({
-        'attention_resolutions': '32, 16, 8',
-        'class_cond': False,
-        'diffusion_steps': diffusion_steps,
-        'rescale_timesteps': True,
-        'timestep_respacing': timestep_respacing,
-        'image_size': 512,
-        'learn_sigma': True,
-        'noise_schedule': 'linear',
-        'num_channels': 256,
-        'num_head_channels': 64,
-        'num_res_blocks': 2,
-        'resblock_updown': True,
-        'use_checkpoint': use_checkpoint,
-        'use_fp16': True,
-        'use_scale_shift_norm': True,
-    })
-elif diffusion_model == '256x256_diffusion_uncond':
-    model_config.update({
-        'attention_resolutions': '32, 16, 8',
-        'class_cond': False,
-        'diffusion_steps': diffusion_steps,
-        'rescale_timesteps': True,
-        'timestep_respacing': timestep_respacing,
-        'image_size': 256,
-        'learn_sigma': True,
-        'noise_schedule': 'linear',
-        'num_channels': 256,
-        'num_head_channels': 64,
-        'num_res_blocks': 2,
-        'resblock_updown': True,
-        'use_checkpoint': use_checkpoint,
-        'use_fp16': True,
-        'use_scale_shift_norm': True,
-    })
-
-secondary_model_ver = 2
-model_default = model_config['image_size']
-
-if secondary_model_ver == 2:
-    secondary_model = SecondaryDiffusionImageNet2()
-    secondary_model.load_state_dict(torch.load(f'{model_path}/secondary_model_imagenet_2.pth', map_location='cpu'))
-secondary_model.eval().requires_grad_(False).to(device)
-
-clip_models = []
-if ViTB32 is True: clip_models.append(clip.load('ViT-B/32', jit=False)[0].eval().requires_grad_(False).to(device))
-if ViTB16 is True: clip_models.append(clip.load('ViT-B/16', jit=False)[0].eval().requires_grad_(False).to(device) )
-if ViTL14 is True: clip_models.append(clip.load('ViT-L/14', jit=False)[0].eval().requires_grad_(False).to(device) )
-if RN50 is True: clip_models.append(clip.load('RN50', jit=False)[0].eval().requires_grad_(False).to(device))
-if RN50x4 is True: clip_models.append(clip.load('RN50x4', jit=False)[0].eval().requires_grad_(False).to(device))
-if RN50x16 is True: clip_models.append(clip.load('RN50x16', jit=False)[0].eval().requires_grad_(False).to(device))
-if RN50x64 is True: clip_models.append(clip.load('RN50x64', jit=False)[0].eval().requires_grad_(False).to(device))
-if RN101 is True: clip_models.append(clip.load('RN101', jit=False)[0].eval().requires_grad_(False).to(device))
-
-if SLIPB16:
-  SLIPB16model = SLIP_VITB16(ssl_mlp_dim=4096, ssl_emb_dim=256)
-  if not os.path.exists(f'{model_path}/slip_base_100ep.pt'):
-    print('slip_base_100ep.pt missing!')
-  sd = torch.load(f'{model_path}/slip_base_100ep.pt')
-  real_sd = {}
-  for k, v in sd['state_dict'].items():
-    real_sd['.'.join(k.split('.')[1:])] = v
-  del sd
-  SLIPB16model.load_state_dict(real_sd)
-  SLIPB16model.requires_grad_(False).eval().to(device)
-
-  clip_models.append(SLIPB16model)
-
-if SLIPL16:
-  SLIPL16model = SLIP_VITL16(ssl_mlp_dim=4096, ssl_emb_dim=256)
-  if not os.path.exists(f'{model_path}/slip_large_100ep.pt'):
-    print('slip_large_100ep.pt missing!')
-  sd = torch.load(f'{model_path}/slip_large_100ep.pt')
-  real_sd = {}
-  for k, v in sd['state_dict'].items():
-    real_sd['.'.join(k.split('.')[1:])] = v
-  del sd
-  SLIPL16model.load_state_dict(real_sd)
-  SLIPL16model.requires_grad_(False).eval().to(device)
-
-  clip_models.append(SLIPL16model)
-
-normalize = T.Normalize(mean=[0.48145466, 0.4578275, 0.40821073], std=[0.26862954, 0.26130258, 0.27577711])
-lpips_model = lpips.LPIPS(net='vgg').to(device)
-
-#@markdown ####**Basic Settings:**
-#batch_name = 'TimeToDisco' #@param{type: 'string'}
-batch_name = '' #@param{type: 'string'}
-steps = 250 #@param [25,50,100,150,250,500,1000]{type: 'raw', allow-input: true}
-if iargs.max_iterations:
-    steps = iargs.max_iterations
-width_height = [1280, 768]#@param{type: 'raw'}
-if iargs.size:
-    width_height = iargs.size
-clip_guidance_scale = 5000 #@param{type: 'number'}
-tv_scale =  0#@param{type: 'number'}
-range_scale =   150#@param{type: 'number'}
-sat_scale =   0#@param{type: 'number'}
-cutn_batches = 4  #@param{type: 'number'}
-if iargs.cutn:
-    cutn_batches = iargs.cutn
-skip_augs = False#@param{type: 'boolean'}
-
-#@markdown ---
-
-#@markdown ####**Init Settings:**
-init_image = None #@param{type: 'string'}
-init_scale = 1000 #@param{type: 'integer'}
-skip_steps = 0 #@param{type: 'integer'}
-if iargs.init_image:
-    init_image = iargs.init_image
-    if iargs.skip_steps > -1 and iargs.skip_steps < steps:
-        skip_steps = iargs.skip_steps
-        print("Using init image: " + init_image + "; skipping first " + str(skip_steps) + " steps")
-    else:
-        skips = round(steps * 0.50)
-        skip_steps = skips
-        steps += skips
-        print("Using init image: " + init_image + ", increasing steps to " + str(steps) + " and skipping first " + str(skips))
-
-#Get corrected sizes
-side_x = (width_height[0]//64)*64;
-side_y = (width_height[1]//64)*64;
-if side_x != width_height[0] or side_y != width_height[1]:
-  print(f'Changing output size to {side_x}x{side_y}. Dimensions must by multiples of 64.')
-
-#Update Model Settings
-timestep_respacing = f'ddim{steps}'
-diffusion_steps = (1000//steps)*steps if steps < 1000 else steps
-model_config.update({
-    'timestep_respacing': timestep_respacing,
-    'diffusion_steps': diffusion_steps,
-})
-
-#Make folder for batch
-batchFolder = f'{outDirPath}'
-createPath(batchFolder)
-
-#@markdown ####**Animation Mode:**
-animation_mode = "None" #@param['None', '2D', 'Video Input']
-#@markdown *For animation, you probably want to turn `cutn_batches` to 1 to make it quicker.*
-
-
-#@markdown ---
-
-#@markdown ####**Video Input Settings:**
-video_init_path = "/content/training.mp4" #@param {type: 'string'}
-extract_nth_frame = 2 #@param {type:"number"}
-
-if animation_mode == "Video Input":
-  videoFramesFolder = f'/content/videoFrames'
-  createPath(videoFramesFolder)
-  print(f"Exporting Video Frames (1 every {extract_nth_frame})...")
-  #try:
-    #TODO !rm {videoFramesFolder}/*.jpg
-  #except:
-    #print('')
-  #vf = f'"select=not(mod(n\,{extract_nth_frame}))"'
-  #TODO !ffmpeg -i {video_init_path} -vf {vf} -vsync vfr -q:v 2 -loglevel error -stats {videoFramesFolder}/%04d.jpg
-
-
-#@markdown ---
-
-#@markdown ####**2D Animation Settings:**
-#@markdown `zoom` is a multiplier of dimensions, 1 is no zoom.
-
-key_frames = True #@param {type:"boolean"}
-max_frames = 10000#@param {type:"number"}
-
-if animation_mode == "Video Input":
-  max_frames = len(glob(f'{videoFramesFolder}/*.jpg'))
-
-interp_spline = 'Linear' #Do not change, currently will not look good. param ['Linear','Quadratic','Cubic']{type:"string"}
-angle = "0:(0)"#@param {type:"string"}
-zoom = "0: (1), 10: (1.05)"#@param {type:"string"}
-translation_x = "0: (0)"#@param {type:"string"}
-translation_y = "0: (0)"#@param {type:"string"}
-
-#@markdown ---
-
-#@markdown ####**Coherency Settings:**
-#@markdown `frame_scale` tries to guide the new frame to looking like the old one. A good default is 1500.
-frames_scale = 1500 #@param{type: 'integer'}
-#@markdown `frame_skip_steps` will blur the previous frame - higher values will flicker less but struggle to add enough new detail to zoom into.
-frames_skip_steps = '60%' #@param ['40%', '50%', '60%', '70%', '80%'] {type: 'string'}
-
-
 def parse_key_frames(string, prompt_parser=None):
     """Given a string representing frame numbers paired with parameter values at that frame,
     return a dictionary with the frame numbers as keys and the parameter values as the values.
@@ -1839,7 +1694,7 @@ def parse_key_frames(string, prompt_parser=None):
         raise RuntimeError('Key Frame string not correctly formatted')
     return frames
 
-def get_inbetweens(key_frames, integer=False):
+def get_inbetweens(key_frames, max_frames, interp_spline='Linear', integer=False):
     """Given a dict with frame numbers as keys and a parameter value as values,
     return a pandas Series containing the value of the parameter at every frame from 0 to max_frames.
     Any values not provided in the input dict are calculated by linear interpolation between
@@ -1863,8 +1718,7 @@ def get_inbetweens(key_frames, integer=False):
 
     Examples
     --------
-    >>> max_frames = 5
-    >>> get_inbetweens({1: 5, 3: 6})
+    >>> get_inbetweens({1: 5, 3: 6}, 5)
     0    5.0
     1    5.0
     2    5.5
@@ -1872,7 +1726,7 @@ def get_inbetweens(key_frames, integer=False):
     4    6.0
     dtype: float64
 
-    >>> get_inbetweens({1: 5, 3: 6}, integer=True)
+    >>> get_inbetweens({1: 5, 3: 6}, 5, integer=True)
     0    5
     1    5
     2    5
@@ -1903,7 +1757,7 @@ def get_inbetweens(key_frames, integer=False):
         return key_frame_series.astype(int)
     return key_frame_series
 
-def split_prompts(prompts):
+def split_prompts(prompts, max_frames):
   prompt_series = pd.Series([np.nan for a in range(max_frames)])
   for i, prompt in prompts.items():
     prompt_series[i] = prompt
@@ -1911,395 +1765,813 @@ def split_prompts(prompts):
   prompt_series = prompt_series.ffill().bfill()
   return prompt_series
 
-if key_frames:
-    try:
-        angle_series = get_inbetweens(parse_key_frames(angle))
-    except RuntimeError as e:
-        print(
-            "WARNING: You have selected to use key frames, but you have not "
-            "formatted `angle` correctly for key frames.\n"
-            "Attempting to interpret `angle` as "
-            f'"0: ({angle})"\n'
-            "Please read the instructions to find out how to use key frames "
-            "correctly.\n"
-        )
-        angle = f"0: ({angle})"
-        angle_series = get_inbetweens(parse_key_frames(angle))
 
-    try:
-        zoom_series = get_inbetweens(parse_key_frames(zoom))
-    except RuntimeError as e:
-        print(
-            "WARNING: You have selected to use key frames, but you have not "
-            "formatted `zoom` correctly for key frames.\n"
-            "Attempting to interpret `zoom` as "
-            f'"0: ({zoom})"\n'
-            "Please read the instructions to find out how to use key frames "
-            "correctly.\n"
-        )
-        zoom = f"0: ({zoom})"
-        zoom_series = get_inbetweens(parse_key_frames(zoom))
+# Turns the command line options into the settings for one run. Everything
+# here is per job; the models themselves live in DiffusionEngine.
+def build_args(iargs):
+    #@markdown ####**Models Settings:**
+    diffusion_model = "512x512_diffusion_uncond_finetune_008100" #@param ["256x256_diffusion_uncond", "512x512_diffusion_uncond_finetune_008100"]
+    use_secondary_model = True #@param {type: 'boolean'}
+    use_checkpoint = True #@param {type: 'boolean'}
+    ViTB32 = True #@param{type:"boolean"}
+    if iargs.VitB32 and iargs.VitB32.lower()[:1] == 'y':
+        ViTB32 = True
+    else:
+        ViTB32 = False
 
-    try:
-        translation_x_series = get_inbetweens(parse_key_frames(translation_x))
-    except RuntimeError as e:
-        print(
-            "WARNING: You have selected to use key frames, but you have not "
-            "formatted `translation_x` correctly for key frames.\n"
-            "Attempting to interpret `translation_x` as "
-            f'"0: ({translation_x})"\n'
-            "Please read the instructions to find out how to use key frames "
-            "correctly.\n"
-        )
-        translation_x = f"0: ({translation_x})"
-        translation_x_series = get_inbetweens(parse_key_frames(translation_x))
+    ViTB16 = True #@param{type:"boolean"}
+    if iargs.VitB16 and iargs.VitB16.lower()[:1] == 'y':
+        ViTB16 = True
+    else:
+        ViTB16 = False
 
-    try:
-        translation_y_series = get_inbetweens(parse_key_frames(translation_y))
-    except RuntimeError as e:
-        print(
-            "WARNING: You have selected to use key frames, but you have not "
-            "formatted `translation_y` correctly for key frames.\n"
-            "Attempting to interpret `translation_y` as "
-            f'"0: ({translation_y})"\n'
-            "Please read the instructions to find out how to use key frames "
-            "correctly.\n"
-        )
-        translation_y = f"0: ({translation_y})"
-        translation_y_series = get_inbetweens(parse_key_frames(translation_y))
+    ViTL14 = False #@param{type:"boolean"}
+    if iargs.VitL14 and iargs.VitL14.lower()[:1] == 'y':
+        ViTL14 = True
+    else:
+        ViTL14 = False
 
-else:
-    angle = float(angle)
-    zoom = float(zoom)
-    translation_x = float(translation_x)
-    translation_y = float(translation_y)
+    RN101 = False #@param{type:"boolean"}
+    if iargs.RN101 and iargs.RN101.lower()[:1] == 'y':
+        RN101 = True
+    else:
+        RN101 = False
 
-#@markdown ####**Saving:**
+    RN50 = True #@param{type:"boolean"}
+    if iargs.RN50 and iargs.RN50.lower()[:1] == 'y':
+        RN50 = True
+    else:
+        RN50 = False
 
-#intermediate_saves = 0#@param{type: 'raw'}
-if iargs.max_iterations and iargs.max_iterations >= 250:
-    # e.g.: at 250 iterations, save at 150, 200, 220, 240
-    intermediate_saves = [iargs.max_iterations-100, iargs.max_iterations-50, iargs.max_iterations-30, iargs.max_iterations-10]#@param{type: 'raw'}
-else:
-    intermediate_saves = 0
+    RN50x4 = False #@param{type:"boolean"}
+    if iargs.RN50x4 and iargs.RN50x4.lower()[:1] == 'y':
+        RN50x4 = True
+    else:
+        RN50x4 = False
 
-intermediates_in_subfolder = True #@param{type: 'boolean'}
-#@markdown Intermediate steps will save a copy at your specified intervals. You can either format it as a single integer or a list of specific steps
+    RN50x16 = False #@param{type:"boolean"}
+    if iargs.RN50x16 and iargs.RN50x16.lower()[:1] == 'y':
+        RN50x16 = True
+    else:
+        RN50x16 = False
 
-#@markdown A value of `2` will save a copy at 33% and 66%. 0 will save none.
+    RN50x64 = False #@param{type:"boolean"}
+    if iargs.RN50x64 and iargs.RN50x64.lower()[:1] == 'y':
+        RN50x64 = True
+    else:
+        RN50x64 = False
+
+    clip_models = [name for name, use in [('ViT-B/32', ViTB32), ('ViT-B/16', ViTB16), ('ViT-L/14', ViTL14), ('RN50', RN50),
+                                         ('RN50x4', RN50x4), ('RN50x16', RN50x16), ('RN50x64', RN50x64), ('RN101', RN101)] if use]
+
+    output_path = "output"
+    output_filename = "output.png"
+
+    # support path conventions on both windows/*nix
+    if '/' in iargs.output:
+        output_filename = iargs.output[iargs.output.rindex('/')+1:]
+        output_path = iargs.output.replace(output_filename,'')[:-1]
+
+    if '\\' in iargs.output:
+        output_filename = iargs.output[iargs.output.rindex('\\')+1:]
+        output_path = iargs.output.replace(output_filename,'')[:-1]
+
+    initDirPath = f'{root_path}/init_images'
+    createPath(initDirPath)
+    #outDirPath = f'{root_path}/images_out'
+    outDirPath = output_path
+    createPath(outDirPath)
+
+    #@markdown ####**Basic Settings:**
+    #batch_name = 'TimeToDisco' #@param{type: 'string'}
+    batch_name = '' #@param{type: 'string'}
+    steps = 250 #@param [25,50,100,150,250,500,1000]{type: 'raw', allow-input: true}
+    if iargs.max_iterations:
+        steps = iargs.max_iterations
+    width_height = [1280, 768]#@param{type: 'raw'}
+    if iargs.size:
+        width_height = iargs.size
+    clip_guidance_scale = 5000 #@param{type: 'number'}
+    tv_scale =  0#@param{type: 'number'}
+    range_scale =   150#@param{type: 'number'}
+    sat_scale =   0#@param{type: 'number'}
+    cutn_batches = 4  #@param{type: 'number'}
+    if iargs.cutn:
+        cutn_batches = iargs.cutn
+    skip_augs = False#@param{type: 'boolean'}
+
+    #@markdown ---
+
+    #@markdown ####**Init Settings:**
+    init_image = None #@param{type: 'string'}
+    init_scale = 1000 #@param{type: 'integer'}
+    skip_steps = 0 #@param{type: 'integer'}
+    if iargs.init_image:
+        init_image = iargs.init_image
+        if iargs.skip_steps > -1 and iargs.skip_steps < steps:
+            skip_steps = iargs.skip_steps
+            print("Using init image: " + init_image + "; skipping first " + str(skip_steps) + " steps")
+        else:
+            skips = round(steps * 0.50)
+            skip_steps = skips
+            steps += skips
+            print("Using init image: " + init_image + ", increasing steps to " + str(steps) + " and skipping first " + str(skips))
+
+    #Get corrected sizes
+    side_x = (width_height[0]//64)*64;
+    side_y = (width_height[1]//64)*64;
+    if side_x != width_height[0] or side_y != width_height[1]:
+      print(f'Changing output size to {side_x}x{side_y}. Dimensions must by multiples of 64.')
+
+    #Update Model Settings
+    # (plms uses the same evenly spaced steps as ddim)
+    diffusion_sampling_mode = iargs.sampler
+    timestep_respacing = f'ddim{steps}'
+    diffusion_steps = (1000//steps)*steps if steps < 1000 else steps
+
+    #Make folder for batch
+    partialFolder = unsharpenFolder = videoFramesFolder = None
+    batchFolder = f'{outDirPath}'
+    createPath(batchFolder)
+
+    #@markdown ####**Animation Mode:**
+    animation_mode = "None" #@param['None', '2D', 'Video Input']
+    #@markdown *For animation, you probably want to turn `cutn_batches` to 1 to make it quicker.*
+
+
+    #@markdown ---
+
+    #@markdown ####**Video Input Settings:**
+    video_init_path = "/content/training.mp4" #@param {type: 'string'}
+    extract_nth_frame = 2 #@param {type:"number"}
+
+    if animation_mode == "Video Input":
+      videoFramesFolder = f'/content/videoFrames'
+      createPath(videoFramesFolder)
+      print(f"Exporting Video Frames (1 every {extract_nth_frame})...")
+      #try:
+        #TODO !rm {videoFramesFolder}/*.jpg
+      #except:
+        #print('')
+      #vf = f'"select=not(mod(n\,{extract_nth_frame}))"'
+      #TODO !ffmpeg -i {video_init_path} -vf {vf} -vsync vfr -q:v 2 -loglevel error -stats {videoFramesFolder}/%04d.jpg
+
+
+    #@markdown ---
+
+    #@markdown ####**2D Animation Settings:**
+    #@markdown `zoom` is a multiplier of dimensions, 1 is no zoom.
+
+    key_frames = True #@param {type:"boolean"}
+    max_frames = 10000#@param {type:"number"}
+
+    if animation_mode == "Video Input":
+      max_frames = len(glob(f'{videoFramesFolder}/*.jpg'))
+
+    interp_spline = 'Linear' #Do not change, currently will not look good. param ['Linear','Quadratic','Cubic']{type:"string"}
+    angle = "0:(0)"#@param {type:"string"}
+    zoom = "0: (1), 10: (1.05)"#@param {type:"string"}
+    translation_x = "0: (0)"#@param {type:"string"}
+    translation_y = "0: (0)"#@param {type:"string"}
+
+    #@markdown ---
+
+    #@markdown ####**Coherency Settings:**
+    #@markdown `frame_scale` tries to guide the new frame to looking like the old one. A good default is 1500.
+    frames_scale = 1500 #@param{type: 'integer'}
+    #@markdown `frame_skip_steps` will blur the previous frame - higher values will flicker less but struggle to add enough new detail to zoom into.
+    frames_skip_steps = '60%' #@param ['40%', '50%', '60%', '70%', '80%'] {type: 'string'}
+
+
+    if key_frames:
+        try:
+            angle_series = get_inbetweens(parse_key_frames(angle), max_frames, interp_spline)
+        except RuntimeError as e:
+            print(
+                "WARNING: You have selected to use key frames, but you have not "
+                "formatted `angle` correctly for key frames.\n"
+                "Attempting to interpret `angle` as "
+                f'"0: ({angle})"\n'
+                "Please read the instructions to find out how to use key frames "
+                "correctly.\n"
+            )
+            angle = f"0: ({angle})"
+            angle_series = get_inbetweens(parse_key_frames(angle), max_frames, interp_spline)
+
+        try:
+            zoom_series = get_inbetweens(parse_key_frames(zoom), max_frames, interp_spline)
+        except RuntimeError as e:
+            print(
+                "WARNING: You have selected to use key frames, but you have not "
+                "formatted `zoom` correctly for key frames.\n"
+                "Attempting to interpret `zoom` as "
+                f'"0: ({zoom})"\n'
+                "Please read the instructions to find out how to use key frames "
+                "correctly.\n"
+            )
+            zoom = f"0: ({zoom})"
+            zoom_series = get_inbetweens(parse_key_frames(zoom), max_frames, interp_spline)
+
+        try:
+            translation_x_series = get_inbetweens(parse_key_frames(translation_x), max_frames, interp_spline)
+        except RuntimeError as e:
+            print(
+                "WARNING: You have selected to use key frames, but you have not "
+                "formatted `translation_x` correctly for key frames.\n"
+                "Attempting to interpret `translation_x` as "
+                f'"0: ({translation_x})"\n'
+                "Please read the instructions to find out how to use key frames "
+                "correctly.\n"
+            )
+            translation_x = f"0: ({translation_x})"
+            translation_x_series = get_inbetweens(parse_key_frames(translation_x), max_frames, interp_spline)
+
+        try:
+            translation_y_series = get_inbetweens(parse_key_frames(translation_y), max_frames, interp_spline)
+        except RuntimeError as e:
+            print(
+                "WARNING: You have selected to use key frames, but you have not "
+                "formatted `translation_y` correctly for key frames.\n"
+                "Attempting to interpret `translation_y` as "
+                f'"0: ({translation_y})"\n'
+                "Please read the instructions to find out how to use key frames "
+                "correctly.\n"
+            )
+            translation_y = f"0: ({translation_y})"
+            translation_y_series = get_inbetweens(parse_key_frames(translation_y), max_frames, interp_spline)
 
-#@markdown A value of `[5, 9, 34, 45]` will save at steps 5, 9, 34, and 45. (Make sure to include the brackets)
+    else:
+        angle_series = zoom_series = translation_x_series = translation_y_series = None
+        angle = float(angle)
+        zoom = float(zoom)
+        translation_x = float(translation_x)
+        translation_y = float(translation_y)
+
+    #@markdown ####**Saving:**
+
+    #intermediate_saves = 0#@param{type: 'raw'}
+    if iargs.max_iterations and iargs.max_iterations >= 250:
+        # e.g.: at 250 iterations, save at 150, 200, 220, 240
+        intermediate_saves = [iargs.max_iterations-100, iargs.max_iterations-50, iargs.max_iterations-30, iargs.max_iterations-10]#@param{type: 'raw'}
+    else:
+        intermediate_saves = 0
 
+    intermediates_in_subfolder = True #@param{type: 'boolean'}
+    #@markdown Intermediate steps will save a copy at your specified intervals. You can either format it as a single integer or a list of specific steps
 
-if type(intermediate_saves) is not list:
-  if intermediate_saves:
-    steps_per_checkpoint = math.floor((steps - skip_steps - 1) // (intermediate_saves+1))
-    steps_per_checkpoint = steps_per_checkpoint if steps_per_checkpoint > 0 else 1
-    print(f'Will save every {steps_per_checkpoint} steps')
-  else:
-    steps_per_checkpoint = steps+10
-else:
-  steps_per_checkpoint = None
+    #@markdown A value of `2` will save a copy at 33% and 66%. 0 will save none.
 
-if intermediate_saves and intermediates_in_subfolder is True:
-  partialFolder = f'{batchFolder}/partials'
-  createPath(partialFolder)
+    #@markdown A value of `[5, 9, 34, 45]` will save at steps 5, 9, 34, and 45. (Make sure to include the brackets)
 
-  #@markdown ---
 
-#@markdown ####**SuperRes Sharpening:**
-#@markdown *Sharpen each image using latent-diffusion. Does not run in animation mode. `keep_unsharp` will save both versions.*
-sharpen_preset = 'Off' #@param ['Off', 'Faster', 'Fast', 'Slow', 'Very Slow']
-keep_unsharp = True #@param{type: 'boolean'}
+    if type(intermediate_saves) is not list:
+      if intermediate_saves:
+        steps_per_checkpoint = math.floor((steps - skip_steps - 1) // (intermediate_saves+1))
+        steps_per_checkpoint = steps_per_checkpoint if steps_per_checkpoint > 0 else 1
+        print(f'Will save every {steps_per_checkpoint} steps')
+      else:
+        steps_per_checkpoint = steps+10
+    else:
+      steps_per_checkpoint = None
 
-if sharpen_preset != 'Off' and keep_unsharp is True:
-  unsharpenFolder = f'{batchFolder}/unsharpened'
-  createPath(unsharpenFolder)
+    if intermediate_saves and intermediates_in_subfolder is True:
+      partialFolder = f'{batchFolder}/partials'
+      createPath(partialFolder)
 
+      #@markdown ---
 
-  #@markdown ---
+    #@markdown ####**SuperRes Sharpening:**
+    #@markdown *Sharpen each image using latent-diffusion. Does not run in animation mode. `keep_unsharp` will save both versions.*
+    sharpen_preset = 'Off' #@param ['Off', 'Faster', 'Fast', 'Slow', 'Very Slow']
+    keep_unsharp = True #@param{type: 'boolean'}
 
-#@markdown ####**Advanced Settings:**
-#@markdown *There are a few extra advanced settings available if you double click this cell.*
+    if sharpen_preset != 'Off' and keep_unsharp is True:
+      unsharpenFolder = f'{batchFolder}/unsharpened'
+      createPath(unsharpenFolder)
 
-#@markdown *Perlin init will replace your init, so uncheck if using one.*
 
-perlin_init = False  #@param{type: 'boolean'}
-perlin_mode = 'mixed' #@param ['mixed', 'color', 'gray']
-set_seed = 'random_seed' #@param{type: 'string'}
-if iargs.seed:
-    set_seed = iargs.seed
-eta = 0.8#@param{type: 'number'}
-clamp_grad = True #@param{type: 'boolean'}
-clamp_max = 0.05 #@param{type: 'number'}
+      #@markdown ---
 
+    #@markdown ####**Advanced Settings:**
+    #@markdown *There are a few extra advanced settings available if you double click this cell.*
 
-### EXTRA ADVANCED SETTINGS:
-randomize_class = True
-clip_denoised = False
-fuzzy_prompt = False
-rand_mag = 0.05
+    #@markdown *Perlin init will replace your init, so uncheck if using one.*
 
+    perlin_init = False  #@param{type: 'boolean'}
+    perlin_mode = 'mixed' #@param ['mixed', 'color', 'gray']
+    set_seed = 'random_seed' #@param{type: 'string'}
+    if iargs.seed:
+        set_seed = iargs.seed
+    eta = 0.8#@param{type: 'number'}
+    clamp_grad = True #@param{type: 'boolean'}
+    clamp_max = 0.05 #@param{type: 'number'}
 
- #@markdown ---
 
-#@markdown ####**Cutn Scheduling:**
-#@markdown Format: `[40]*400+[20]*600` = 40 cuts for the first 400 /1000 steps, then 20 for the last 600/1000
+    ### EXTRA ADVANCED SETTINGS:
+    randomize_class = True
+    clip_denoised = False
+    fuzzy_prompt = False
+    rand_mag = 0.05
 
-#@markdown cut_overview and cut_innercut are cumulative for total cutn on any given step. Overview cuts see the entire image and are good for early structure, innercuts are your standard cutn.
 
-cut_overview = "[12]*400+[4]*600" #@param {type: 'string'}
-cut_innercut ="[4]*400+[12]*600"#@param {type: 'string'}
-cut_ic_pow = 1#@param {type: 'number'}
-cut_icgray_p = "[0.2]*400+[0]*600"#@param {type: 'string'}
+     #@markdown ---
 
-text_prompts = {
-    #0: ["A beautiful painting of a singular lighthouse, shining its light across a tumultuous sea of blood by greg rutkowski and thomas kinkade, Trending on artstation."]
-    0: ["A beautiful painting of a singular lighthouse", "by greg rutkowski", "trending on artstation:-0.99"]
-    # 100: ["This set of prompts start at frame 100", "This prompt has weight five:5"],
-}
+    #@markdown ####**Cutn Scheduling:**
+    #@markdown Format: `[40]*400+[20]*600` = 40 cuts for the first 400 /1000 steps, then 20 for the last 600/1000
 
-if iargs.prompts:
-    #input_prompts = iargs.prompts.split('|')
-    #for x in range(len(input_prompts)):
-    #    input_prompts[x] = input_prompts[x].strip()
+    #@markdown cut_overview and cut_innercut are cumulative for total cutn on any given step. Overview cuts see the entire image and are good for early structure, innercuts are your standard cutn.
+
+    cut_overview = "[12]*400+[4]*600" #@param {type: 'string'}
+    cut_innercut ="[4]*400+[12]*600"#@param {type: 'string'}
+    cut_ic_pow = 1#@param {type: 'number'}
+    cut_icgray_p = "[0.2]*400+[0]*600"#@param {type: 'string'}
 
     text_prompts = {
-        #0: input_prompts,
-        #0: [iargs.prompts],
-        0: iargs.prompts.split('|'),
+        #0: ["A beautiful painting of a singular lighthouse, shining its light across a tumultuous sea of blood by greg rutkowski and thomas kinkade, Trending on artstation."]
+        0: ["A beautiful painting of a singular lighthouse", "by greg rutkowski", "trending on artstation:-0.99"]
         # 100: ["This set of prompts start at frame 100", "This prompt has weight five:5"],
     }
 
-    # not necessary but makes the cli output easier to parse
-    for x in range(len(text_prompts[0])):
-        text_prompts[0][x] = text_prompts[0][x].strip()
+    if iargs.prompts:
+        #input_prompts = iargs.prompts.split('|')
+        #for x in range(len(input_prompts)):
+        #    input_prompts[x] = input_prompts[x].strip()
 
-image_prompts = {
-    # 0:['ImagePromptsWorkButArentVeryGood.png:2',],
-}
+        text_prompts = {
+            #0: input_prompts,
+            #0: [iargs.prompts],
+            0: iargs.prompts.split('|'),
+            # 100: ["This set of prompts start at frame 100", "This prompt has weight five:5"],
+        }
 
-#@title Do the Run!
-#@markdown `n_batches` ignored with animation modes.
-display_rate =  50 #@param{type: 'number'}
-n_batches =  1 #@param{type: 'number'}
+        # not necessary but makes the cli output easier to parse
+        for x in range(len(text_prompts[0])):
+            text_prompts[0][x] = text_prompts[0][x].strip()
 
-batch_size = 1
+    image_prompts = {
+        # 0:['ImagePromptsWorkButArentVeryGood.png:2',],
+    }
 
+    #@title Do the Run!
+    #@markdown `n_batches` ignored with animation modes.
+    display_rate =  50 #@param{type: 'number'}
+    n_batches =  1 #@param{type: 'number'}
 
-#@markdown ---
+    batch_size = iargs.batch_size
 
+    # the batch's images after the first are saved next to it, as -bo says or
+    # with -2, -3, ... added to the output name
+    output_filenames = [output_filename]
+    for k in range(1, batch_size):
+        if iargs.batch_outputs is not None and k - 1 < len(iargs.batch_outputs):
+            output_filenames.append(os.path.basename(iargs.batch_outputs[k - 1]))
+        else:
+            output_filenames.append(os.path.splitext(output_filename)[0] + '-' + str(k + 1) + '.png')
 
-resume_run = False #@param{type: 'boolean'}
-run_to_resume = 'latest' #@param{type: 'string'}
-resume_from_frame = 'latest' #@param{type: 'string'}
-retain_overwritten_frames = False #@param{type: 'boolean'}
-if retain_overwritten_frames is True:
-  retainFolder = f'{batchFolder}/retained'
-  createPath(retainFolder)
 
+    #@markdown ---
 
-skip_step_ratio = int(frames_skip_steps.rstrip("%")) / 100
-calc_frames_skip_steps = math.floor(steps * skip_step_ratio)
 
+    resume_run = False #@param{type: 'boolean'}
+    run_to_resume = 'latest' #@param{type: 'string'}
+    resume_from_frame = 'latest' #@param{type: 'string'}
+    retain_overwritten_frames = False #@param{type: 'boolean'}
+    if retain_overwritten_frames is True:
+      retainFolder = f'{batchFolder}/retained'
+      createPath(retainFolder)
 
-if steps <= calc_frames_skip_steps:
-  sys.exit("ERROR: You can't skip more steps than your total steps")
 
-if resume_run:
-  if run_to_resume == 'latest':
-    try:
-      batchNum
-    except:
-      batchNum = len(glob(f"{batchFolder}/{batch_name}(*)_settings.txt"))-1
-  else:
-    batchNum = int(run_to_resume)
-  if resume_from_frame == 'latest':
-    start_frame = len(glob(batchFolder+f"/{batch_name}({batchNum})_*.png"))
-  else:
-    start_frame = int(resume_from_frame)+1
-    if retain_overwritten_frames is True:
-      existing_frames = len(glob(batchFolder+f"/{batch_name}({batchNum})_*.png"))
-      frames_to_save = existing_frames - start_frame
-      print(f'Moving {frames_to_save} frames to the Retained folder')
-      move_files(start_frame, existing_frames, batchFolder, retainFolder)
-else:
-  start_frame = 0
-  batchNum = len(glob(batchFolder+"/*.txt"))
-  while path.isfile(f"{batchFolder}/{batch_name}({batchNum})_settings.txt") is True or path.isfile(f"{batchFolder}/{batch_name}-{batchNum}_settings.txt") is True:
-    batchNum += 1
-
-print(f'Starting Run: {batch_name}({batchNum}) at frame {start_frame}')
-
-if set_seed == 'random_seed':
-    random.seed()
-    seed = random.randint(0, 2**32)
-    # print(f'Using seed: {seed}')
-else:
-    seed = int(set_seed)
-
-args = {
-    'batchNum': batchNum,
-    'prompts_series':split_prompts(text_prompts) if text_prompts else None,
-    'image_prompts_series':split_prompts(image_prompts) if image_prompts else None,
-    'seed': seed,
-    'display_rate':display_rate,
-    'n_batches':n_batches if animation_mode == 'None' else 1,
-    'batch_size':batch_size,
-    'batch_name': batch_name,
-    'steps': steps,
-    'width_height': width_height,
-    'clip_guidance_scale': clip_guidance_scale,
-    'tv_scale': tv_scale,
-    'range_scale': range_scale,
-    'sat_scale': sat_scale,
-    'cutn_batches': cutn_batches,
-    'init_image': init_image,
-    'init_scale': init_scale,
-    'skip_steps': skip_steps,
-    'sharpen_preset': sharpen_preset,
-    'keep_unsharp': keep_unsharp,
-    'side_x': side_x,
-    'side_y': side_y,
-    'timestep_respacing': timestep_respacing,
-    'diffusion_steps': diffusion_steps,
-    'animation_mode': animation_mode,
-    'video_init_path': video_init_path,
-    'extract_nth_frame': extract_nth_frame,
-    'key_frames': key_frames,
-    'max_frames': max_frames if animation_mode != "None" else 1,
-    'interp_spline': interp_spline,
-    'start_frame': start_frame,
-    'angle': angle,
-    'zoom': zoom,
-    'translation_x': translation_x,
-    'translation_y': translation_y,
-    'angle_series':angle_series,
-    'zoom_series':zoom_series,
-    'translation_x_series':translation_x_series,
-    'translation_y_series':translation_y_series,
-    'frames_scale': frames_scale,
-    'calc_frames_skip_steps': calc_frames_skip_steps,
-    'skip_step_ratio': skip_step_ratio,
-    'calc_frames_skip_steps': calc_frames_skip_steps,
-    'text_prompts': text_prompts,
-    'image_prompts': image_prompts,
-    'cut_overview': eval(cut_overview),
-    'cut_innercut': eval(cut_innercut),
-    'cut_ic_pow': cut_ic_pow,
-    'cut_icgray_p': eval(cut_icgray_p),
-    'intermediate_saves': intermediate_saves,
-    'intermediates_in_subfolder': intermediates_in_subfolder,
-    'steps_per_checkpoint': steps_per_checkpoint,
-    'perlin_init': perlin_init,
-    'perlin_mode': perlin_mode,
-    'set_seed': set_seed,
-    'eta': eta,
-    'clamp_grad': clamp_grad,
-    'clamp_max': clamp_max,
-    'skip_augs': skip_augs,
-    'randomize_class': randomize_class,
-    'clip_denoised': clip_denoised,
-    'fuzzy_prompt': fuzzy_prompt,
-    'rand_mag': rand_mag,
-}
-
-args = SimpleNamespace(**args)
-
-print('Prepping model...')
-model, diffusion = create_model_and_diffusion(**model_config)
-model.load_state_dict(torch.load(f'{model_path}/{diffusion_model}.pt', map_location='cpu'))
-model.requires_grad_(False).eval().to(device)
-for name, param in model.named_parameters():
-    if 'qkv' in name or 'norm' in name or 'proj' in name:
-        param.requires_grad_()
-if model_config['use_fp16']:
-    model.convert_to_fp16()
-
-gc.collect()
-torch.cuda.empty_cache()
-try:
-  do_run()
-except KeyboardInterrupt:
-    pass
-finally:
-    #print('Seed used:', seed)
-    gc.collect()
-    torch.cuda.empty_cache()
-
-
-
-# @title ### **Create video**
-#@markdown Video file will save in the same folder as your images.
-
-skip_video_for_run_all = True #@param {type: 'boolean'}
-
-if skip_video_for_run_all == False:
-  # import subprocess in case this cell is run without the above cells
-  import subprocess
-  from base64 import b64encode
-
-  latest_run = batchNum
-
-  folder = batch_name #@param
-  run = latest_run #@param
-  final_frame = 'final_frame'
-
-
-  init_frame = 1#@param {type:"number"} This is the frame where the video will start
-  last_frame = final_frame#@param {type:"number"} You can change i to the number of the last frame you want to generate. It will raise an error if that number of frames does not exist.
-  fps = 12#@param {type:"number"}
-  view_video_in_cell = False #@param {type: 'boolean'}
-
-  frames = []
-  # tqdm.write('Generating video...')
-
-  if last_frame == 'final_frame':
-    last_frame = len(glob(batchFolder+f"/{folder}({run})_*.png"))
-    print(f'Total frames: {last_frame}')
-
-  image_path = f"{outDirPath}/{folder}/{folder}({run})_%04d.png"
-  filepath = f"{outDirPath}/{folder}/{folder}({run}).mp4"
-
-  cmd = [
-      'ffmpeg',
-      '-y',
-      '-vcodec',
-      'png',
-      '-r',
-      str(fps),
-      '-start_number',
-      str(init_frame),
-      '-i',
-      image_path,
-      '-frames:v',
-      str(last_frame+1),
-      '-c:v',
-      'libx264',
-      '-vf',
-      f'fps={fps}',
-      '-pix_fmt',
-      'yuv420p',
-      '-crf',
-      '17',
-      '-preset',
-      'veryslow',
-      filepath
-  ]
-
-  process = subprocess.Popen(cmd, cwd=f'{batchFolder}', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  stdout, stderr = process.communicate()
-  if process.returncode != 0:
-      print(stderr)
-      raise RuntimeError(stderr)
-  else:
-      print("The video is ready")
-
-  if view_video_in_cell:
-      mp4 = open(filepath,'rb').read()
-      data_url = "data:video/mp4;base64," + b64encode(mp4).decode()
-      display.HTML("""
-      <video width=400 controls>
-            <source src="%s" type="video/mp4">
-      </video>
-      """ % data_url)
+    skip_step_ratio = int(frames_skip_steps.rstrip("%")) / 100
+    calc_frames_skip_steps = math.floor(steps * skip_step_ratio)
+
+
+    if steps <= calc_frames_skip_steps:
+      sys.exit("ERROR: You can't skip more steps than your total steps")
+
+    if resume_run:
+      if run_to_resume == 'latest':
+        try:
+          batchNum
+        except:
+          batchNum = len(glob(f"{batchFolder}/{batch_name}(*)_settings.txt"))-1
+      else:
+        batchNum = int(run_to_resume)
+      if resume_from_frame == 'latest':
+        start_frame = len(glob(batchFolder+f"/{batch_name}({batchNum})_*.png"))
+      else:
+        start_frame = int(resume_from_frame)+1
+        if retain_overwritten_frames is True:
+          existing_frames = len(glob(batchFolder+f"/{batch_name}({batchNum})_*.png"))
+          frames_to_save = existing_frames - start_frame
+          print(f'Moving {frames_to_save} frames to the Retained folder')
+          move_files(start_frame, existing_frames, batchFolder, retainFolder)
+    else:
+      start_frame = 0
+      batchNum = len(glob(batchFolder+"/*.txt"))
+      while path.isfile(f"{batchFolder}/{batch_name}({batchNum})_settings.txt") is True or path.isfile(f"{batchFolder}/{batch_name}-{batchNum}_settings.txt") is True:
+        batchNum += 1
+
+    print(f'Starting Run: {batch_name}({batchNum}) at frame {start_frame}')
+
+    if set_seed == 'random_seed':
+        random.seed()
+        seed = random.randint(0, 2**32)
+        # print(f'Using seed: {seed}')
+    else:
+        seed = int(set_seed)
+
+    args = {
+        'batchNum': batchNum,
+        'prompts_series':split_prompts(text_prompts, max_frames) if text_prompts else None,
+        'image_prompts_series':split_prompts(image_prompts, max_frames) if image_prompts else None,
+        'seed': seed,
+        'display_rate':display_rate,
+        'n_batches':n_batches if animation_mode == 'None' else 1,
+        'batch_size':batch_size if animation_mode == 'None' else 1,
+        'batch_name': batch_name,
+        'steps': steps,
+        'width_height': width_height,
+        'clip_guidance_scale': clip_guidance_scale,
+        'tv_scale': tv_scale,
+        'range_scale': range_scale,
+        'sat_scale': sat_scale,
+        'cutn_batches': cutn_batches,
+        'init_image': init_image,
+        'init_scale': init_scale,
+        'skip_steps': skip_steps,
+        'sharpen_preset': sharpen_preset,
+        'keep_unsharp': keep_unsharp,
+        'side_x': side_x,
+        'side_y': side_y,
+        'timestep_respacing': timestep_respacing,
+        'diffusion_steps': diffusion_steps,
+        'animation_mode': animation_mode,
+        'video_init_path': video_init_path,
+        'extract_nth_frame': extract_nth_frame,
+        'key_frames': key_frames,
+        'max_frames': max_frames if animation_mode != "None" else 1,
+        'interp_spline': interp_spline,
+        'start_frame': start_frame,
+        'angle': angle,
+        'zoom': zoom,
+        'translation_x': translation_x,
+        'translation_y': translation_y,
+        'angle_series':angle_series,
+        'zoom_series':zoom_series,
+        'translation_x_series':translation_x_series,
+        'translation_y_series':translation_y_series,
+        'frames_scale': frames_scale,
+        'calc_frames_skip_steps': calc_frames_skip_steps,
+        'skip_step_ratio': skip_step_ratio,
+        'calc_frames_skip_steps': calc_frames_skip_steps,
+        'text_prompts': text_prompts,
+        'image_prompts': image_prompts,
+        'cut_overview': eval(cut_overview),
+        'cut_innercut': eval(cut_innercut),
+        'cut_ic_pow': cut_ic_pow,
+        'cut_icgray_p': eval(cut_icgray_p),
+        'intermediate_saves': intermediate_saves,
+        'intermediates_in_subfolder': intermediates_in_subfolder,
+        'steps_per_checkpoint': steps_per_checkpoint,
+        'perlin_init': perlin_init,
+        'perlin_mode': perlin_mode,
+        'set_seed': set_seed,
+        'eta': eta,
+        'guidance_every': iargs.guidance_every,
+        'diffusion_sampling_mode': diffusion_sampling_mode,
+        'clamp_grad': clamp_grad,
+        'clamp_max': clamp_max,
+        'skip_augs': skip_augs,
+        'randomize_class': randomize_class,
+        'clip_denoised': clip_denoised,
+        'fuzzy_prompt': fuzzy_prompt,
+        'rand_mag': rand_mag,
+        'diffusion_model': diffusion_model,
+        'use_secondary_model': use_secondary_model,
+        'use_checkpoint': use_checkpoint,
+        'clip_models': clip_models,
+        'ViTB32': ViTB32,
+        'ViTB16': ViTB16,
+        'ViTL14': ViTL14,
+        'RN101': RN101,
+        'RN50': RN50,
+        'RN50x4': RN50x4,
+        'RN50x16': RN50x16,
+        'RN50x64': RN50x64,
+        'cuda_device': iargs.cuda_device,
+        'output_path': output_path,
+        'output_filename': output_filename,
+        'output_filenames': output_filenames,
+        'batchFolder': batchFolder,
+        'partialFolder': partialFolder,
+        'unsharpenFolder': unsharpenFolder,
+        'videoFramesFolder': videoFramesFolder,
+        'resume_run': resume_run,
+        'jpg_comment': iargs.jpg_comment,
+        'jpg_author': iargs.jpg_author,
+        'start_time': time.time(),
+    }
+
+    return SimpleNamespace(**args)
+
+
+# CLIP's input normalisation, with its mean and std kept on each device and
+# type they're used with; T.Normalize copies them to the GPU and checks std for
+# zeros there (a host sync) on every call
+normalize_stats = {}
+
+def normalize(input):
+    key = (input.device, input.dtype)
+    stats = normalize_stats.get(key)
+    if stats is None:
+        mean = torch.tensor([0.48145466, 0.4578275, 0.40821073], dtype=input.dtype)[:, None, None]
+        std = torch.tensor([0.26862954, 0.26130258, 0.27577711], dtype=input.dtype)[:, None, None]
+        stats = (mean.to(input.device), std.to(input.device))
+        normalize_stats[key] = stats
+    return (input - stats[0]) / stats[1]
+
+
+# Holds the diffusion, secondary and LPIPS models on one device so a resident
+# worker can render any number of jobs without reloading them. CLIP models and
+# the superres model are loaded the first time a job asks for them.
+class DiffusionEngine:
+    def __init__(self, device, diffusion_model='512x512_diffusion_uncond_finetune_008100', use_checkpoint=True):
+        self.key = (diffusion_model, use_checkpoint, str(device))
+        self.device = device
+        self.use_checkpoint = use_checkpoint
+        self.diffusion_model = diffusion_model
+
+        self.model_config = model_and_diffusion_defaults()
+        if diffusion_model == '512x512_diffusion_uncond_finetune_008100':
+            self.model_config.update({
+                'attention_resolutions': '32, 16, 8',
+                'class_cond': False,
+                'rescale_timesteps': True,
+                'image_size': 512,
+                'learn_sigma': True,
+                'noise_schedule': 'linear',
+                'num_channels': 256,
+                'num_head_channels': 64,
+                'num_res_blocks': 2,
+                'resblock_updown': True,
+                'use_checkpoint': use_checkpoint,
+                'use_fp16': self.device.type == 'cuda',
+                'use_scale_shift_norm': True,
+            })
+        elif diffusion_model == '256x256_diffusion_uncond':
+            self.model_config.update({
+                'attention_resolutions': '32, 16, 8',
+                'class_cond': False,
+                'rescale_timesteps': True,
+                'image_size': 256,
+                'learn_sigma': True,
+                'noise_schedule': 'linear',
+                'num_channels': 256,
+                'num_head_channels': 64,
+                'num_res_blocks': 2,
+                'resblock_updown': True,
+                'use_checkpoint': use_checkpoint,
+                'use_fp16': self.device.type == 'cuda',
+                'use_scale_shift_norm': True,
+            })
+
+        print('Prepping model...')
+        self.model, _ = create_model_and_diffusion(**self.model_config)
+        self.model.load_state_dict(torch.load(f'{model_path}/{diffusion_model}.pt', map_location='cpu'))
+        self.model.requires_grad_(False).eval().to(device)
+        if self.model_config['use_fp16']:
+            self.model.convert_to_fp16()
+
+        secondary_model_ver = 2
+        if secondary_model_ver == 2:
+            self.secondary_model = SecondaryDiffusionImageNet2()
+            self.secondary_model.load_state_dict(torch.load(f'{model_path}/secondary_model_imagenet_2.pth', map_location='cpu'))
+        self.secondary_model.eval().requires_grad_(False).to(device)
+
+        self.lpips_model = lpips.LPIPS(net='vgg').to(device)
+        self.init_features = None
+
+        self.clip_models = {}
+        self.embed_cache = embed_cache.get_cache()
+        self.sr_model = None
+        # respaced diffusions by (timestep_respacing, diffusion_steps)
+        self.diffusions = {}
+        self.image_display = Output()
+
+    # The models a job needs; a resident worker reloads when this changes
+    @staticmethod
+    def key_for(args):
+        return (args.diffusion_model, args.use_checkpoint, str(get_device(args.cuda_device)))
+
+    # Respacing only builds the beta schedule, so each step count gets its own
+    # diffusion object while all of them share the one loaded model
+    def get_diffusion(self, args):
+        key = (args.timestep_respacing, args.diffusion_steps)
+        if key not in self.diffusions:
+            config = dict(self.model_config, timestep_respacing=args.timestep_respacing, diffusion_steps=args.diffusion_steps)
+            self.diffusions[key] = create_gaussian_diffusion(
+                steps=config['diffusion_steps'],
+                learn_sigma=config['learn_sigma'],
+                noise_schedule=config['noise_schedule'],
+                use_kl=config['use_kl'],
+                predict_xstart=config['predict_xstart'],
+                rescale_timesteps=config['rescale_timesteps'],
+                rescale_learned_sigmas=config['rescale_learned_sigmas'],
+                timestep_respacing=config['timestep_respacing'],
+            )
+        return self.diffusions[key]
+
+    # (name, model) for each CLIP model the job uses
+    def get_clip_models(self, args):
+        clip_models = []
+        for name in args.clip_models:
+            if name not in self.clip_models:
+                self.clip_models[name] = clip.load(name, jit=False)[0].eval().requires_grad_(False).to(self.device)
+            clip_models.append((name, self.clip_models[name]))
+
+        device = self.device
+        if SLIPB16:
+          SLIPB16model = SLIP_VITB16(ssl_mlp_dim=4096, ssl_emb_dim=256)
+          if not os.path.exists(f'{model_path}/slip_base_100ep.pt'):
+            print('slip_base_100ep.pt missing!')
+          sd = torch.load(f'{model_path}/slip_base_100ep.pt')
+          real_sd = {}
+          for k, v in sd['state_dict'].items():
+            real_sd['.'.join(k.split('.')[1:])] = v
+          del sd
+          SLIPB16model.load_state_dict(real_sd)
+          SLIPB16model.requires_grad_(False).eval().to(device)
+
+          clip_models.append(('SLIP-B/16', SLIPB16model))
+
+        if SLIPL16:
+          SLIPL16model = SLIP_VITL16(ssl_mlp_dim=4096, ssl_emb_dim=256)
+          if not os.path.exists(f'{model_path}/slip_large_100ep.pt'):
+            print('slip_large_100ep.pt missing!')
+          sd = torch.load(f'{model_path}/slip_large_100ep.pt')
+          real_sd = {}
+          for k, v in sd['state_dict'].items():
+            real_sd['.'.join(k.split('.')[1:])] = v
+          del sd
+          SLIPL16model.load_state_dict(real_sd)
+          SLIPL16model.requires_grad_(False).eval().to(device)
+
+          clip_models.append(('SLIP-L/16', SLIPL16model))
+
+        return clip_models
+
+    # Guidance only backpropagates through the diffusion model when there's no
+    # secondary model. With one, the model's parameters need no gradients, and
+    # checkpointing would only keep inputs around to recompute activations
+    # that are never used, so both are switched off for the job
+    def set_guidance(self, use_secondary_model):
+        through_model = not use_secondary_model
+        for name, param in self.model.named_parameters():
+            if 'qkv' in name or 'norm' in name or 'proj' in name:
+                param.requires_grad_(through_model)
+        for module in self.model.modules():
+            if hasattr(module, 'use_checkpoint'):
+                module.use_checkpoint = self.use_checkpoint and through_model
+
+    # The LPIPS features of a job's init image (None if it doesn't use one). The
+    # last ones are kept, so the steps, batches and animation frames of a job,
+    # and the jobs after it, that have the same init image share them
+    def get_init_features(self, init, args):
+        if init is None or not args.init_scale:
+            self.init_features = None
+        elif self.init_features is None or not self.init_features.matches(init):
+            self.init_features = InitFeatures(self.lpips_model, init)
+        return self.init_features
+
+    def get_sr_model(self):
+        if self.sr_model is None:
+            self.sr_model = get_model('superresolution')
+        return self.sr_model
+
+    def generate(self, args):
+        gc.collect()
+        torch.cuda.empty_cache()
+        self.set_guidance(args.use_secondary_model)
+        try:
+            do_run(self, args)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            #print('Seed used:', seed)
+            gc.collect()
+            torch.cuda.empty_cache()
+
+
+# Runs in a resident worker process started by make_art.py: loads the models
+# once and then renders every job (a list of command line arguments) it is sent
+def serve(job_queue, result_queue):
+    engine = None
+    while True:
+        argv = job_queue.get()
+        if argv is None:
+            break
+
+        start_time = time.time()
+        ok = True
+        try:
+            args = build_args(parser.parse_args(argv))
+            if engine is None or engine.key != DiffusionEngine.key_for(args):
+                # free the old models before loading new ones
+                engine = None
+                gc.collect()
+                torch.cuda.empty_cache()
+                engine = DiffusionEngine(get_device(args.cuda_device), args.diffusion_model, args.use_checkpoint)
+            engine.generate(args)
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            ok = False
+            gc.collect()
+            torch.cuda.empty_cache()
+        # the job's images are only done once they're written
+        image_writer.get_writer().flush()
+        result_queue.put({'ok': ok, 'time': time.time() - start_time, 'embed_cache': embed_cache.get_cache().take_stats()})
+
+
+if __name__ == '__main__':
+    args = build_args(parser.parse_args())
+    device = get_device(args.cuda_device)
+    print('Using device:', device)
+    engine = DiffusionEngine(device, args.diffusion_model, args.use_checkpoint)
+    engine.generate(args)
+    image_writer.get_writer().flush()
+    embed_cache.report_stats()
+
+    # @title ### **Create video**
+    #@markdown Video file will save in the same folder as your images.
+
+    skip_video_for_run_all = True #@param {type: 'boolean'}
+
+    if skip_video_for_run_all == False:
+      # import subprocess in case this cell is run without the above cells
+      import subprocess
+      from base64 import b64encode
+
+      latest_run = args.batchNum
+
+      folder = args.batch_name #@param
+      run = latest_run #@param
+      final_frame = 'final_frame'
+
+
+      init_frame = 1#@param {type:"number"} This is the frame where the video will start
+      last_frame = final_frame#@param {type:"number"} You can change i to the number of the last frame you want to generate. It will raise an error if that number of frames does not exist.
+      fps = 12#@param {type:"number"}
+      view_video_in_cell = False #@param {type: 'boolean'}
+
+      frames = []
+      # tqdm.write('Generating video...')
+
+      if last_frame == 'final_frame':
+        last_frame = len(glob(args.batchFolder+f"/{folder}({run})_*.png"))
+        print(f'Total frames: {last_frame}')
+
+      image_path = f"{args.output_path}/{folder}/{folder}({run})_%04d.png"
+      filepath = f"{args.output_path}/{folder}/{folder}({run}).mp4"
+
+      cmd = [
+          'ffmpeg',
+          '-y',
+          '-vcodec',
+          'png',
+          '-r',
+          str(fps),
+          '-start_number',
+          str(init_frame),
+          '-i',
+          image_path,
+          '-frames:v',
+          str(last_frame+1),
+          '-c:v',
+          'libx264',
+          '-vf',
+          f'fps={fps}',
+          '-pix_fmt',
+          'yuv420p',
+          '-crf',
+          '17',
+          '-preset',
+          'veryslow',
+          filepath
+      ]
+
+      process = subprocess.Popen(cmd, cwd=f'{args.batchFolder}', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      stdout, stderr = process.communicate()
+      if process.returncode != 0:
+          print(stderr)
+          raise RuntimeError(stderr)
+      else:
+          print("The video is ready")
+
+      if view_video_in_cell:
+          mp4 = open(filepath,'rb').read()
+          data_url = "data:video/mp4;base64," + b64encode(mp4).decode()
+          display.HTML("""
+          <video width=400 controls>
+                <source src="%s" type="video/mp4">
+          </video>
+          """ % data_url)
@@ -0,0 +1,148 @@
+# Cache of CLIP text embeddings keyed by (CLIP model name, prompt text).
+# Prompt files re-use the same subjects and styles across many jobs, so a
+# worker only needs to run each distinct string through CLIP's text encoder
+# once. Embeddings are kept in memory for the life of the process and, if a
+# cache file is configured, in a sqlite database shared by every worker (and
+# by later runs).
+
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import torch
+
+# make_art.py sets this for its workers when run with --embed-cache
+CACHE_ENV = 'AI_ART_EMBED_CACHE'
+# and this for jobs it runs as a process of their own: the file they leave
+# their hit/miss counts in (see report_stats)
+STATS_ENV = 'AI_ART_EMBED_CACHE_STATS'
+
+
+class EmbeddingCache():
+    def __init__(self, path=None):
+        self.path = path
+        self.memory = {}
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            folder = os.path.dirname(path)
+            if folder != '':
+                os.makedirs(folder, exist_ok=True)
+            # WAL lets several worker processes read while one of them writes
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS embeddings ('
+                            'model TEXT NOT NULL, text TEXT NOT NULL, shape TEXT NOT NULL, data BLOB NOT NULL, '
+                            'PRIMARY KEY (model, text))')
+            self.db.commit()
+
+    # returns the float32 embedding of text for the named CLIP model on device,
+    # calling encode(text) only if it isn't cached yet
+    def get(self, model_name, text, encode, device):
+        key = (model_name, text)
+        with self.lock:
+            embed = self.memory.get(key)
+            if embed is None and self.db is not None:
+                embed = self.__load(key)
+                if embed is not None:
+                    self.memory[key] = embed
+            counts = self.hits if embed is not None else self.misses
+            counts[model_name] = counts.get(model_name, 0) + 1
+
+        if embed is not None:
+            return torch.from_numpy(embed).to(device, copy=True)
+
+        encoded = encode(text).float()
+        embed = encoded.detach().cpu().numpy().copy()
+        with self.lock:
+            self.memory[key] = embed
+            if self.db is not None:
+                self.__store(key, embed)
+        return encoded
+
+    def __load(self, key):
+        row = self.db.execute('SELECT shape, data FROM embeddings WHERE model = ? AND text = ?', key).fetchone()
+        if row is None:
+            return None
+        shape = tuple(int(x) for x in row[0].split(','))
+        # copy so the array owns (writable) memory that torch can wrap
+        return np.frombuffer(row[1], dtype=np.float32).reshape(shape).copy()
+
+    def __store(self, key, embed):
+        shape = ','.join(str(x) for x in embed.shape)
+        try:
+            self.db.execute('INSERT OR REPLACE INTO embeddings (model, text, shape, data) VALUES (?, ?, ?, ?)',
+                            key + (shape, np.ascontiguousarray(embed, dtype=np.float32).tobytes()))
+            self.db.commit()
+        except sqlite3.Error as e:
+            # the in-memory copy is still good; another worker may hold the lock
+            print('Could not save text embedding to ' + str(self.path) + ': ' + str(e))
+
+    # hit/miss counts per CLIP model since the last call, e.g.
+    # {'ViT-B/32': {'hits': 3, 'misses': 1}}
+    def take_stats(self):
+        with self.lock:
+            stats = {}
+            for model_name in set(self.hits) | set(self.misses):
+                stats[model_name] = {'hits': self.hits.get(model_name, 0), 'misses': self.misses.get(model_name, 0)}
+            self.hits = {}
+            self.misses = {}
+        return stats
+
+
+# adds the counts in stats to totals (both as returned by take_stats())
+def merge_stats(totals, stats):
+    for model_name, counts in stats.items():
+        total = totals.setdefault(model_name, {'hits': 0, 'misses': 0})
+        total['hits'] += counts['hits']
+        total['misses'] += counts['misses']
+    return totals
+
+
+# one line per CLIP model, for the end of a run
+def format_stats(totals):
+    lines = []
+    for model_name in sorted(totals):
+        hits = totals[model_name]['hits']
+        lookups = hits + totals[model_name]['misses']
+        rate = 100 * hits / lookups if lookups > 0 else 0
+        lines.append(model_name + ': ' + str(hits) + '/' + str(lookups) + ' hits (' + str(round(rate, 1)) + '%)')
+    return lines
+
+
+# for the end of a standalone vqgan.py/diffusion.py run: prints the process's
+# hit rates and, if make_art.py asked for them, leaves the counts in the
+# $AI_ART_EMBED_CACHE_STATS file
+def report_stats():
+    stats = get_cache().take_stats()
+    if len(stats) > 0:
+        print('Text embedding cache hits:')
+        for line in format_stats(stats):
+            print('  ' + line)
+    path = os.environ.get(STATS_ENV)
+    if path:
+        with open(path, 'w') as f:
+            json.dump(stats, f)
+
+
+# the counts a job left in path with report_stats(), or {} if it didn't
+def load_stats(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+_cache = None
+
+# the process-wide cache, stored in the file named by $AI_ART_EMBED_CACHE (if set)
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = EmbeddingCache(os.environ.get(CACHE_ENV) or None)
+    return _cache
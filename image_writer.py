@@ -0,0 +1,77 @@
+# Saves finished images as JPEGs with the details of the job that made them in
+# their EXIF data. Generators hand their images to a background thread for
+# encoding, so a progress save every few iterations doesn't hold up the next
+# iteration; flush() waits until everything handed over so far is on disk.
+
+import datetime
+import os
+import queue
+import threading
+import traceback
+
+JPEG_QUALITY = 88
+
+
+# where the .jpg for an output filename goes
+def jpg_path(path):
+    return os.path.splitext(path)[0] + '.jpg'
+
+
+# the command that made an image, the GPU it ran on and how long it took
+def make_exif(image, command, author, seconds):
+    exif = image.getexif()
+    # usercomments
+    exif[0x9286] = command
+    # comments used by windows
+    exif[0x9c9c] = command.encode('utf16')
+    # author used by windows
+    exif[0x9c9d] = author.encode('utf16')
+    # software name used by windows
+    exif[0x0131] = "AI Art (generated in " + str(datetime.timedelta(seconds=round(seconds))) + ")"
+    return exif
+
+
+# writes a PIL image to path as a JPEG with its generation details
+def save_jpg(image, path, command, author, seconds):
+    im = image.convert('RGB')
+    im.save(path, exif=make_exif(im, command, author, seconds), quality=JPEG_QUALITY)
+
+
+class ImageWriter():
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    # queues a save_jpg(); image must not change afterwards (PIL images from
+    # TF.to_pil_image() are already a copy of the tensor)
+    def save_jpg(self, image, path, command, author, seconds):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run, daemon=True)
+                self.thread.start()
+        self.queue.put((image, path, command, author, seconds))
+
+    def __run(self):
+        while True:
+            image, path, command, author, seconds = self.queue.get()
+            try:
+                save_jpg(image, path, command, author, seconds)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    # blocks until every queued image has been written
+    def flush(self):
+        self.queue.join()
+
+
+_writer = None
+
+# the process-wide writer
+def get_writer():
+    global _writer
+    if _writer is None:
+        _writer = ImageWriter()
+    return _writer
@@ -0,0 +1,93 @@
+# Append-only record (one JSON object per line) of the jobs make_art.py starts
+# and finishes, kept next to the prompt file while it runs. Jobs are made from
+# the work queue's seed, so if make_art.py dies part way through a prompt file,
+# the journal's seed re-creates the same jobs (with the same seeds) on restart;
+# the ones it finished are skipped, and the ones that were still running (or
+# failed) are run again. The journal is removed once the prompt file is done.
+
+import hashlib
+import json
+import os
+import threading
+
+
+# identifies a job by everything that goes into making it, so a finished job
+# is only skipped if the prompt file still makes exactly the same job
+def job_hash(job):
+    spec = [list(job.settings), job.prompt, job.seed, job.output]
+    return hashlib.sha1(json.dumps(spec).encode()).hexdigest()[:16]
+
+
+class Journal():
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    # (queue seed, {job key: job hash} of the finished jobs) from an earlier
+    # run that didn't get to the end, or None
+    def replay(self):
+        if not os.path.exists(self.path):
+            return None
+        seed = None
+        done = {}
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short by the crash
+                    continue
+                if record['event'] == 'queue':
+                    seed = record['seed']
+                    done = {}
+                elif record['event'] == 'done':
+                    done[tuple(record['key'])] = record['hash']
+        if seed is None:
+            return None
+        return seed, done
+
+    # starts a journal for a new work queue, keeping the jobs in done ({job
+    # key: job hash}) that were finished by an earlier run
+    def begin(self, seed, done=None):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            # write the new journal to the side first, so a crash here can't
+            # lose the old one
+            temp = self.path + '.tmp'
+            with open(temp, 'w') as f:
+                f.write(json.dumps({'event': 'queue', 'seed': seed}) + '\n')
+                for key, h in (done or {}).items():
+                    f.write(json.dumps({'event': 'done', 'key': list(key), 'hash': h}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.path)
+            self.file = open(self.path, 'a')
+
+    def __write(self, record):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    # a job (or a batch of jobs) was handed to a worker
+    def started(self, jobs):
+        for job in jobs if isinstance(jobs, list) else [jobs]:
+            self.__write({'event': 'start', 'key': list(job.key), 'hash': job_hash(job), 'seed': job.seed})
+
+    # a job (or a batch of jobs) finished; failed jobs are run again on restart
+    def finished(self, jobs, ok=True):
+        for job in jobs if isinstance(jobs, list) else [jobs]:
+            self.__write({'event': 'done' if ok else 'failed', 'key': list(job.key), 'hash': job_hash(job)})
+
+    # stops writing; with remove, also deletes the journal (the work is done)
+    def close(self, remove=False):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if remove and os.path.exists(self.path):
+                os.remove(self.path)
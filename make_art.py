@@ -3,21 +3,29 @@
 
 import threading
 import time
-import datetime
-import shlex
+import argparse
+import importlib
+import multiprocessing
+import queue
 import subprocess
 import sys
+import tempfile
+import traceback
 import unicodedata
 import re
 import random
+import math
 import os
 from os.path import exists
 from datetime import datetime as dt
 from datetime import date
 from pathlib import Path
-from collections import deque
+from collections import deque, namedtuple
 from PIL.PngImagePlugin import PngImageFile, PngInfo
-from torch.cuda import get_device_name
+from torch.cuda import get_device_name, is_available
+import embed_cache
+import image_writer
+import journal
 
 # for stable diffusion
 cwd = os.getcwd()
@@ -41,6 +49,12 @@ LEARNING_RATE = 0.1     # default = 0.1 (VQGAN ONLY)
 TRANSFORMER = ""        # needs to be a .yaml and .ckpt file in /checkpoints directory for whatever is specified here, default = vqgan_imagenet_f16_16384 (VQGAN ONLY)
 CLIP_MODEL = ""         # default = ViT-B/32 (VQGAN ONLY)
 OPTIMISER = ""          # default = Adam (VQGAN ONLY)
+PRECISION = ""          # fp16 or bf16 to run the models at lower precision, default = fp32 (VQGAN ONLY)
+COMPILE = "no"          # compile the training step with torch.compile? (VQGAN ONLY)
+VQGAN_BATCH = 1         # number of consecutive jobs to optimise together in one batch (VQGAN ONLY)
+SAMPLER = ""            # plms for comparable images in fewer steps, default = ddim (DIFFUSION ONLY)
+GUIDANCE_EVERY = ""     # guide every k-th step, e.g. 2 or [1]*400+[2]*600, default = every step (DIFFUSION ONLY)
+DIFFUSION_BATCH = 1     # number of seeds of each prompt to render together in one batch (DIFFUSION ONLY)
 D_USE_VITB32 = "yes"    # load VitB32 CLIP model? (DIFFUSION ONLY)
 D_USE_VITB16 = "yes"    # load VitB16 CLIP model? (DIFFUSION ONLY)
 D_USE_VITL14 = "no"     # load VitL14 CLIP model? (DIFFUSION ONLY)
@@ -55,45 +69,457 @@ SAMPLES = 1             # number of samples to generate (STABLE DIFFUSION ONLY)
 BATCH_SIZE = 1          # number of images to generate per sample (STABLE DIFFUSION ONLY)
 STRENGTH = 0.75         # strength of starting image influence (STABLE DIFFUSION ONLY)
 
+# processes that can run in a resident worker that keeps its models loaded between jobs
+RESIDENT_PROCESSES = ('vqgan', 'diffusion')
+
 # Prevent threads from printing at same time.
 print_lock = threading.Lock()
 
-gpu_name = get_device_name()
+gpu_name = get_device_name() if is_available() else "CPU"
+
+# name of the GPU a job ran on, for the exif metadata
+def gpu_name_of(device):
+    if is_available() and str(device).isdigit():
+        return get_device_name(int(device))
+    return gpu_name
+
+# parses a comma-separated list of cuda devices (e.g. "0,1,2,3"), dropping duplicates
+def parse_devices(value):
+    devices = []
+    for device in str(value).split(','):
+        device = device.strip().replace('cuda:', '')
+        if device != '' and device not in devices:
+            devices.append(device)
+    return devices
+
+# entry point of a resident worker process; the generator module (vqgan.py/diffusion.py)
+# is only imported here, in the child, and its serve() loop runs the jobs
+def serve(process, job_queue, result_queue):
+    importlib.import_module(process).serve(job_queue, result_queue)
+
+# a long-lived generator process: models are loaded by its first job and stay
+# resident, later jobs are fed to it over a queue instead of a new process each
+class ResidentProcess():
+    def __init__(self, process):
+        ctx = multiprocessing.get_context('spawn')
+        self.process = process
+        self.job_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.proc = ctx.Process(target=serve, args=(process, self.job_queue, self.result_queue), daemon=True)
+        self.proc.start()
+
+    # runs a job (its argv minus "python [process].py") and waits for the result
+    def run(self, argv):
+        self.job_queue.put(argv)
+        while True:
+            try:
+                return self.result_queue.get(timeout=1)
+            except queue.Empty:
+                if not self.proc.is_alive():
+                    return {'ok': False, 'time': 0}
+
+    def is_alive(self):
+        return self.proc.is_alive()
+
+    def stop(self):
+        if self.proc.is_alive():
+            self.job_queue.put(None)
+            self.proc.join(30)
+        if self.proc.is_alive():
+            self.proc.terminate()
+
+# resident processes, at most one per device so that switching between
+# processes in the prompt file doesn't hold two sets of models in VRAM
+class ResidentPool():
+    def __init__(self):
+        self.residents = {}
+        self.lock = threading.Lock()
+
+    # returns the resident process for this process/device, (re)starting it if needed
+    def get(self, process, device):
+        with self.lock:
+            resident = self.residents.get(device)
+            if resident is not None and (resident.process != process or not resident.is_alive()):
+                resident.stop()
+                resident = None
+            if resident is None:
+                resident = ResidentProcess(process)
+                self.residents[device] = resident
+            return resident
+
+    def shutdown(self):
+        with self.lock:
+            for resident in self.residents.values():
+                resident.stop()
+            self.residents = {}
+
+# settings from the prompt file's directives; every job keeps the settings that
+# were current when it was queued (one shared, read-only copy per change)
+Settings = namedtuple('Settings', ['process', 'cuda_device', 'width', 'height', 'iterations', 'learning_rate',
+                                   'cuts', 'input_image', 'skip_steps', 'transformer', 'clip_model', 'optimiser', 'precision', 'compile', 'vqgan_batch',
+                                   'sampler', 'guidance_every', 'diffusion_batch', 'd_use_vitb32', 'd_use_vitb16', 'd_use_vitl14', 'd_use_rn101', 'd_use_rn50',
+                                   'd_use_rn50x4', 'd_use_rn50x16', 'd_use_rn50x64',
+                                   'steps', 'scale', 'samples', 'batch_size', 'strength'])
+
+DEFAULT_SETTINGS = Settings(process=PROCESS, cuda_device=CUDA_DEVICE, width=WIDTH, height=HEIGHT,
+                            iterations=ITERATIONS, learning_rate=LEARNING_RATE, cuts=CUTS,
+                            input_image=INPUT_IMAGE, skip_steps=SKIP_STEPS, transformer=TRANSFORMER,
+                            clip_model=CLIP_MODEL, optimiser=OPTIMISER, precision=PRECISION, compile=COMPILE, vqgan_batch=VQGAN_BATCH,
+                            sampler=SAMPLER, guidance_every=GUIDANCE_EVERY, diffusion_batch=DIFFUSION_BATCH,
+                            d_use_vitb32=D_USE_VITB32, d_use_vitb16=D_USE_VITB16, d_use_vitl14=D_USE_VITL14,
+                            d_use_rn101=D_USE_RN101, d_use_rn50=D_USE_RN50, d_use_rn50x4=D_USE_RN50x4,
+                            d_use_rn50x16=D_USE_RN50x16, d_use_rn50x64=D_USE_RN50x64,
+                            steps=STEPS, scale=SCALE, samples=SAMPLES, batch_size=BATCH_SIZE, strength=STRENGTH)
+
+# one image (or one Stable Diffusion run) to make; only turned into a command
+# line when a worker runs it
+class Job():
+    __slots__ = ('settings', 'prompt', 'seed', 'output', 'key')
+
+    def __init__(self, settings, prompt, seed, output, key=None):
+        self.settings = settings
+        # the full prompt text, e.g. "a red apple | watercolor"
+        self.prompt = prompt
+        self.seed = seed
+        # output filename for vqgan/diffusion, output folder for SD;
+        # "[[date]]" is replaced with the date the job runs
+        self.output = output
+        # the (subject, style) lines the job was made from
+        self.key = key
+
+    # argv for the job's process on device ('' for the default) writing to output
+    # (and, for a diffusion batch, its other images to batch_outputs)
+    def argv(self, device, output, batch_outputs=()):
+        s = self.settings
+        if s.process == "stablediff":
+            if s.input_image != "":
+                argv = ['python', 'scripts/img2img.py', '--ddim_steps', str(s.steps), '--prompt', self.prompt]
+            else:
+                argv = ['python', 'scripts/txt2img.py', '--W', str(s.width), '--H', str(s.height),
+                        '--ddim_steps', str(s.steps), '--prompt', self.prompt]
+            argv += ['--scale', str(s.scale), '--n_samples', str(s.batch_size)]
+            # note/todo: to add support for cuda device, txt2img.py in stable-diffusion/scripts needs to be modified
+            # leaving it out for now as the change will be overwritten every time there is a new SD release unless
+            # it's incorporated into their repo
+            if s.input_image != "":
+                argv += ['--init-img', '../' + s.input_image, '--strength', str(s.strength)]
+            # note that SD doesn't allow specifying output filename
+            return argv + ['--seed', str(self.seed), '--skip_grid', '--n_iter', str(s.samples), '--outdir', '../' + output]
+
+        # vqgan & diffusion shared initial setup
+        argv = ['python', s.process + '.py', '-s', str(s.width), str(s.height),
+                '-i', str(s.iterations), '-cuts', str(s.cuts), '-p', self.prompt]
+
+        # VQGAN+CLIP -specific params
+        if s.process == "vqgan":
+            argv += ['-lr', str(s.learning_rate)]
+            if s.transformer != "":
+                argv += ['-conf', 'checkpoints/' + s.transformer + '.yaml', '-ckpt', 'checkpoints/' + s.transformer + '.ckpt']
+            if s.clip_model != "":
+                argv += ['-m', s.clip_model]
+            if s.optimiser != "":
+                argv += ['-opt', s.optimiser]
+            if s.precision != "":
+                argv += ['-pr', s.precision]
+            if s.compile == "yes":
+                argv += ['-cmp']
+            if str(device) != "":
+                argv += ['-cd', 'cuda:' + str(device)]
+
+        # CLIP-guided diffusion -specific params:
+        if s.process == "diffusion":
+            argv += ['-cd', str(device),
+                     '-dvitb32', s.d_use_vitb32, '-dvitb16', s.d_use_vitb16, '-dvitl14', s.d_use_vitl14,
+                     '-drn101', s.d_use_rn101, '-drn50', s.d_use_rn50, '-drn50x4', s.d_use_rn50x4,
+                     '-drn50x16', s.d_use_rn50x16, '-drn50x64', s.d_use_rn50x64]
+            if s.sampler != "":
+                argv += ['-sm', s.sampler]
+            if s.guidance_every != "":
+                argv += ['-ge', s.guidance_every]
+            if int(s.diffusion_batch) > 1:
+                argv += ['-bs', str(s.diffusion_batch)]
+                if batch_outputs:
+                    argv += ['-bo'] + list(batch_outputs)
+
+        # vqgan and diffusion -shared closing args:
+        if s.input_image != "":
+            argv += ['-ii', s.input_image]
+            if s.process == "diffusion" and int(s.skip_steps) > -1:
+                argv += ['-ss', str(s.skip_steps)]
+        return argv + ['-sd', str(self.seed), '-o', output]
+
+# an argv as a command line, for display and the exif metadata (jobs are run
+# from the argv itself, so prompts can contain anything)
+def command_line(argv):
+    return ' '.join('"' + arg + '"' if arg == '' or ' ' in arg or '|' in arg else arg for arg in argv)
+
+# the jobs from a prompt file: every subject with every style, made one at a
+# time as workers ask for them instead of all up front, so a huge prompt file
+# takes no more memory than its lines and the first job starts right away.
+# A job gets its prefix, suffix and seed from an RNG seeded with the queue's
+# seed and the job's key (its subject and style lines), so a queue re-created
+# with the same seed - even from an edited prompt file - makes the same jobs
+class WorkQueue():
+    def __init__(self, subjects, styles, prefixes, suffixes, outdir, seed=None, shuffle=False, cursor=0):
+        # (settings, subject) for every subject line, with the settings from
+        # the directives above it
+        self.subjects = subjects
+        self.styles = styles
+        self.prefixes = prefixes
+        self.suffixes = suffixes
+        self.outdir = outdir
+        self.seed = random.getrandbits(63) if seed is None else seed
+        self.shuffle = shuffle
+        self.total = len(subjects) * len(styles)
+        # jobs are known by their subject and style lines (and which repeat of
+        # the line it is), which stay the same when other lines are edited
+        self.subject_keys = line_keys([subject for settings, subject in subjects])
+        self.style_keys = line_keys(styles)
+        self.subject_index = {key: i for i, key in enumerate(self.subject_keys)}
+        self.style_index = {key: i for i, key in enumerate(self.style_keys)}
+        # how many jobs have been taken (or skipped) so far
+        self.cursor = cursor
+        # jobs not to run (already run from an earlier queue) that the cursor
+        # hasn't reached yet
+        self.skip = set()
+        self.upcoming = None
+
+        # a shuffled order that doesn't need a list of every job: n -> (a*n + b)
+        # mod total visits each job once for any a coprime with total
+        self.stride = 1
+        self.offset = 0
+        if shuffle and self.total > 1:
+            rng = random.Random(self.seed)
+            self.stride = rng.randrange(1, self.total)
+            while math.gcd(self.stride, self.total) != 1:
+                self.stride = rng.randrange(1, self.total)
+            self.offset = rng.randrange(self.total)
+
+    # jobs left to run
+    def __len__(self):
+        return self.total - self.cursor - len(self.skip)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        job = self.peek()
+        if job is None:
+            raise StopIteration
+        self.upcoming = None
+        self.cursor += 1
+        return job
+
+    # the next job, without taking it (None once there are no more)
+    def peek(self):
+        while self.upcoming is None and self.cursor < self.total:
+            n = (self.stride * self.cursor + self.offset) % self.total
+            if n in self.skip:
+                self.skip.discard(n)
+                self.cursor += 1
+            else:
+                self.upcoming = self.job(n)
+        return self.upcoming
+
+    # what it takes to re-create the queue where it is now
+    def state(self):
+        return {'seed': self.seed, 'shuffle': self.shuffle, 'cursor': self.cursor}
+
+    # the index of the job with key, or None if the prompt file no longer has it
+    def index(self, key):
+        i = self.subject_index.get(key[0])
+        j = self.style_index.get(key[1])
+        if i is None or j is None:
+            return None
+        return i * len(self.styles) + j
+
+    # leaves out the jobs with these keys
+    def skip_keys(self, keys):
+        for key in keys:
+            n = self.index(key)
+            if n is not None:
+                self.skip.add(n)
+        self.upcoming = None
+
+    # job n of the subject x style product (subjects in the outer loop)
+    def job(self, n):
+        i = n // len(self.styles)
+        j = n % len(self.styles)
+        settings, subject = self.subjects[i]
+        style = self.styles[j]
+        key = (self.subject_keys[i], self.style_keys[j])
+        rng = random.Random(str(self.seed) + ':' + key[0] + ':' + key[1])
+        prefix = rng.choice(self.prefixes) if len(self.prefixes) > 0 else ''
+        suffix = rng.choice(self.suffixes) if len(self.suffixes) > 0 else ''
+
+        if settings.process == "stablediff":
+            # order matters more in stable diffusion, get the style in front of suffix
+            prompt = (prefix + " " + subject + ", " + style.strip() + ", " + suffix).strip()
+        else:
+            prompt = (prefix + ' ' + subject + ' ' + suffix).strip() + " | " + style.strip()
+
+        seed = rng.randint(1, 2**32) - 1
 
-# worker thread executes specified shell command
+        if settings.process == "stablediff":
+            output = self.outdir
+        else:
+            name_subj = slugify(subject)
+            name_subj = re.sub(":[-+]?\d*\.?\d+|[-+]?\d+", "", name_subj)
+            name_style = slugify(style)
+            name_style = re.sub(":[-+]?\d*\.?\d+|[-+]?\d+", "", name_style)
+            if len(name_subj) > (180 - len(name_style)):
+                x = 180 - len(name_style)
+                name_subj = name_subj[0:x]
+            output = self.outdir + "/" + name_subj + '-' + name_style + ".png"
+
+        return Job(settings, prompt, seed, output, key)
+
+# a key for each line that's the same wherever the line is in the file: the
+# line itself, with "#2", "#3", ... added for repeats of an earlier line
+def line_keys(lines):
+    keys = []
+    seen = {}
+    for line in lines:
+        seen[line] = seen.get(line, 0) + 1
+        keys.append(line if seen[line] == 1 else line + '#' + str(seen[line]))
+    return keys
+
+# hands out unique output filenames: if an image with the same name is
+# already in the folder, a -2, -3, ... suffix is added. Each folder is listed
+# once, and the names taken since are kept in memory instead of checking the
+# disk for every candidate name; names are reserved as soon as they're handed
+# out, so workers on different devices can't be given the same one
+class OutputNames():
+    def __init__(self):
+        self.lock = threading.Lock()
+        # folder -> names (without extension) used in it
+        self.folders = {}
+        # (folder, name) -> the last suffix number handed out for name
+        self.counters = {}
+
+    # a unique .png filename in the folder of path, based on the name of path
+    def take(self, path):
+        folder = os.path.dirname(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        with self.lock:
+            used = self.folders.get(folder)
+            if used is None:
+                used = set()
+                if os.path.isdir(folder or '.'):
+                    for f in os.listdir(folder or '.'):
+                        if f.endswith('.jpg'):
+                            used.add(f[:-4])
+                self.folders[folder] = used
+
+            x = self.counters.get((folder, name), 1)
+            unique = name if x == 1 else name + '-' + str(x)
+            while unique in used:
+                x += 1
+                unique = name + '-' + str(x)
+            self.counters[(folder, name)] = x
+            used.add(unique)
+        return path[:len(path) - len(os.path.basename(path))] + unique + '.png'
+
+output_names = OutputNames()
+
+# worker thread runs a job (or a list of vqgan jobs to optimise as one batch)
 class Worker(threading.Thread):
-    def __init__(self, command, callback=lambda: None):
+    def __init__(self, job, callback=lambda: None, residents=None, device=''):
         threading.Thread.__init__(self)
-        self.command = command
+        self.job = job
         self.callback = callback
-
-    def run(self):
+        self.residents = residents
+        self.device = device
+        # the command line(s) the job ran as
+        self.command = None
+        # what a resident worker reported back for the job (if one ran it)
+        self.result = None
+        # whether the job's process reported success
+        self.ok = False
+
+    # the device a job runs on: the device slot's when jobs are spread over a
+    # pool of devices, else the one from the prompt file's !CUDA_DEVICE
+    def device_for(self, job):
+        if self.device != '':
+            return self.device
+        return str(job.settings.cuda_device)
+
+    # creates a vqgan/diffusion job's output folder and gives it a unique output
+    # filename
+    def prepare_output(self, job):
         # doing it this way in case the date has changed since the
         # work queue was created, vs having tons of files in a single dir
-        self.command = self.command.replace("[[date]]", str(date.today()))
-        sd = False
-        # create output folder if it doesn't exist
-        if " -o " in self.command:
-            # this is vqgan/diffusion
-            fullfilepath = self.command.split(" -o ",1)[1]
-            filepath = fullfilepath.replace(fullfilepath[fullfilepath.rindex('/'):], "")
-            Path(filepath).mkdir(parents=True, exist_ok=True)
-
-            # check to see if output file already exists; find unique name if it does
-            x = 1
-            basefilepath = fullfilepath
-            while exists(fullfilepath.replace('.png', '.jpg')):
-                x += 1
-                fullfilepath = basefilepath.replace(".png","") + '-' + str(x) + ".png"
+        fullfilepath = job.output.replace("[[date]]", str(date.today()))
+        Path(os.path.dirname(fullfilepath)).mkdir(parents=True, exist_ok=True)
+        return output_names.take(fullfilepath)
+
+    # arguments that have vqgan/diffusion write the final jpg themselves, with the
+    # generation details as exif metadata (straight from memory, no png round trip)
+    def jpg_args(self, command, device):
+        return ['-jc', command, '-ja', gpu_name_of(device)]
+
+    # converts an output png to jpg with the generation details as exif metadata
+    # (for generators that only wrote a png)
+    def save_jpg(self, command, fullfilepath, exec_time, device=''):
+        pngImage = PngImageFile(fullfilepath)
+        image_writer.save_jpg(pngImage, image_writer.jpg_path(fullfilepath), command, gpu_name_of(device), exec_time)
+        if exists(image_writer.jpg_path(fullfilepath)):
+            os.remove(fullfilepath)
+
+    # runs a batch (list) of vqgan jobs together in a resident worker
+    def run_batch(self):
+        device = self.device_for(self.job[0])
+        argvs = []
+        fullfilepaths = []
+        for job in self.job:
+            fullfilepath = self.prepare_output(job)
+            argvs.append(job.argv(device, fullfilepath))
+            fullfilepaths.append(fullfilepath)
+        self.command = [command_line(argv) for argv in argvs]
+
+        with print_lock:
+            print("Batch of " + str(len(argvs)) + " jobs:")
+            for command in self.command:
+                print("Command: " + command)
+
+        start_time = time.time()
+        jobs = [argv[2:] + self.jpg_args(command, device) for argv, command in zip(argvs, self.command)]
+        self.result = self.residents.get('vqgan', device).run(jobs)
+        self.ok = bool(self.result.get('ok'))
+
+        # the batch ran as one, so every image took the whole time
+        exec_time = time.time() - start_time
+        for command, fullfilepath in zip(self.command, fullfilepaths):
+            if exists(fullfilepath):
+                self.save_jpg(command, fullfilepath, exec_time, device)
+
+        with print_lock:
+            print("Worker done.")
+        self.callback()
 
-            self.command = self.command.split(" -o ",1)[0] + " -o " + fullfilepath
+    def run(self):
+        if isinstance(self.job, list):
+            self.run_batch()
+            return
+
+        job = self.job
+        device = self.device_for(job)
+        process = job.settings.process
+        sd = process == "stablediff"
+        batch_outputs = []
+        if not sd:
+            # this is vqgan/diffusion
+            fullfilepath = self.prepare_output(job)
+            # diffusion renders DIFFUSION_BATCH seeds of the prompt at once, each
+            # image with its own unique name
+            if process == "diffusion":
+                batch_outputs = [self.prepare_output(job) for _ in range(int(job.settings.diffusion_batch) - 1)]
         else:
-            # this is stable diffusion
-            sd = True
             # fullfilepath in the case of SD will simply be the output path since
             # SD doesn't support specifying input files
-            fullfilepath = self.command.split(" --outdir ",1)[1]
-            fullfilepath = fullfilepath.replace("../","")
+            fullfilepath = job.output.replace("[[date]]", str(date.today()))
+        argv = job.argv(device, fullfilepath, batch_outputs)
+        self.command = command_line(argv)
 
         with print_lock:
             print("Command: " + self.command)
@@ -101,12 +527,29 @@ class Worker(threading.Thread):
         start_time = time.time()
         # invoke specified AI art process
         if not sd:
-            subprocess.call(shlex.split(self.command))
+            argv = argv + self.jpg_args(self.command, device)
+            if self.residents is not None and process in RESIDENT_PROCESSES:
+                self.result = self.residents.get(process, device).run(argv[2:])
+                self.ok = bool(self.result.get('ok'))
+            else:
+                # the job's process leaves its text embedding cache counts in
+                # a file, for the totals at the end of the run
+                fd, stats_path = tempfile.mkstemp(prefix='embed-cache-stats-', suffix='.json')
+                os.close(fd)
+                try:
+                    self.ok = subprocess.call(argv, env=dict(os.environ, **{embed_cache.STATS_ENV: stats_path})) == 0
+                    self.result = {'ok': self.ok, 'embed_cache': embed_cache.load_stats(stats_path)}
+                finally:
+                    os.remove(stats_path)
         else:
+            # SD scripts don't take a device argument, so limit what they can see instead
+            env = None
+            if self.device != '':
+                env = dict(os.environ, CUDA_VISIBLE_DEVICES=str(self.device))
             if sys.platform == "win32" or os.name == 'nt':
-                subprocess.call(shlex.split(self.command), cwd=(cwd + '\stable-diffusion'))
+                self.ok = subprocess.call(argv, cwd=(cwd + '\stable-diffusion'), env=env) == 0
             else:
-                subprocess.call(shlex.split(self.command), cwd=(cwd + '/stable-diffusion'))
+                self.ok = subprocess.call(argv, cwd=(cwd + '/stable-diffusion'), env=env) == 0
 
             # find the new image(s) that SD created: re-name, process, and move them
             new_files = os.listdir(fullfilepath + "/samples")
@@ -114,17 +557,11 @@ class Worker(threading.Thread):
             exec_time = time.time() - start_time
             for f in new_files:
                 if (".png" in f):
-                    # todo: this is mostly a lazy copy from below and should be made into a function
+                    # SD's own scripts write pngs, so these still need converting
                     pngImage = PngImageFile(fullfilepath + "/samples/" + f)
-                    im = pngImage.convert('RGB')
-                    exif = im.getexif()
-                    exif[0x9286] = self.command
-                    exif[0x9c9c] = self.command.encode('utf16')
-                    exif[0x9c9d] = gpu_name.encode('utf16')
-                    exif[0x0131] = "AI Art (generated in " + str(datetime.timedelta(seconds=round(exec_time))) + ")"
                     newfilename = dt.now().strftime('%Y%m-%d%H-%M%S-') + str(nf_count)
                     nf_count += 1
-                    im.save(fullfilepath + "/" + newfilename + ".jpg", exif=exif, quality=88)
+                    image_writer.save_jpg(pngImage, fullfilepath + "/" + newfilename + ".jpg", self.command, gpu_name_of(self.device), exec_time)
                     if exists(fullfilepath + "/samples/" + f):
                         os.remove(fullfilepath + "/samples/" + f)
                     try:
@@ -136,85 +573,86 @@ class Worker(threading.Thread):
 
             fullfilepath = ""
 
-        # save generation details as exif metadata for VQGAN and CLIP-guided diffusion outputs
-        if exists(fullfilepath):
-            exec_time = time.time() - start_time
-            pngImage = PngImageFile(fullfilepath)
-            #metadata = PngInfo()
-            #metadata.add_text("VQGAN+CLIP", self.command)
-            #pngImage.save(fullfilepath, pnginfo=metadata)
-            #pngImage = PngImageFile(fullfilepath)
-
-            # convert to jpg and remove the original png file
-            im = pngImage.convert('RGB')
-            exif = im.getexif()
-            # usercomments
-            exif[0x9286] = self.command
-            # comments used by windows
-            exif[0x9c9c] = self.command.encode('utf16')
-            # author used by windows
-            exif[0x9c9d] = gpu_name.encode('utf16')
-            # software name used by windows
-            exif[0x0131] = "AI Art (generated in " + str(datetime.timedelta(seconds=round(exec_time))) + ")"
-
-            im.save(fullfilepath.replace('.png', '.jpg'), exif=exif, quality=88)
-            if exists(fullfilepath.replace('.png', '.jpg')):
-                os.remove(fullfilepath)
+        # the generators write their own jpg; convert any png left behind
+        for path in [fullfilepath] + batch_outputs:
+            if exists(path):
+                self.save_jpg(self.command, path, time.time() - start_time, device)
 
         with print_lock:
             print("Worker done.")
         self.callback()
 
+# runs jobs from the controller's work queue on one device, one at a time
+class DeviceSlot(threading.Thread):
+    def __init__(self, control, device=''):
+        threading.Thread.__init__(self)
+        self.control = control
+        self.device = device
+        self.jobs_done = 0
+
+    def run(self):
+        while True:
+            job = self.control.next_work(self)
+            if job is None:
+                break
+            worker = Worker(job, residents=self.control.residents, device=self.device)
+            ok = False
+            try:
+                worker.run()
+                # a job whose process failed (or died) is run again on restart
+                ok = worker.ok
+            except Exception:
+                # a broken job shouldn't take the whole device out of the pool
+                traceback.print_exc()
+            finally:
+                self.control.on_work_done(self, job, worker.result, ok)
+
 # controller manages worker thread(s) and user input
-# TODO change worker_idle to array of bools to manage multiple threads/gpus
 class Controller:
-    def __init__(self, prompt_file):
-
-        self.process = PROCESS
-        self.width = WIDTH
-        self.height = HEIGHT
-        self.iterations = ITERATIONS
-        self.cuda_device = CUDA_DEVICE
-        self.learning_rate = LEARNING_RATE
-        self.cuts = CUTS
-        self.input_image = INPUT_IMAGE
-        self.skip_steps = SKIP_STEPS
-        self.transformer = TRANSFORMER
-        self.clip_model = CLIP_MODEL
-        self.optimiser = OPTIMISER
-        self.d_use_vitb32 = D_USE_VITB32
-        self.d_use_vitb16 = D_USE_VITB16
-        self.d_use_vitl14 = D_USE_VITL14
-        self.d_use_rn101 = D_USE_RN101
-        self.d_use_rn50 = D_USE_RN50
-        self.d_use_rn50x4 = D_USE_RN50x4
-        self.d_use_rn50x16 = D_USE_RN50x16
-        self.d_use_rn50x64 = D_USE_RN50x64
-        self.steps = STEPS
-        self.scale = SCALE
-        self.samples = SAMPLES
-        self.batch_size = BATCH_SIZE
-        self.strength = STRENGTH
-
-        self.work_queue = deque()
+    def __init__(self, prompt_file, resident=True, devices=None, shuffle=False, fresh=False, watch=True):
+
+        # current settings; directives in the prompt file replace them
+        self.settings = DEFAULT_SETTINGS
+
+        # run the subject/style combinations in a random order instead of
+        # going through the styles for one subject at a time
+        self.shuffle = shuffle
+        self.work_queue = None
         self.work_done = False
-        self.worker_idle = True
         self.is_paused = False
+        self.jobs_started = 0
         self.jobs_done = 0
+        self.jobs_failed = 0
+        self.jobs_running = 0
+        # CLIP text embedding cache hits/misses reported by resident workers
+        self.embed_cache_stats = {}
+        # device slots wait on this for work instead of polling; guards the
+        # work queue and the job counters above
+        self.work_cond = threading.Condition()
+        # one reload at a time (hotkey and file watcher)
+        self.reload_lock = threading.Lock()
+        # reload the prompt file whenever it's saved
+        self.watch = watch
+
+        # devices to run jobs on in parallel; from the command line, or else
+        # the prompt file's !DEVICES directive (read once at startup)
+        self.devices_from_cli = bool(devices)
+        self.devices = list(devices) if devices else []
+        self.slots = []
+
+        # keeps vqgan models loaded between jobs instead of a new process per job
+        self.residents = ResidentPool() if resident else None
 
         # text file containing all of the prompt/style/etc info
         self.prompt_file_name = prompt_file
 
         # lists for prompts/styles
-        self.subjects = list()
-        self.styles = list()
-        self.prefixes = list()
-        self.suffixes = list()
+        self.read_prompt_file()
 
-        self.__init_lists(self.subjects, "subjects")
-        self.__init_lists(self.styles, "styles")
-        self.__init_lists(self.prefixes, "prefixes")
-        self.__init_lists(self.suffixes, "suffixes")
+        # record of the jobs started and finished, so that a run that dies part
+        # way through carries on where it left off when started again
+        self.journal = journal.Journal(prompt_file + '.journal')
+        resume = None if fresh else self.journal.replay()
 
         if sys.platform == "win32" or os.name == 'nt':
             #keyboard.on_press_key("f10", lambda _:self.pause_callback())
@@ -223,163 +661,96 @@ class Controller:
             keyboard.add_hotkey("ctrl+shift+q", lambda: self.exit_callback())
             keyboard.add_hotkey("ctrl+shift+r", lambda: self.reload_callback())
 
-        self.init_work_queue()
+        self.init_work_queue(resume)
         with print_lock:
             print("Queued " + str(len(self.work_queue)) + " work items from " + self.prompt_file_name + ".")
 
-    # init the lists
-    def __init_lists(self, which_list, search_text):
-        with open(self.prompt_file_name) as f:
-            lines = f.readlines()
+        # one slot per device, or a single slot that runs every job on
+        # whatever device its command line asks for
+        self.slots = [DeviceSlot(self, device) for device in self.devices] or [DeviceSlot(self)]
 
-            search_header = '[' + search_text + ']'
-            found_header = False
+    # reads the subjects/styles/prefixes/suffixes lists from the prompt file in a
+    # single pass: each line goes to the list of the last [header] above it
+    def read_prompt_file(self):
+        self.subjects = list()
+        self.styles = list()
+        self.prefixes = list()
+        self.suffixes = list()
+        sections = {'[subjects]': self.subjects, '[styles]': self.styles,
+                    '[prefixes]': self.prefixes, '[suffixes]': self.suffixes}
 
-            # find the search text and read until the next search header
-            for line in lines:
+        which_list = None
+        with open(self.prompt_file_name) as f:
+            for line in f:
                 # ignore comments and strip whitespace
-                line = line.strip().split('#', 1)
-                line = line[0].strip()
-
-                # if we already found the header we want and we see another header, stop
-                if found_header and len(line) > 0 and line[0] == '[':
-                    break
-
-                # found the search header
-                if search_header.lower() == line.lower():
-                    found_header = True
-                    line = ""
-
-                if len(line) > 0 and found_header:
-                    #print(search_header + ": " + line)
+                line = line.split('#', 1)[0].strip()
+                if len(line) == 0:
+                    continue
+
+                # a header starts a new list (or ends the last one if it's unknown)
+                if line[0] == '[':
+                    which_list = sections.get(line.lower())
+                elif which_list is not None:
                     which_list.append(line)
 
-    # returns a random prefix from the prompt file
-    def prefix(self):
-        prefix = ''
-        if len(self.prefixes) > 0:
-            x = random.randint(0, len(self.prefixes)-1)
-            prefix = self.prefixes[x]
-        return prefix
-
-    # returns a random suffix from the prompt file
-    def suffix(self):
-        suffix = ''
-        if len(self.suffixes) > 0:
-            x = random.randint(0, len(self.suffixes)-1)
-            suffix = self.suffixes[x]
-        return suffix
-
-    # build a work queue with the specified prompt and style files
-    def init_work_queue(self):
-
-        # construct work queue consisting of all prompt+style combos
+    # builds a work queue from the prompt file lists, made with seed (a new
+    # random one if None)
+    def build_work_queue(self, seed=None):
+        input_name = self.prompt_file_name.split('/')
+        input_name = input_name[len(input_name)-1]
+        input_name = input_name.split('\\')
+        input_name = input_name[len(input_name)-1]
+        outdir = "output/[[date]]" + '-' + slugify(input_name.split('.', 1)[0])
+
+        # apply the setting directives, pairing each subject with the settings
+        # current at its line; the jobs themselves are made as they're needed
+        self.settings = DEFAULT_SETTINGS
+        subjects = []
         for subject in self.subjects:
-
-            # if this is a setting directive, handle it
             if subject[0] == '!':
                 self.change_setting(subject)
-
-            # otherwise build the command
             else:
-                base = ""
-
-                if self.process == "stablediff":
-                    if self.input_image != "":
-                        base = "python scripts/img2img.py" \
-                            + " --ddim_steps " + str(self.steps) \
-                            + " --prompt \""
-                    else:
-                        base = "python scripts/txt2img.py" \
-                            + " --W " + str(self.width) \
-                            + " --H " + str(self.height) \
-                            + " --ddim_steps " + str(self.steps) \
-                            + " --prompt \""
-
-                else:
-                    # vqgan & diffusion shared initial setup
-                    base = "python " + self.process + ".py" \
-                        + " -s " + str(self.width) + " " + str(self.height) \
-                        + " -i " + str(self.iterations) \
-                        + " -cuts " + str(self.cuts) \
-                        + " -p \""
-
-                input_name = self.prompt_file_name.split('/')
-                input_name = input_name[len(input_name)-1]
-                input_name = input_name.split('\\')
-                input_name = input_name[len(input_name)-1]
-                outdir="output/[[date]]" + '-' + slugify(input_name.split('.', 1)[0])
-
-                # queue a work item for each style/artist
-                for style in self.styles:
-                    if self.process == "stablediff":
-                        # order matters more in stable diffusion, get the style in front of suffix
-                        work = base + (self.prefix() + " " + subject + ", " + style.strip() + ", " + self.suffix()).strip() + "\""
-                    else:
-                        base += (self.prefix() + ' ' + subject + ' ' + self.suffix()).strip()
-                        work = base + " | " + style.strip() + "\""
-
-                    # VQGAN+CLIP -specific params
-                    if self.process == "vqgan":
-                        work += " -lr " + str(self.learning_rate)
-
-                        if self.transformer != "":
-                            work += " -conf checkpoints/" + self.transformer + ".yaml -ckpt checkpoints/" + self.transformer + ".ckpt"
-                        if self.clip_model != "":
-                            work += " -m " + self.clip_model
-                        if self.optimiser != "":
-                            work += " -opt " + self.optimiser
-                        if self.cuda_device != "":
-                            work += " -cd \"cuda:" + str(self.cuda_device) + "\""
-
-                    # CLIP-guided diffusion -specific params:
-                    if self.process == "diffusion":
-                        work += " -cd " + str(self.cuda_device)
-                        work += " -dvitb32 " + self.d_use_vitb32
-                        work += " -dvitb16 " + self.d_use_vitb16
-                        work += " -dvitl14 " + self.d_use_vitl14
-                        work += " -drn101 " + self.d_use_rn101
-                        work += " -drn50 " + self.d_use_rn50
-                        work += " -drn50x4 " + self.d_use_rn50x4
-                        work += " -drn50x16 " + self.d_use_rn50x16
-                        work += " -drn50x64 " + self.d_use_rn50x64
-
-                    seed = random.randint(1, 2**32) - 1
-
-                    # Stable Diffusion -specific params:
-                    if self.process == "stablediff":
-                        work += " --scale " + str(self.scale)
-                        work += " --n_samples " + str(self.batch_size)
-                        # note/todo: to add support for cuda device, txt2img.py in stable-diffusion/scripts needs to be modified
-                        # leaving it out for now as the change will be overwritten every time there is a new SD release unless
-                        # it's incorporated into their repo
-
-                    if self.process == "stablediff":
-                        # Stable Diffusion -specific closing args:
-                        if self.input_image != "":
-                            work += " --init-img \"../" + self.input_image + "\"" + " --strength " + str(self.strength)
-                        work += " --seed " + str(seed) + " --skip_grid" + " --n_iter " + str(self.samples) + " --outdir ../" + outdir
-                        # note that SD doesn't allow specifying output filename
-
-                    else:
-                        # vqgan and diffusion -shared closing args:
-                        if self.input_image != "":
-                            work += " -ii \"" + self.input_image + "\""
-                            if self.process == "diffusion" and int(self.skip_steps) > -1:
-                                work += " -ss " + self.skip_steps
-
-                        name_subj = slugify(subject)
-                        name_subj = re.sub(":[-+]?\d*\.?\d+|[-+]?\d+", "", name_subj)
-                        name_style = slugify(style)
-                        name_style = re.sub(":[-+]?\d*\.?\d+|[-+]?\d+", "", name_style)
-                        if len(name_subj) > (180 - len(name_style)):
-                            x = 180 - len(name_style)
-                            name_subj = name_subj[0:x]
-
-                        work += " -sd " + str(seed) + " -o " + outdir + "/" + name_subj + '-' + name_style + ".png"
-
-                    # work args built, add to queue
-                    self.work_queue.append(work)
+                subjects.append((self.settings, subject))
+
+        return WorkQueue(subjects, self.styles, self.prefixes, self.suffixes, outdir, seed=seed, shuffle=self.shuffle)
+
+    # build a work queue with the specified prompt and style files; resume is
+    # what an unfinished earlier run left in the journal
+    def init_work_queue(self, resume=None):
+        self.work_queue = self.build_work_queue(resume[0] if resume else None)
+
+        # skip the jobs that the earlier run finished, as long as the prompt
+        # file still makes exactly the same job
+        done = {}
+        if resume:
+            for key, h in resume[1].items():
+                n = self.work_queue.index(key)
+                if n is not None and journal.job_hash(self.work_queue.job(n)) == h:
+                    done[key] = h
+            self.work_queue.skip_keys(done)
+            with print_lock:
+                print("Resuming an unfinished run of " + self.prompt_file_name + ": skipping "
+                      + str(len(done)) + " jobs it already finished.")
+        # keys of the jobs run (or running) so far, left out when the prompt
+        # file is reloaded
+        self.taken = set(done)
+        self.journal.begin(self.work_queue.seed, done)
+
+    # takes the next job from the work queue; with a VQGAN_BATCH over 1,
+    # consecutive vqgan jobs with the same settings are taken together as one
+    # batch (a list of jobs) for a resident worker to optimise at once
+    def next_job(self):
+        job = next(self.work_queue)
+        settings = job.settings
+        if settings.process != "vqgan" or self.residents is None or int(settings.vqgan_batch) <= 1:
+            return job
+        batch = [job]
+        while len(batch) < int(settings.vqgan_batch):
+            following = self.work_queue.peek()
+            if following is None or following.settings != settings:
+                break
+            batch.append(next(self.work_queue))
+        return batch
 
     # handle whatever settings directives that are allowed in the prompt file here
     def change_setting(self, setting_string):
@@ -392,126 +763,196 @@ class Controller:
             if command == 'process':
                 if value == '':
                     value = PROCESS
-                self.process = value
+                self.settings = self.settings._replace(process=value)
 
             elif command == 'cuda_device':
                 if value == '':
                     value = CUDA_DEVICE
-                self.cuda_device = value
+                self.settings = self.settings._replace(cuda_device=value)
+
+            elif command == 'devices':
+                if not self.devices_from_cli and not self.slots:
+                    self.devices = parse_devices(value)
 
             elif command == 'width':
                 if value == '':
                     value = WIDTH
-                self.width = value
+                self.settings = self.settings._replace(width=value)
 
             elif command == 'height':
                 if value == '':
                     value = HEIGHT
-                self.height = value
+                self.settings = self.settings._replace(height=value)
 
             elif command == 'iterations':
                 if value == '':
                     value = ITERATIONS
-                self.iterations = value
+                self.settings = self.settings._replace(iterations=value)
 
             elif command == 'learning_rate':
                 if value == '':
                     value = LEARNING_RATE
-                self.learning_rate = value
+                self.settings = self.settings._replace(learning_rate=value)
 
             elif command == 'cuts':
                 if value == '':
                     value = CUTS
-                self.cuts = value
+                self.settings = self.settings._replace(cuts=value)
 
             elif command == 'input_image':
-                self.input_image = value
+                self.settings = self.settings._replace(input_image=value)
 
             elif command == 'skip_steps':
                 if value == '':
                     value = SKIP_STEPS
-                self.skip_steps = value
+                self.settings = self.settings._replace(skip_steps=value)
 
             elif command == 'transformer':
                 if value == 'vqgan_imagenet_f16_16384':
                     value = ''
-                self.transformer = value
+                self.settings = self.settings._replace(transformer=value)
 
             elif command == 'clip_model':
-                self.clip_model = value
+                self.settings = self.settings._replace(clip_model=value)
 
             elif command == 'optimiser':
-                self.optimiser = value
+                self.settings = self.settings._replace(optimiser=value)
+
+            elif command == 'precision':
+                self.settings = self.settings._replace(precision=value.lower())
+
+            elif command == 'compile':
+                if value == '':
+                    value = COMPILE
+                self.settings = self.settings._replace(compile=value.lower())
+
+            elif command == 'vqgan_batch':
+                if value == '':
+                    value = VQGAN_BATCH
+                self.settings = self.settings._replace(vqgan_batch=value)
+
+            elif command == 'sampler':
+                self.settings = self.settings._replace(sampler=value.lower())
+
+            elif command == 'guidance_every':
+                self.settings = self.settings._replace(guidance_every=value)
+
+            elif command == 'diffusion_batch':
+                if value == '':
+                    value = DIFFUSION_BATCH
+                self.settings = self.settings._replace(diffusion_batch=value)
 
             elif command == 'd_vitb32':
-                self.d_use_vitb32 = value
+                self.settings = self.settings._replace(d_use_vitb32=value)
 
             elif command == 'd_vitb16':
-                self.d_use_vitb16 = value
+                self.settings = self.settings._replace(d_use_vitb16=value)
 
             elif command == 'd_vitl14':
-                self.d_use_vitl14 = value
+                self.settings = self.settings._replace(d_use_vitl14=value)
 
             elif command == 'd_rn101':
-                self.d_use_rn101 = value
+                self.settings = self.settings._replace(d_use_rn101=value)
 
             elif command == 'd_rn50':
-                self.d_use_rn50 = value
+                self.settings = self.settings._replace(d_use_rn50=value)
 
             elif command == 'd_rn50x4':
-                self.d_use_rn50x4 = value
+                self.settings = self.settings._replace(d_use_rn50x4=value)
 
             elif command == 'd_rn50x16':
-                self.d_use_rn50x16 = value
+                self.settings = self.settings._replace(d_use_rn50x16=value)
 
             elif command == 'd_rn50x64':
-                self.d_use_rn50x64 = value
+                self.settings = self.settings._replace(d_use_rn50x64=value)
 
             elif command == 'steps':
                 if value == '':
                     value = STEPS
-                self.steps = value
+                self.settings = self.settings._replace(steps=value)
 
             elif command == 'scale':
                 if value == '':
                     value = SCALE
-                self.scale = value
+                self.settings = self.settings._replace(scale=value)
 
             elif command == 'samples':
                 if value == '':
                     value = SAMPLES
-                self.samples = value
+                self.settings = self.settings._replace(samples=value)
 
             elif command == 'batch_size':
                 if value == '':
                     value = BATCH_SIZE
-                self.batch_size = value
+                self.settings = self.settings._replace(batch_size=value)
 
             elif command == 'strength':
                 if value == '':
                     value = STRENGTH
-                self.strength = value
+                self.settings = self.settings._replace(strength=value)
 
             else:
                 print("\n*** WARNING: prompt file command not recognized: " + command.upper() + " (it will be ignored!) ***\n")
                 time.sleep(1.5)
 
-    # start a new worker thread
-    def do_work(self, command):
-        self.worker_idle = False
-        with print_lock:
-            print("\n\nWorker starting job #" + str(self.jobs_done+1) + ":")
-        thread = Worker(command, self.on_work_done)
-        thread.start()
-
-    # callback for worker threads when finished
-    def on_work_done(self):
-        self.worker_idle = True
-        self.jobs_done += 1
+    # starts a device slot for every device and waits until the work is done
+    def run(self):
+        if self.watch:
+            PromptFileWatcher(self).start()
+        for slot in self.slots:
+            slot.start()
+        for slot in self.slots:
+            slot.join()
+
+    # called by a device slot for its next job; blocks while paused or while
+    # other slots are still busy, returns None once there's nothing left to do
+    def next_work(self, slot):
+        with self.work_cond:
+            while not self.work_done:
+                if not self.is_paused and len(self.work_queue) > 0:
+                    job = self.next_job()
+                    self.journal.started(job)
+                    self.taken.update(j.key for j in (job if isinstance(job, list) else [job]))
+                    self.jobs_started += 1
+                    self.jobs_running += 1
+                    with print_lock:
+                        if slot.device != '':
+                            print("\n\nWorker starting job #" + str(self.jobs_started) + " on device " + slot.device + ":")
+                        else:
+                            print("\n\nWorker starting job #" + str(self.jobs_started) + ":")
+                    return job
+                if not self.is_paused and self.jobs_running == 0:
+                    # no more prompts to work on
+                    print('\nAll work done!')
+                    # keep the journal if any jobs failed, so a restart runs
+                    # just those again
+                    if self.jobs_failed > 0:
+                        print(str(self.jobs_failed) + ' job(s) failed; they will be run again if you restart with this prompt file.')
+                    self.journal.close(remove=self.jobs_failed == 0)
+                    self.work_done = True
+                    self.work_cond.notify_all()
+                    break
+                self.work_cond.wait()
+        return None
+
+    # called by a device slot when its job is finished
+    def on_work_done(self, slot, job, result=None, ok=True):
+        with self.work_cond:
+            self.journal.finished(job, ok)
+            if not ok:
+                self.jobs_failed += 1
+            if result is not None and 'embed_cache' in result:
+                embed_cache.merge_stats(self.embed_cache_stats, result['embed_cache'])
+            self.jobs_running -= 1
+            self.jobs_done += 1
+            slot.jobs_done += 1
+            self.work_cond.notify_all()
 
     # pause execution at user request
     def pause_callback(self):
-        self.is_paused = not self.is_paused
+        with self.work_cond:
+            self.is_paused = not self.is_paused
+            self.work_cond.notify_all()
         if self.is_paused:
             with print_lock:
                 print("\n\n*** Work will be paused when current operation finishes! ***")
@@ -524,27 +965,71 @@ class Controller:
     def exit_callback(self):
         if self.is_paused:
             print("Exiting...")
-            self.work_done = True
-
-    # discards the current work queue and re-builds it from the prompt file
-    # useful if the file has changed and the user wants to reload it
+            with self.work_cond:
+                # keep the journal, to carry on from here next time
+                self.journal.close()
+                self.work_done = True
+                self.work_cond.notify_all()
+
+    # re-reads the prompt file (after it's changed) and carries on with the new
+    # one: subject/style combinations new to the file are added to the work
+    # queue, ones no longer in it are dropped, and the ones already run or
+    # running aren't run again. Jobs keep the seeds they had before
     def reload_callback(self):
-        with print_lock:
-            print("\n\n*** Discarding current work queue and re-building! ***")
+        with self.reload_lock:
+            with print_lock:
+                print("\n\n*** Reloading " + self.prompt_file_name + "! ***")
 
-        self.work_queue = deque()
-        self.subjects = list()
-        self.styles = list()
-        self.prefixes = list()
-        self.suffixes = list()
-        self.__init_lists(self.subjects, "subjects")
-        self.__init_lists(self.styles, "styles")
-        self.__init_lists(self.prefixes, "prefixes")
-        self.__init_lists(self.suffixes, "suffixes")
-        self.init_work_queue()
+            # the slow part (reading the file) happens while the workers carry on
+            self.read_prompt_file()
+            work_queue = self.build_work_queue(self.work_queue.seed)
 
-        with print_lock:
-            print("*** Queued " + str(len(self.work_queue)) + " work items from " + self.prompt_file_name + "! ***")
+            with self.work_cond:
+                work_queue.skip_keys(self.taken)
+                before = len(self.work_queue)
+                self.work_queue = work_queue
+                self.work_cond.notify_all()
+
+            with print_lock:
+                print("*** " + str(len(work_queue)) + " work items left to do (was " + str(before) + ")! ***")
+
+
+# reloads the prompt file when it changes; polls the file's size and
+# modification time, which works the same on every platform and file system
+class PromptFileWatcher(threading.Thread):
+    def __init__(self, control, interval=2.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.control = control
+        self.interval = interval
+        self.stamp = self.stat()
+
+    def stat(self):
+        try:
+            st = os.stat(self.control.prompt_file_name)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            # editors can briefly remove the file while saving it
+            return None
+
+    def run(self):
+        pending = None
+        while not self.control.work_done:
+            time.sleep(self.interval)
+            stamp = self.stat()
+            if stamp is None or stamp == self.stamp:
+                pending = None
+                continue
+            # only reload once the file has stopped changing, in case it's
+            # being written in several goes
+            if stamp != pending:
+                pending = stamp
+                continue
+            self.stamp = stamp
+            pending = None
+            try:
+                self.control.reload_callback()
+            except Exception:
+                traceback.print_exc()
 
 
 # for easy reading of prompt/style files
@@ -584,33 +1069,46 @@ def slugify(value, allow_unicode=False):
 # entry point
 if __name__ == '__main__':
 
-    if len(sys.argv) > 1:
-        prompt_filename = sys.argv[1]
-        if not exists(prompt_filename):
-            print("\nThe specified prompt file '" + prompt_filename + "' doesn't exist!")
-            print("Please specify a valid text file containing your prompt information.")
-            exit()
-
-        control = Controller(prompt_filename)
-        # main work loop
-        while not control.work_done:
-            # worker is idle, start some work
-            if (control.worker_idle and not control.is_paused):
-                if len(control.work_queue) > 0:
-                    # get a new prompt or setting directive from the queue
-                    new_work = control.work_queue.popleft()
-                    control.do_work(new_work)
-                else:
-                    # no more prompts to work on
-                    print('\nAll work done!')
-                    control.work_done = True
-            else:
-                time.sleep(.01)
-
-    else:
-        print("\nUsage: python make_art.py [prompt file]")
-        print("Example: python make_art.py prompts.txt")
-
-    if control and control.jobs_done > 0:
+    parser = argparse.ArgumentParser(description='Automated AI art generation from a prompt file')
+    parser.add_argument("prompt_file", help="text file containing your subjects, styles and settings directives")
+    parser.add_argument("--no-resident", action='store_true', dest='no_resident',
+                        help="start a new process for every vqgan/diffusion job instead of keeping the models loaded between jobs")
+    parser.add_argument("--embed-cache", type=str, default=None, dest='embed_cache',
+                        help="sqlite file to keep CLIP text embeddings in, shared by all workers and later runs")
+    parser.add_argument("--devices", type=str, default=None, dest='devices',
+                        help="comma-separated cuda devices to run jobs on in parallel, e.g. 0,1,2,3 (overrides !DEVICES)")
+    parser.add_argument("--shuffle", action='store_true', dest='shuffle',
+                        help="run the subject/style combinations in a random order")
+    parser.add_argument("--fresh", action='store_true', dest='fresh',
+                        help="start the prompt file over instead of resuming an unfinished earlier run of it")
+    parser.add_argument("--no-watch", action='store_true', dest='no_watch',
+                        help="don't reload the prompt file when it changes")
+    cli_args = parser.parse_args()
+
+    prompt_filename = cli_args.prompt_file
+    if not exists(prompt_filename):
+        print("\nThe specified prompt file '" + prompt_filename + "' doesn't exist!")
+        print("Please specify a valid text file containing your prompt information.")
+        exit()
+
+    # workers (and their child processes) pick this up from the environment
+    if cli_args.embed_cache:
+        os.environ[embed_cache.CACHE_ENV] = cli_args.embed_cache
+
+    devices = parse_devices(cli_args.devices) if cli_args.devices else None
+    control = Controller(prompt_filename, resident=not cli_args.no_resident, devices=devices, shuffle=cli_args.shuffle, fresh=cli_args.fresh, watch=not cli_args.no_watch)
+    # main work loop
+    control.run()
+
+    if control.residents is not None:
+        control.residents.shutdown()
+    if control.jobs_done > 0:
         print("Total jobs done: " + str(control.jobs_done))
+        if len(control.slots) > 1:
+            for slot in control.slots:
+                print("  device " + slot.device + ": " + str(slot.jobs_done))
+    if len(control.embed_cache_stats) > 0:
+        print("Text embedding cache hits:")
+        for line in embed_cache.format_stats(control.embed_cache_stats):
+            print("  " + line)
     exit()
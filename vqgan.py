@@ -4,12 +4,14 @@
 # The original BigGAN+CLIP method was by https://twitter.com/advadnoun
 
 import argparse
-import math
 import random
 from urllib.request import urlopen
 from tqdm import tqdm
 import sys
 import os
+import gc
+import time
+import traceback
 
 # pip install taming-transformers doesn't work with Gumbel, but does not yet work with coco etc
 # appending the path does work with Gumbel, but gives ModuleNotFoundError: No module named 'transformers' for coco etc
@@ -33,6 +35,9 @@ torch.backends.cudnn.benchmark = False		# NR: True is a bit faster, but can lead
 from torch_optimizer import DiffGrad, AdamP, RAdam
 
 from CLIP import clip
+import embed_cache
+import image_writer
+from cutouts import random_boxes, resample_boxes
 import kornia.augmentation as K
 import numpy as np
 import imageio
@@ -94,96 +99,85 @@ vq_parser.add_argument("-d",    "--deterministic", action='store_true', help="En
 vq_parser.add_argument("-aug",  "--augments", nargs='+', action='append', type=str, choices=['Ji','Sh','Gn','Pe','Ro','Af','Et','Ts','Cr','Er','Re'], help="Enabled augments (latest vut method only)", default=[], dest='augments')
 vq_parser.add_argument("-vsd",  "--video_style_dir", type=str, help="Directory with video frames to style", default=None, dest='video_style_dir')
 vq_parser.add_argument("-cd",   "--cuda_device", type=str, help="Cuda device to use", default="cuda:0", dest='cuda_device')
-
-
-# Execute the parse_args() method
-args = vq_parser.parse_args()
-
-if not args.prompts and not args.image_prompts:
-    args.prompts = "A cute, smiling, Nerdy Rodent"
-
-if args.cudnn_determinism:
-   torch.backends.cudnn.deterministic = True
-
-if not args.augments:
-   args.augments = [['Af', 'Pe', 'Ji', 'Er']]
-
-# Split text prompts using the pipe character (weights are split later)
-if args.prompts:
-    # For stories, there will be many phrases
-    story_phrases = [phrase.strip() for phrase in args.prompts.split("^")]
-
-    # Make a list of all phrases
-    all_phrases = []
-    for phrase in story_phrases:
-        all_phrases.append(phrase.split("|"))
-
-    # First phrase
-    args.prompts = all_phrases[0]
-
-# Split target images using the pipe character (weights are split later)
-if args.image_prompts:
-    args.image_prompts = args.image_prompts.split("|")
-    args.image_prompts = [image.strip() for image in args.image_prompts]
-
-if args.make_video and args.make_zoom_video:
-    print("Warning: Make video and make zoom video are mutually exclusive.")
-    args.make_video = False
-
-# Make video steps directory
-if args.make_video or args.make_zoom_video:
-    if not os.path.exists('steps'):
-        os.mkdir('steps')
-
-# Fallback to CPU if CUDA is not found and make sure GPU video rendering is also disabled
-# NB. May not work for AMD cards?
-if not args.cuda_device == 'cpu' and not torch.cuda.is_available():
-    args.cuda_device = 'cpu'
-    args.video_fps = 0
-    print("Warning: No GPU found! Using the CPU instead. The iterations will be slow.")
-    print("Perhaps CUDA/ROCm or the right pytorch version is not properly installed?")
-
-# If a video_style_dir has been, then create a list of all the images
-if args.video_style_dir:
-    print("Locating video frames...")
-    video_frame_list = []
-    for entry in os.scandir(args.video_style_dir):
-        if (entry.path.endswith(".jpg")
-                or entry.path.endswith(".png")) and entry.is_file():
-            video_frame_list.append(entry.path)
-
-    # Reset a few options - same filename, different directory
-    if not os.path.exists('steps'):
-        os.mkdir('steps')
-
-    args.init_image = video_frame_list[0]
-    filename = os.path.basename(args.init_image)
-    cwd = os.getcwd()
-    args.output = os.path.join(cwd, "steps", filename)
-    num_video_frames = len(video_frame_list) # for video styling
+vq_parser.add_argument("-jc",   "--jpg_comment", type=str, help="Save the output as a .jpg with this comment in its EXIF data (used by make_art.py)", default=None, dest='jpg_comment')
+vq_parser.add_argument("-ja",   "--jpg_author", type=str, help="Author for the EXIF data of a .jpg output", default="", dest='jpg_author')
+vq_parser.add_argument("-cmp",  "--compile", action='store_true', help="Compile the training step with torch.compile (single jobs; falls back to eager if it can't)", dest='compile')
+vq_parser.add_argument("-pr",   "--precision", type=str, help="Run the VQGAN decoder, cutouts and CLIP in this precision (fp16 needs a GPU)", choices=['fp32','fp16','bf16'], default='fp32', dest='precision')
+
+
+# Parse and post-process the arguments for a single job
+# (argv=None reads the command line, resident workers pass each job's argv)
+def parse_args(argv=None):
+    args = vq_parser.parse_args(argv)
+    args.start_time = time.time()
+
+    if not args.prompts and not args.image_prompts:
+        args.prompts = "A cute, smiling, Nerdy Rodent"
+
+    if not args.augments:
+       args.augments = [['Af', 'Pe', 'Ji', 'Er']]
+
+    # Split text prompts using the pipe character (weights are split later)
+    args.all_phrases = []
+    if args.prompts:
+        # For stories, there will be many phrases
+        story_phrases = [phrase.strip() for phrase in args.prompts.split("^")]
+
+        # Make a list of all phrases
+        for phrase in story_phrases:
+            args.all_phrases.append(phrase.split("|"))
+
+        # First phrase
+        args.prompts = args.all_phrases[0]
+
+    # Split target images using the pipe character (weights are split later)
+    if args.image_prompts:
+        args.image_prompts = args.image_prompts.split("|")
+        args.image_prompts = [image.strip() for image in args.image_prompts]
+
+    if args.make_video and args.make_zoom_video:
+        print("Warning: Make video and make zoom video are mutually exclusive.")
+        args.make_video = False
+
+    # Make video steps directory
+    if args.make_video or args.make_zoom_video:
+        if not os.path.exists('steps'):
+            os.mkdir('steps')
+
+    # Fallback to CPU if CUDA is not found and make sure GPU video rendering is also disabled
+    # NB. May not work for AMD cards?
+    if not args.cuda_device == 'cpu' and not torch.cuda.is_available():
+        args.cuda_device = 'cpu'
+        args.video_fps = 0
+        print("Warning: No GPU found! Using the CPU instead. The iterations will be slow.")
+        print("Perhaps CUDA/ROCm or the right pytorch version is not properly installed?")
+
+    # CPU autocast only does bf16
+    if args.cuda_device == 'cpu' and args.precision == 'fp16':
+        args.precision = 'bf16'
+        print("Warning: fp16 needs a GPU, using bf16 instead.")
+
+    # If a video_style_dir has been, then create a list of all the images
+    args.video_frame_list = []
+    if args.video_style_dir:
+        print("Locating video frames...")
+        for entry in os.scandir(args.video_style_dir):
+            if (entry.path.endswith(".jpg")
+                    or entry.path.endswith(".png")) and entry.is_file():
+                args.video_frame_list.append(entry.path)
+
+        # Reset a few options - same filename, different directory
+        if not os.path.exists('steps'):
+            os.mkdir('steps')
+
+        args.init_image = args.video_frame_list[0]
+        filename = os.path.basename(args.init_image)
+        args.output = os.path.join(os.getcwd(), "steps", filename)
+
+    return args
 
 
 # Various functions and classes
-def sinc(x):
-    return torch.where(x != 0, torch.sin(math.pi * x) / (math.pi * x), x.new_ones([]))
-
-
-def lanczos(x, a):
-    cond = torch.logical_and(-a < x, x < a)
-    out = torch.where(cond, sinc(x) * sinc(x/a), x.new_zeros([]))
-    return out / out.sum()
-
-
-def ramp(ratio, width):
-    n = math.ceil(width / ratio + 1)
-    out = torch.empty([n])
-    cur = 0
-    for i in range(out.shape[0]):
-        out[i] = cur
-        cur += ratio
-    return torch.cat([-out[1:].flip([0]), out])[1:-1]
-
-
 # For zoom video
 def zoom_at(img, x, y, zoom):
     w, h = img.size
@@ -222,29 +216,6 @@ def random_gradient_image(w,h):
     return random_image
 
 
-# Used in older MakeCutouts
-def resample(input, size, align_corners=True):
-    n, c, h, w = input.shape
-    dh, dw = size
-
-    input = input.view([n * c, 1, h, w])
-
-    if dh < h:
-        kernel_h = lanczos(ramp(dh / h, 2), 2).to(input.device, input.dtype)
-        pad_h = (kernel_h.shape[0] - 1) // 2
-        input = F.pad(input, (0, 0, pad_h, pad_h), 'reflect')
-        input = F.conv2d(input, kernel_h[None, None, :, None])
-
-    if dw < w:
-        kernel_w = lanczos(ramp(dw / w, 2), 2).to(input.device, input.dtype)
-        pad_w = (kernel_w.shape[0] - 1) // 2
-        input = F.pad(input, (pad_w, pad_w, 0, 0), 'reflect')
-        input = F.conv2d(input, kernel_w[None, None, None, :])
-
-    input = input.view([n, c, h, w])
-    return F.interpolate(input, size, mode='bicubic', align_corners=align_corners)
-
-
 class ReplaceGrad(torch.autograd.Function):
     @staticmethod
     def forward(ctx, x_forward, x_backward):
@@ -274,10 +245,19 @@ class ClampWithGrad(torch.autograd.Function):
 clamp_with_grad = ClampWithGrad.apply
 
 
-def vector_quantize(x, codebook):
-    d = x.pow(2).sum(dim=-1, keepdim=True) + codebook.pow(2).sum(dim=1) - 2 * x @ codebook.T
-    indices = d.argmin(-1)
-    x_q = F.one_hot(indices, codebook.shape[0]).to(d.dtype) @ codebook
+# Snaps each vector in x to its nearest codebook entry, with a straight-through
+# gradient. Distances are worked out chunk_size vectors at a time and the codes
+# looked up by index, so there is never a full [tokens, n_e] distance matrix or
+# one-hot matrix in memory. |x|^2 is the same for every code so it is left out;
+# pass codebook_norms (codebook.pow(2).sum(dim=1)) to skip recomputing the rest.
+def vector_quantize(x, codebook, codebook_norms=None, chunk_size=256):
+    if codebook_norms is None:
+        codebook_norms = codebook.pow(2).sum(dim=1)
+    # always in full precision, so autocast can't change which codes are picked
+    with torch.no_grad(), torch.autocast(x.device.type, enabled=False):
+        flat = x.reshape(-1, x.shape[-1])
+        indices = torch.cat([(codebook_norms - 2 * chunk @ codebook.T).argmin(-1) for chunk in flat.split(chunk_size)])
+    x_q = codebook[indices].view(x.shape)
     return replace_grad(x_q, x)
 
 
@@ -303,16 +283,34 @@ def split_prompt(prompt):
     return vals[0], float(vals[1]), float(vals[2])
 
 
+# The pooling cutouts all start out as the same pooled image, so pool once and
+# let the augments (which make the copies differ) see it cutn times. For a
+# single image that is a broadcast view; nothing is copied before augmenting.
+def pooled_cutouts(input, av_pool, max_pool, cutn):
+    pooled = (av_pool(input) + max_pool(input))/2
+    if len(input) == 1:
+        return pooled.expand(cutn, -1, -1, -1)
+    return pooled.repeat(cutn, 1, 1, 1)
+
+
+# batch + facs * noise, with a random noise level per cutout, in one buffer
+def add_noise(batch, cutn, noise_fac):
+    facs = batch.new_empty([cutn, 1, 1, 1]).uniform_(0, noise_fac)
+    return torch.randn_like(batch).mul_(facs).add_(batch)
+
+
 class MakeCutouts(nn.Module):
-    def __init__(self, cut_size, cutn, cut_pow=1.):
+    def __init__(self, cut_size, cutn, cut_pow=1., augments=None):
         super().__init__()
         self.cut_size = cut_size
         self.cutn = cutn
         self.cut_pow = cut_pow # not used with pooling
 
         # Pick your own augments & their order
+        if not augments:
+            augments = [['Af', 'Pe', 'Ji', 'Er']]
         augment_list = []
-        for item in args.augments[0]:
+        for item in augments[0]:
             if item == 'Ji':
                 augment_list.append(K.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1, p=0.7))
             elif item == 'Sh':
@@ -348,18 +346,11 @@ class MakeCutouts(nn.Module):
         self.max_pool = nn.AdaptiveMaxPool2d((self.cut_size, self.cut_size))
 
     def forward(self, input):
-        cutouts = []
-
-        for _ in range(self.cutn):
-            # Use Pooling
-            cutout = (self.av_pool(input) + self.max_pool(input))/2
-            cutouts.append(cutout)
-
-        batch = self.augs(torch.cat(cutouts, dim=0))
+        # Use Pooling
+        batch = self.augs(pooled_cutouts(input, self.av_pool, self.max_pool, self.cutn))
 
         if self.noise_fac:
-            facs = batch.new_empty([self.cutn, 1, 1, 1]).uniform_(0, self.noise_fac)
-            batch = batch + facs * torch.randn_like(batch)
+            batch = add_noise(batch, self.cutn, self.noise_fac)
         return batch
 
 
@@ -386,23 +377,16 @@ class MakeCutoutsPoolingUpdate(nn.Module):
         sideY, sideX = input.shape[2:4]
         max_size = min(sideX, sideY)
         min_size = min(sideX, sideY, self.cut_size)
-        cutouts = []
-
-        for _ in range(self.cutn):
-            cutout = (self.av_pool(input) + self.max_pool(input))/2
-            cutouts.append(cutout)
-
-        batch = self.augs(torch.cat(cutouts, dim=0))
+        batch = self.augs(pooled_cutouts(input, self.av_pool, self.max_pool, self.cutn))
 
         if self.noise_fac:
-            facs = batch.new_empty([self.cutn, 1, 1, 1]).uniform_(0, self.noise_fac)
-            batch = batch + facs * torch.randn_like(batch)
+            batch = add_noise(batch, self.cutn, self.noise_fac)
         return batch
 
 
 # An Nerdy updated version with selectable Kornia augments, but no pooling:
 class MakeCutoutsNRUpdate(nn.Module):
-    def __init__(self, cut_size, cutn, cut_pow=1.):
+    def __init__(self, cut_size, cutn, cut_pow=1., augments=None):
         super().__init__()
         self.cut_size = cut_size
         self.cutn = cutn
@@ -410,8 +394,10 @@ class MakeCutoutsNRUpdate(nn.Module):
         self.noise_fac = 0.1
 
         # Pick your own augments & their order
+        if not augments:
+            augments = [['Af', 'Pe', 'Ji', 'Er']]
         augment_list = []
-        for item in args.augments[0]:
+        for item in augments[0]:
             if item == 'Ji':
                 augment_list.append(K.ColorJitter(brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1, p=0.7))
             elif item == 'Sh':
@@ -440,19 +426,11 @@ class MakeCutoutsNRUpdate(nn.Module):
 
     def forward(self, input):
         sideY, sideX = input.shape[2:4]
-        max_size = min(sideX, sideY)
-        min_size = min(sideX, sideY, self.cut_size)
-        cutouts = []
-        for _ in range(self.cutn):
-            size = int(torch.rand([])**self.cut_pow * (max_size - min_size) + min_size)
-            offsetx = torch.randint(0, sideX - size + 1, ())
-            offsety = torch.randint(0, sideY - size + 1, ())
-            cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
-            cutouts.append(resample(cutout, (self.cut_size, self.cut_size)))
-        batch = self.augs(torch.cat(cutouts, dim=0))
+        # crop and resample all the cutouts at once
+        boxes = random_boxes(self.cutn, sideX, sideY, self.cut_size, self.cut_pow)
+        batch = self.augs(resample_boxes(input, boxes, (self.cut_size, self.cut_size)))
         if self.noise_fac:
-            facs = batch.new_empty([self.cutn, 1, 1, 1]).uniform_(0, self.noise_fac)
-            batch = batch + facs * torch.randn_like(batch)
+            batch = add_noise(batch, self.cutn, self.noise_fac)
         return batch
 
 
@@ -475,19 +453,11 @@ class MakeCutoutsUpdate(nn.Module):
 
     def forward(self, input):
         sideY, sideX = input.shape[2:4]
-        max_size = min(sideX, sideY)
-        min_size = min(sideX, sideY, self.cut_size)
-        cutouts = []
-        for _ in range(self.cutn):
-            size = int(torch.rand([])**self.cut_pow * (max_size - min_size) + min_size)
-            offsetx = torch.randint(0, sideX - size + 1, ())
-            offsety = torch.randint(0, sideY - size + 1, ())
-            cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
-            cutouts.append(resample(cutout, (self.cut_size, self.cut_size)))
-        batch = self.augs(torch.cat(cutouts, dim=0))
+        # crop and resample all the cutouts at once
+        boxes = random_boxes(self.cutn, sideX, sideY, self.cut_size, self.cut_pow)
+        batch = self.augs(resample_boxes(input, boxes, (self.cut_size, self.cut_size)))
         if self.noise_fac:
-            facs = batch.new_empty([self.cutn, 1, 1, 1]).uniform_(0, self.noise_fac)
-            batch = batch + facs * torch.randn_like(batch)
+            batch = add_noise(batch, self.cutn, self.noise_fac)
         return batch
 
 
@@ -501,20 +471,12 @@ class MakeCutoutsOrig(nn.Module):
 
     def forward(self, input):
         sideY, sideX = input.shape[2:4]
-        max_size = min(sideX, sideY)
-        min_size = min(sideX, sideY, self.cut_size)
-        cutouts = []
-        for _ in range(self.cutn):
-            size = int(torch.rand([])**self.cut_pow * (max_size - min_size) + min_size)
-            offsetx = torch.randint(0, sideX - size + 1, ())
-            offsety = torch.randint(0, sideY - size + 1, ())
-            cutout = input[:, :, offsety:offsety + size, offsetx:offsetx + size]
-            cutouts.append(resample(cutout, (self.cut_size, self.cut_size)))
-        return clamp_with_grad(torch.cat(cutouts, dim=0), 0, 1)
+        boxes = random_boxes(self.cutn, sideX, sideY, self.cut_size, self.cut_pow)
+        return clamp_with_grad(resample_boxes(input, boxes, (self.cut_size, self.cut_size)), 0, 1)
 
 
+# Returns the model and whether it is a Gumbel VQGAN
 def load_vqgan_model(config_path, checkpoint_path):
-    global gumbel
     gumbel = False
     config = OmegaConf.load(config_path)
     if config.model.target == 'taming.models.vqgan.VQModel':
@@ -534,7 +496,12 @@ def load_vqgan_model(config_path, checkpoint_path):
     else:
         raise ValueError(f'unknown model type: {config.model.target}')
     del model.loss
-    return model
+    return model, gumbel
+
+
+def load_clip_model(clip_model):
+    jit = True if "1.7.1" in torch.__version__ else False
+    return clip.load(clip_model, jit=jit)[0]
 
 
 def resize_image(image, out_size):
@@ -544,84 +511,7 @@ def resize_image(image, out_size):
     return image.resize(size, Image.LANCZOS)
 
 
-# Do it
-device = torch.device(args.cuda_device)
-model = load_vqgan_model(args.vqgan_config, args.vqgan_checkpoint).to(device)
-jit = True if "1.7.1" in torch.__version__ else False
-perceptor = clip.load(args.clip_model, jit=jit)[0].eval().requires_grad_(False).to(device)
-
-# clock=deepcopy(perceptor.visual.positional_embedding.data)
-# perceptor.visual.positional_embedding.data = clock/clock.max()
-# perceptor.visual.positional_embedding.data=clamp_with_grad(clock,0,1)
-
-cut_size = perceptor.visual.input_resolution
-f = 2**(model.decoder.num_resolutions - 1)
-
-# Cutout class options:
-# 'latest','original','updated' or 'updatedpooling'
-if args.cut_method == 'latest':
-    make_cutouts = MakeCutouts(cut_size, args.cutn, cut_pow=args.cut_pow)
-elif args.cut_method == 'original':
-    make_cutouts = MakeCutoutsOrig(cut_size, args.cutn, cut_pow=args.cut_pow)
-elif args.cut_method == 'updated':
-    make_cutouts = MakeCutoutsUpdate(cut_size, args.cutn, cut_pow=args.cut_pow)
-elif args.cut_method == 'nrupdated':
-    make_cutouts = MakeCutoutsNRUpdate(cut_size, args.cutn, cut_pow=args.cut_pow)
-else:
-    make_cutouts = MakeCutoutsPoolingUpdate(cut_size, args.cutn, cut_pow=args.cut_pow)
-
-toksX, toksY = args.size[0] // f, args.size[1] // f
-sideX, sideY = toksX * f, toksY * f
-
-# Gumbel or not?
-if gumbel:
-    e_dim = 256
-    n_toks = model.quantize.n_embed
-    z_min = model.quantize.embed.weight.min(dim=0).values[None, :, None, None]
-    z_max = model.quantize.embed.weight.max(dim=0).values[None, :, None, None]
-else:
-    e_dim = model.quantize.e_dim
-    n_toks = model.quantize.n_e
-    z_min = model.quantize.embedding.weight.min(dim=0).values[None, :, None, None]
-    z_max = model.quantize.embedding.weight.max(dim=0).values[None, :, None, None]
-
-
-if args.init_image:
-    if 'http' in args.init_image:
-      img = Image.open(urlopen(args.init_image))
-    else:
-      img = Image.open(args.init_image)
-    pil_image = img.convert('RGB')
-    pil_image = pil_image.resize((sideX, sideY), Image.LANCZOS)
-    pil_tensor = TF.to_tensor(pil_image)
-    z, *_ = model.encode(pil_tensor.to(device).unsqueeze(0) * 2 - 1)
-elif args.init_noise == 'pixels':
-    img = random_noise_image(args.size[0], args.size[1])
-    pil_image = img.convert('RGB')
-    pil_image = pil_image.resize((sideX, sideY), Image.LANCZOS)
-    pil_tensor = TF.to_tensor(pil_image)
-    z, *_ = model.encode(pil_tensor.to(device).unsqueeze(0) * 2 - 1)
-elif args.init_noise == 'gradient':
-    img = random_gradient_image(args.size[0], args.size[1])
-    pil_image = img.convert('RGB')
-    pil_image = pil_image.resize((sideX, sideY), Image.LANCZOS)
-    pil_tensor = TF.to_tensor(pil_image)
-    z, *_ = model.encode(pil_tensor.to(device).unsqueeze(0) * 2 - 1)
-else:
-    one_hot = F.one_hot(torch.randint(n_toks, [toksY * toksX], device=device), n_toks).float()
-    # z = one_hot @ model.quantize.embedding.weight
-    if gumbel:
-        z = one_hot @ model.quantize.embed.weight
-    else:
-        z = one_hot @ model.quantize.embedding.weight
-
-    z = z.view([-1, toksY, toksX, e_dim]).permute(0, 3, 1, 2)
-    #z = torch.rand_like(z)*2						# NR: check
-
-z_orig = z.clone()
-z.requires_grad_(True)
 
-pMs = []
 normalize = transforms.Normalize(mean=[0.48145466, 0.4578275, 0.40821073],
                                   std=[0.26862954, 0.26130258, 0.27577711])
 
@@ -629,30 +519,9 @@ normalize = transforms.Normalize(mean=[0.48145466, 0.4578275, 0.40821073],
 #normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
 #                                  std=[0.229, 0.224, 0.225])
 
-# CLIP tokenize/encode
-if args.prompts:
-    for prompt in args.prompts:
-        txt, weight, stop = split_prompt(prompt)
-        embed = perceptor.encode_text(clip.tokenize(txt).to(device)).float()
-        pMs.append(Prompt(embed, weight, stop).to(device))
-
-for prompt in args.image_prompts:
-    path, weight, stop = split_prompt(prompt)
-    img = Image.open(path)
-    pil_image = img.convert('RGB')
-    img = resize_image(pil_image, (sideX, sideY))
-    batch = make_cutouts(TF.to_tensor(img).unsqueeze(0).to(device))
-    embed = perceptor.encode_image(normalize(batch)).float()
-    pMs.append(Prompt(embed, weight, stop).to(device))
-
-for seed, weight in zip(args.noise_prompt_seeds, args.noise_prompt_weights):
-    gen = torch.Generator().manual_seed(seed)
-    embed = torch.empty([1, perceptor.visual.output_dim]).normal_(generator=gen)
-    pMs.append(Prompt(embed, weight).to(device))
-
 
 # Set the optimiser
-def get_opt(opt_name, opt_lr):
+def get_opt(opt_name, opt_lr, z):
     if opt_name == "Adam":
         opt = optim.Adam([z], lr=opt_lr)	# LR=0.1 (Default)
     elif opt_name == "AdamW":
@@ -674,258 +543,554 @@ def get_opt(opt_name, opt_lr):
         opt = optim.Adam([z], lr=opt_lr)
     return opt
 
-opt = get_opt(args.optimiser, args.step_size)
-
-
-# Output for the user
-print('Using device:', device)
-print('Optimising using:', args.optimiser)
-
-if args.prompts:
-    for x in range(len(args.prompts)):
-        args.prompts[x] = args.prompts[x].strip()
-    print('Using text prompts:', args.prompts)
-if args.image_prompts:
-    print('Using image prompts:', args.image_prompts)
-if args.init_image:
-    print('Using initial image:', args.init_image)
-if args.noise_prompt_weights:
-    print('Noise prompt weights:', args.noise_prompt_weights)
 
-
-if args.seed is None:
-    seed = torch.seed()
-else:
-    seed = args.seed
-torch.manual_seed(seed)
-print('Using seed:', seed)
-
-
-# Vector quantize
-def synth(z):
-    if gumbel:
-        z_q = vector_quantize(z.movedim(1, 3), model.quantize.embed.weight).movedim(3, 1)
-    else:
-        z_q = vector_quantize(z.movedim(1, 3), model.quantize.embedding.weight).movedim(3, 1)
-    return clamp_with_grad(model.decode(z_q).add(1).div(2), 0, 1)
-
-
-#@torch.no_grad()
-@torch.inference_mode()
-def checkin(i, losses):
-    losses_str = ', '.join(f'{loss.item():g}' for loss in losses)
-    tqdm.write(f'i: {i}, loss: {sum(losses).item():g}, losses: {losses_str}')
-    out = synth(z)
-    info = PngImagePlugin.PngInfo()
-    info.add_text('comment', f'{args.prompts}')
-    TF.to_pil_image(out[0].cpu()).save(args.output, pnginfo=info)
-
-
-def ascend_txt():
-    global i
-    out = synth(z)
-    iii = perceptor.encode_image(normalize(make_cutouts(out))).float()
-
-    result = []
-
-    if args.init_weight:
-        # result.append(F.mse_loss(z, z_orig) * args.init_weight / 2)
-        result.append(F.mse_loss(z, torch.zeros_like(z_orig)) * ((1/torch.tensor(i*2 + 1))*args.init_weight) / 2)
-
-    for prompt in pMs:
-        result.append(prompt(iii))
-
-    if args.make_video:
-        img = np.array(out.mul(255).clamp(0, 255)[0].cpu().detach().numpy().astype(np.uint8))[:,:,:]
-        img = np.transpose(img, (1, 2, 0))
-        imageio.imwrite('./steps/' + str(i) + '.png', np.array(img))
-
-    return result # return loss
-
-
-def train(i):
-    opt.zero_grad(set_to_none=True)
-    lossAll = ascend_txt()
-
-    if i % args.display_freq == 0:
-        checkin(i, lossAll)
-
-    loss = sum(lossAll)
-    loss.backward()
-    opt.step()
-
-    #with torch.no_grad():
-    with torch.inference_mode():
-        z.copy_(z.maximum(z_min).minimum(z_max))
-
-
-
-i = 0 # Iteration counter
-j = 0 # Zoom video frame counter
-p = 1 # Phrase counter
-smoother = 0 # Smoother counter
-this_video_frame = 0 # for video styling
-
-# Messing with learning rate / optimisers
-#variable_lr = args.step_size
-#optimiser_list = [['Adam',0.075],['AdamW',0.125],['Adagrad',0.2],['Adamax',0.125],['DiffGrad',0.075],['RAdam',0.125],['RMSprop',0.02]]
-
-# Do it
-try:
-    with tqdm() as pbar:
-        while True:
-            # Change generated image
-            if args.make_zoom_video:
-                if i % args.zoom_frequency == 0:
-                    out = synth(z)
-
-                    # Save image
-                    img = np.array(out.mul(255).clamp(0, 255)[0].cpu().detach().numpy().astype(np.uint8))[:,:,:]
-                    img = np.transpose(img, (1, 2, 0))
-                    imageio.imwrite('./steps/' + str(j) + '.png', np.array(img))
-
-                    # Time to start zooming?
-                    if args.zoom_start <= i:
-                        # Convert z back into a Pil image
-                        #pil_image = TF.to_pil_image(out[0].cpu())
-
-                        # Convert NP to Pil image
-                        pil_image = Image.fromarray(np.array(img).astype('uint8'), 'RGB')
-
-                        # Zoom
-                        if args.zoom_scale != 1:
-                            pil_image_zoom = zoom_at(pil_image, sideX/2, sideY/2, args.zoom_scale)
-                        else:
-                            pil_image_zoom = pil_image
-
-                        # Shift - https://pillow.readthedocs.io/en/latest/reference/ImageChops.html
-                        if args.zoom_shift_x or args.zoom_shift_y:
-                            # This one wraps the image
-                            pil_image_zoom = ImageChops.offset(pil_image_zoom, args.zoom_shift_x, args.zoom_shift_y)
-
-                        # Convert image back to a tensor again
-                        pil_tensor = TF.to_tensor(pil_image_zoom)
-
-                        # Re-encode
-                        z, *_ = model.encode(pil_tensor.to(device).unsqueeze(0) * 2 - 1)
-                        z_orig = z.clone()
-                        z.requires_grad_(True)
-
-                        # Re-create optimiser
-                        opt = get_opt(args.optimiser, args.step_size)
-
-                    # Next
-                    j += 1
-
-            # Change text prompt
-            if args.prompt_frequency > 0:
-                if i % args.prompt_frequency == 0 and i > 0:
-                    # In case there aren't enough phrases, just loop
-                    if p >= len(all_phrases):
-                        p = 0
-
-                    pMs = []
-                    args.prompts = all_phrases[p]
-
-                    # Show user we're changing prompt
-                    print(args.prompts)
-
-                    for prompt in args.prompts:
-                        txt, weight, stop = split_prompt(prompt)
-                        embed = perceptor.encode_text(clip.tokenize(txt).to(device)).float()
-                        pMs.append(Prompt(embed, weight, stop).to(device))
+# Lower precisions for --precision. Only the decoder, cutouts and CLIP run in
+# them (under autocast); z, the losses and the optimiser stay in fp32
+precision_dtypes = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+def autocast(args, device):
+    dtype = precision_dtypes[args.precision]
+    return torch.autocast(device.type, dtype=dtype or torch.float32, enabled=dtype is not None)
+
+# fp16 gradients can underflow, so fp16 jobs scale the loss up before the
+# backward pass (and the gradients back down before the optimiser step); for
+# other precisions this does nothing
+def grad_scaler(args):
+    return torch.cuda.amp.GradScaler(enabled=args.precision == 'fp16')
+
+
+# Runs fn through torch.compile for --compile, or eagerly if it can't be
+# compiled (kornia's augments don't always trace). Compiling happens on the
+# first call and again for each new input shape or cutout module, so a queue of
+# same-sized jobs only pays for it once
+class Compiled:
+    def __init__(self, fn):
+        self.fn = fn
+        self.compiled = torch.compile(fn) if hasattr(torch, 'compile') else None
+        if self.compiled is None:
+            print("Warning: torch.compile needs pytorch 2.0 or later, running the training step eagerly.")
+
+    def __call__(self, *args):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args)
+            except Exception:
+                traceback.print_exc()
+                print("Warning: couldn't compile the training step, running it eagerly.")
+                self.compiled = None
+        return self.fn(*args)
+
+
+# Holds the VQGAN model, CLIP perceptor and cutout modules for one
+# config/checkpoint/CLIP model/device combination, so that a long-lived
+# process can run any number of jobs without reloading them
+class VQGANGenerator:
+    # the models are loaded from the config, checkpoint and CLIP model name
+    # unless they're passed in already built (as benchmarks/stubs.py does);
+    # cache defaults to the process's shared text embedding cache
+    def __init__(self, vqgan_config, vqgan_checkpoint, clip_model, cuda_device, model=None, gumbel=False, perceptor=None, cache=None):
+        self.key = (vqgan_config, vqgan_checkpoint, clip_model, str(cuda_device))
+        self.device = torch.device(cuda_device)
+        if model is None:
+            model, gumbel = load_vqgan_model(vqgan_config, vqgan_checkpoint)
+        self.model, self.gumbel = model.to(self.device), gumbel
+        self.clip_model = clip_model
+        if perceptor is None:
+            perceptor = load_clip_model(clip_model)
+        self.perceptor = perceptor.eval().requires_grad_(False).to(self.device)
+        self.embed_cache = embed_cache.get_cache() if cache is None else cache
+
+        # clock=deepcopy(perceptor.visual.positional_embedding.data)
+        # perceptor.visual.positional_embedding.data = clock/clock.max()
+        # perceptor.visual.positional_embedding.data=clamp_with_grad(clock,0,1)
+
+        self.cut_size = self.perceptor.visual.input_resolution
+        self.f = 2**(self.model.decoder.num_resolutions - 1)
+
+        # Gumbel or not?
+        if self.gumbel:
+            self.e_dim = 256
+            self.n_toks = self.model.quantize.n_embed
+            self.codebook = self.model.quantize.embed.weight
+        else:
+            self.e_dim = self.model.quantize.e_dim
+            self.n_toks = self.model.quantize.n_e
+            self.codebook = self.model.quantize.embedding.weight
+        self.codebook_norms = self.codebook.pow(2).sum(dim=1)
+        self.z_min = self.codebook.min(dim=0).values[None, :, None, None]
+        self.z_max = self.codebook.max(dim=0).values[None, :, None, None]
+
+        # cutout modules by (cut_method, cutn, cut_pow, augments)
+        self.cutouts = {}
+        # forward_step for --compile jobs, made on first use
+        self.compiled_step = None
+
+    # The models a job needs; a resident worker reloads when this changes
+    @staticmethod
+    def key_for(args):
+        return (args.vqgan_config, args.vqgan_checkpoint, args.clip_model, str(args.cuda_device))
+
+    def get_cutouts(self, args):
+        key = (args.cut_method, args.cutn, args.cut_pow, tuple(map(tuple, args.augments)))
+        if key not in self.cutouts:
+            # Cutout class options:
+            # 'latest','original','updated' or 'updatedpooling'
+            if args.cut_method == 'latest':
+                make_cutouts = MakeCutouts(self.cut_size, args.cutn, cut_pow=args.cut_pow, augments=args.augments)
+            elif args.cut_method == 'original':
+                make_cutouts = MakeCutoutsOrig(self.cut_size, args.cutn, cut_pow=args.cut_pow)
+            elif args.cut_method == 'updated':
+                make_cutouts = MakeCutoutsUpdate(self.cut_size, args.cutn, cut_pow=args.cut_pow)
+            elif args.cut_method == 'nrupdated':
+                make_cutouts = MakeCutoutsNRUpdate(self.cut_size, args.cutn, cut_pow=args.cut_pow, augments=args.augments)
+            else:
+                make_cutouts = MakeCutoutsPoolingUpdate(self.cut_size, args.cutn, cut_pow=args.cut_pow)
+            self.cutouts[key] = make_cutouts
+        return self.cutouts[key]
+
+    # Encode a PIL image into a latent of the output size
+    def encode(self, img, sideX, sideY):
+        pil_image = img.convert('RGB')
+        pil_image = pil_image.resize((sideX, sideY), Image.LANCZOS)
+        pil_tensor = TF.to_tensor(pil_image)
+        z, *_ = self.model.encode(pil_tensor.to(self.device).unsqueeze(0) * 2 - 1)
+        return z
+
+    def encode_text(self, txt):
+        return self.perceptor.encode_text(clip.tokenize(txt).to(self.device)).float()
+
+    # CLIP tokenize/encode (through the text embedding cache)
+    def text_prompts(self, prompts):
+        pMs = []
+        for prompt in prompts:
+            txt, weight, stop = split_prompt(prompt)
+            embed = self.embed_cache.get(self.clip_model, txt, self.encode_text, self.device)
+            pMs.append(Prompt(embed, weight, stop).to(self.device))
+        return pMs
+
+    # Vector quantize
+    def synth(self, z):
+        z_q = vector_quantize(z.movedim(1, 3), self.codebook, self.codebook_norms).movedim(3, 1)
+        return clamp_with_grad(self.model.decode(z_q).add(1).div(2), 0, 1)
+
+    #@torch.no_grad()
+    @torch.inference_mode()
+    def checkin(self, args, z, i, losses, out=None):
+        losses_str = ', '.join(f'{loss.item():g}' for loss in losses)
+        tqdm.write(f'i: {i}, loss: {sum(losses).item():g}, losses: {losses_str}')
+        if out is None:
+            out = self.synth(z)
+        image = TF.to_pil_image(out[0].float().cpu())
+        if args.jpg_comment is not None and not args.video_style_dir:
+            # straight to the final .jpg, encoded on a background thread
+            image_writer.get_writer().save_jpg(image, image_writer.jpg_path(args.output), args.jpg_comment, args.jpg_author, time.time() - args.start_time)
+        else:
+            info = PngImagePlugin.PngInfo()
+            info.add_text('comment', f'{args.prompts}')
+            image.save(args.output, pnginfo=info)
+
+    # The model part of a training step: synth, cutouts and CLIP's image encoder
+    def forward_step(self, z, make_cutouts):
+        out = self.synth(z)
+        iii = self.perceptor.encode_image(normalize(make_cutouts(out))).float()
+        return out, iii
+
+    def get_forward_step(self, args):
+        if not args.compile:
+            return self.forward_step
+        if self.compiled_step is None:
+            self.compiled_step = Compiled(self.forward_step)
+        return self.compiled_step
+
+    def ascend_txt(self, args, make_cutouts, z, z_orig, pMs, i):
+        with autocast(args, self.device):
+            out, iii = self.get_forward_step(args)(z, make_cutouts)
+
+        result = []
+
+        if args.init_weight:
+            # result.append(F.mse_loss(z, z_orig) * args.init_weight / 2)
+            result.append(F.mse_loss(z, torch.zeros_like(z_orig)) * ((1/torch.tensor(i*2 + 1))*args.init_weight) / 2)
+
+        for prompt in pMs:
+            result.append(prompt(iii))
+
+        if args.make_video:
+            img = np.array(out.float().mul(255).clamp(0, 255)[0].cpu().detach().numpy().astype(np.uint8))[:,:,:]
+            img = np.transpose(img, (1, 2, 0))
+            imageio.imwrite('./steps/' + str(i) + '.png', np.array(img))
+
+        return result # return loss
+
+    # One optimiser step; returns the loss (a tensor, so there's no GPU sync)
+    def train(self, args, make_cutouts, opt, z, z_orig, pMs, i, scaler):
+        opt.zero_grad(set_to_none=True)
+        lossAll = self.ascend_txt(args, make_cutouts, z, z_orig, pMs, i)
+
+        if i % args.display_freq == 0:
+            self.checkin(args, z, i, lossAll)
+
+        loss = sum(lossAll)
+        scaler.scale(loss).backward()
+        scaler.step(opt)
+        scaler.update()
+
+        #with torch.no_grad():
+        with torch.inference_mode():
+            z.copy_(z.maximum(self.z_min).minimum(self.z_max))
+        return loss.detach()
+
+    # Seeds the random number generators and sets up a job's starting latent,
+    # prompts and optimiser. Everything random a job does happens after this
+    # and in the same order, so a seed always gives the same image.
+    def start_job(self, args, make_cutouts, sideX, sideY):
+        device = self.device
+        toksX, toksY = sideX // self.f, sideY // self.f
+
+        if args.seed is None:
+            seed = torch.seed()
+        else:
+            seed = args.seed
+        torch.manual_seed(seed)
+        np.random.seed(seed % 2**32)	# for the pixels/gradient init noise
+
+        if args.init_image:
+            if 'http' in args.init_image:
+              img = Image.open(urlopen(args.init_image))
+            else:
+              img = Image.open(args.init_image)
+            z = self.encode(img, sideX, sideY)
+        elif args.init_noise == 'pixels':
+            img = random_noise_image(args.size[0], args.size[1])
+            z = self.encode(img, sideX, sideY)
+        elif args.init_noise == 'gradient':
+            img = random_gradient_image(args.size[0], args.size[1])
+            z = self.encode(img, sideX, sideY)
+        else:
+            # random codes, looked up by index rather than a one-hot matmul
+            z = self.codebook[torch.randint(self.n_toks, [toksY * toksX], device=device)]
+            z = z.view([-1, toksY, toksX, self.e_dim]).permute(0, 3, 1, 2)
+            #z = torch.rand_like(z)*2						# NR: check
+
+        z_orig = z.clone()
+        z.requires_grad_(True)
+
+        pMs = []
+        if args.prompts:
+            pMs = self.text_prompts(args.prompts)
+
+        for prompt in args.image_prompts:
+            path, weight, stop = split_prompt(prompt)
+            img = Image.open(path)
+            pil_image = img.convert('RGB')
+            img = resize_image(pil_image, (sideX, sideY))
+            batch = make_cutouts(TF.to_tensor(img).unsqueeze(0).to(device))
+            embed = self.perceptor.encode_image(normalize(batch)).float()
+            pMs.append(Prompt(embed, weight, stop).to(device))
+
+        for noise_seed, weight in zip(args.noise_prompt_seeds, args.noise_prompt_weights):
+            gen = torch.Generator().manual_seed(noise_seed)
+            embed = torch.empty([1, self.perceptor.visual.output_dim]).normal_(generator=gen)
+            pMs.append(Prompt(embed, weight).to(device))
+
+        opt = get_opt(args.optimiser, args.step_size, z)
+
+        # Output for the user
+        print('Using device:', device)
+        print('Optimising using:', args.optimiser)
+        print('Using seed:', seed)
+
+        if args.prompts:
+            for x in range(len(args.prompts)):
+                args.prompts[x] = args.prompts[x].strip()
+            print('Using text prompts:', args.prompts)
+        if args.image_prompts:
+            print('Using image prompts:', args.image_prompts)
+        if args.init_image:
+            print('Using initial image:', args.init_image)
+        if args.noise_prompt_weights:
+            print('Noise prompt weights:', args.noise_prompt_weights)
+
+        return z, z_orig, pMs, opt
+
+    # Run a single job (the parsed args of one vqgan.py command line)
+    def generate(self, args):
+        device = self.device
+        torch.backends.cudnn.deterministic = args.cudnn_determinism
+        make_cutouts = self.get_cutouts(args)
+
+        toksX, toksY = args.size[0] // self.f, args.size[1] // self.f
+        sideX, sideY = toksX * self.f, toksY * self.f
+
+        z, z_orig, pMs, opt = self.start_job(args, make_cutouts, sideX, sideY)
+        scaler = grad_scaler(args)
+
+        i = 0 # Iteration counter
+        j = 0 # Zoom video frame counter
+        p = 1 # Phrase counter
+        smoother = 0 # Smoother counter
+        this_video_frame = 0 # for video styling
+        num_video_frames = len(args.video_frame_list)
+
+        # Messing with learning rate / optimisers
+        #variable_lr = args.step_size
+        #optimiser_list = [['Adam',0.075],['AdamW',0.125],['Adagrad',0.2],['Adamax',0.125],['DiffGrad',0.075],['RAdam',0.125],['RMSprop',0.02]]
+
+        # Do it
+        try:
+            with tqdm() as pbar:
+                while True:
+                    # Change generated image
+                    if args.make_zoom_video:
+                        if i % args.zoom_frequency == 0:
+                            out = self.synth(z)
+
+                            # Save image
+                            img = np.array(out.mul(255).clamp(0, 255)[0].cpu().detach().numpy().astype(np.uint8))[:,:,:]
+                            img = np.transpose(img, (1, 2, 0))
+                            imageio.imwrite('./steps/' + str(j) + '.png', np.array(img))
+
+                            # Time to start zooming?
+                            if args.zoom_start <= i:
+                                # Convert z back into a Pil image
+                                #pil_image = TF.to_pil_image(out[0].cpu())
+
+                                # Convert NP to Pil image
+                                pil_image = Image.fromarray(np.array(img).astype('uint8'), 'RGB')
+
+                                # Zoom
+                                if args.zoom_scale != 1:
+                                    pil_image_zoom = zoom_at(pil_image, sideX/2, sideY/2, args.zoom_scale)
+                                else:
+                                    pil_image_zoom = pil_image
+
+                                # Shift - https://pillow.readthedocs.io/en/latest/reference/ImageChops.html
+                                if args.zoom_shift_x or args.zoom_shift_y:
+                                    # This one wraps the image
+                                    pil_image_zoom = ImageChops.offset(pil_image_zoom, args.zoom_shift_x, args.zoom_shift_y)
+
+                                # Convert image back to a tensor again
+                                pil_tensor = TF.to_tensor(pil_image_zoom)
+
+                                # Re-encode
+                                z, *_ = self.model.encode(pil_tensor.to(device).unsqueeze(0) * 2 - 1)
+                                z_orig = z.clone()
+                                z.requires_grad_(True)
+
+                                # Re-create optimiser
+                                opt = get_opt(args.optimiser, args.step_size, z)
+
+                            # Next
+                            j += 1
+
+                    # Change text prompt
+                    if args.prompt_frequency > 0:
+                        if i % args.prompt_frequency == 0 and i > 0:
+                            # In case there aren't enough phrases, just loop
+                            if p >= len(args.all_phrases):
+                                p = 0
+
+                            args.prompts = args.all_phrases[p]
+
+                            # Show user we're changing prompt
+                            print(args.prompts)
+
+                            pMs = self.text_prompts(args.prompts)
+
+                            '''
+                            # Smooth test
+                            smoother = args.zoom_frequency * 15 # smoothing over x frames
+                            variable_lr = args.step_size * 0.25
+                            opt = get_opt(args.optimiser, variable_lr, z)
+                            '''
+
+                            p += 1
 
                     '''
-                    # Smooth test
-                    smoother = args.zoom_frequency * 15 # smoothing over x frames
-                    variable_lr = args.step_size * 0.25
-                    opt = get_opt(args.optimiser, variable_lr)
+                    if smoother > 0:
+                        if smoother == 1:
+                            opt = get_opt(args.optimiser, args.step_size, z)
+                        smoother -= 1
                     '''
 
-                    p += 1
-
-            '''
-            if smoother > 0:
-                if smoother == 1:
-                    opt = get_opt(args.optimiser, args.step_size)
-                smoother -= 1
-            '''
-
-            '''
-            # Messing with learning rate / optimisers
-            if i % 225 == 0 and i > 0:
-                variable_optimiser_item = random.choice(optimiser_list)
-                variable_optimiser = variable_optimiser_item[0]
-                variable_lr = variable_optimiser_item[1]
-
-                opt = get_opt(variable_optimiser, variable_lr)
-                print("New opt: %s, lr= %f" %(variable_optimiser,variable_lr))
-            '''
-
-
-            # Training time
-            train(i)
-
-            # Ready to stop yet?
-            if i == args.max_iterations:
-                if not args.video_style_dir:
-                    # we're done
-                    break
-                else:
-                    if this_video_frame == (num_video_frames - 1):
-                        # we're done
-                        make_styled_video = True
-                        break
-                    else:
-                        # Next video frame
-                        this_video_frame += 1
-
-                        # Reset the iteration count
-                        i = -1
-                        pbar.reset()
-
-                        # Load the next frame, reset a few options - same filename, different directory
-                        args.init_image = video_frame_list[this_video_frame]
-                        print("Next frame: ", args.init_image)
-
-                        if args.seed is None:
-                            seed = torch.seed()
-                        else:
-                            seed = args.seed
-                        torch.manual_seed(seed)
-                        print("Seed: ", seed)
-
-                        filename = os.path.basename(args.init_image)
-                        args.output = os.path.join(cwd, "steps", filename)
-
-                        # Load and resize image
-                        img = Image.open(args.init_image)
-                        pil_image = img.convert('RGB')
-                        pil_image = pil_image.resize((sideX, sideY), Image.LANCZOS)
-                        pil_tensor = TF.to_tensor(pil_image)
-
-                        # Re-encode
-                        z, *_ = model.encode(pil_tensor.to(device).unsqueeze(0) * 2 - 1)
-                        z_orig = z.clone()
-                        z.requires_grad_(True)
+                    '''
+                    # Messing with learning rate / optimisers
+                    if i % 225 == 0 and i > 0:
+                        variable_optimiser_item = random.choice(optimiser_list)
+                        variable_optimiser = variable_optimiser_item[0]
+                        variable_lr = variable_optimiser_item[1]
+
+                        opt = get_opt(variable_optimiser, variable_lr, z)
+                        print("New opt: %s, lr= %f" %(variable_optimiser,variable_lr))
+                    '''
 
-                        # Re-create optimiser
-                        opt = get_opt(args.optimiser, args.step_size)
 
-            i += 1
-            pbar.update()
-except KeyboardInterrupt:
-    pass
+                    # Training time
+                    self.train(args, make_cutouts, opt, z, z_orig, pMs, i, scaler)
 
-# All done :)
+                    # Ready to stop yet?
+                    if i == args.max_iterations:
+                        if not args.video_style_dir:
+                            # we're done
+                            break
+                        else:
+                            if this_video_frame == (num_video_frames - 1):
+                                # we're done
+                                make_styled_video = True
+                                break
+                            else:
+                                # Next video frame
+                                this_video_frame += 1
+
+                                # Reset the iteration count
+                                i = -1
+                                pbar.reset()
+
+                                # Load the next frame, reset a few options - same filename, different directory
+                                args.init_image = args.video_frame_list[this_video_frame]
+                                print("Next frame: ", args.init_image)
+
+                                if args.seed is None:
+                                    seed = torch.seed()
+                                else:
+                                    seed = args.seed
+                                torch.manual_seed(seed)
+                                print("Seed: ", seed)
+
+                                filename = os.path.basename(args.init_image)
+                                args.output = os.path.join(os.getcwd(), "steps", filename)
+
+                                # Load and resize image, then re-encode
+                                img = Image.open(args.init_image)
+                                z = self.encode(img, sideX, sideY)
+                                z_orig = z.clone()
+                                z.requires_grad_(True)
+
+                                # Re-create optimiser
+                                opt = get_opt(args.optimiser, args.step_size, z)
+
+                    i += 1
+                    pbar.update()
+        except KeyboardInterrupt:
+            pass
+
+        # All done :)
+
+        # Video generation
+        if args.make_video or args.make_zoom_video:
+            if args.make_zoom_video:
+                make_video(args, j)
+            else:
+                make_video(args, i)  # This will raise an error if that number of frames does not exist.
+
+    # The settings jobs must share to be optimised together in one batch (every
+    # one train_batch takes from the first job, or that get_cutouts and train
+    # read), or None for jobs that can only run on their own (videos, zooms,
+    # stories)
+    @staticmethod
+    def batch_key(args):
+        if args.make_video or args.make_zoom_video or args.video_style_dir or args.prompt_frequency > 0:
+            return None
+        return (VQGANGenerator.key_for(args), tuple(args.size), args.max_iterations, args.display_freq,
+                args.cut_method, args.cutn, args.cut_pow, tuple(map(tuple, args.augments)),
+                args.optimiser, args.step_size, args.init_weight, args.cudnn_determinism, args.precision,
+                args.compile)
+
+    def get_rng_state(self):
+        if self.device.type == 'cuda':
+            return torch.get_rng_state(), torch.cuda.get_rng_state(self.device)
+        return torch.get_rng_state(), None
+
+    def set_rng_state(self, state):
+        torch.set_rng_state(state[0])
+        if state[1] is not None:
+            torch.cuda.set_rng_state(state[1], self.device)
+
+    # Run several jobs, optimising the latents of compatible ones together so
+    # that each iteration is one synth, one CLIP encode and one backward pass
+    # for the whole batch instead of one per job
+    def generate_batch(self, jobs):
+        for args in jobs:
+            if self.key_for(args) != self.key:
+                raise ValueError('all jobs in a batch must use the same VQGAN and CLIP models and device')
+
+        batches = {}
+        for args in jobs:
+            key = self.batch_key(args)
+            if key is None:
+                self.generate(args)
+            else:
+                batches.setdefault(key, []).append(args)
+
+        for batch in batches.values():
+            if len(batch) == 1:
+                self.generate(batch[0])
+            else:
+                self.train_batch(batch)
+
+    # Each job in the batch keeps its own latent, optimiser and random number
+    # stream (restored around its cutouts), so it ends up the same as it would
+    # on its own, up to float differences between batched and single kernels
+    def train_batch(self, batch):
+        args = batch[0]
+        torch.backends.cudnn.deterministic = args.cudnn_determinism
+        make_cutouts = self.get_cutouts(args)
+
+        toksX, toksY = args.size[0] // self.f, args.size[1] // self.f
+        sideX, sideY = toksX * self.f, toksY * self.f
+
+        jobs = []
+        for job_args in batch:
+            z, z_orig, pMs, opt = self.start_job(job_args, make_cutouts, sideX, sideY)
+            jobs.append([job_args, z, z_orig, pMs, opt, self.get_rng_state()])
+        print('Optimising', len(jobs), 'images as one batch')
+        # one scaler for the batch's loss, stepping every job's optimiser
+        scaler = grad_scaler(args)
 
-# Video generation
-if args.make_video or args.make_zoom_video:
+        try:
+            with tqdm(total=args.max_iterations + 1) as pbar:
+                for i in range(args.max_iterations + 1):
+                    for job_args, z, z_orig, pMs, opt, rng in jobs:
+                        opt.zero_grad(set_to_none=True)
+
+                    with autocast(args, self.device):
+                        out = self.synth(torch.cat([job[1] for job in jobs]))
+
+                        cutouts = []
+                        for k, job in enumerate(jobs):
+                            self.set_rng_state(job[5])
+                            cutouts.append(make_cutouts(out[k:k + 1]))
+                            job[5] = self.get_rng_state()
+                        iii = self.perceptor.encode_image(normalize(torch.cat(cutouts))).float()
+                    iii = iii.split([len(c) for c in cutouts])
+
+                    loss = 0
+                    for k, (job_args, z, z_orig, pMs, opt, rng) in enumerate(jobs):
+                        lossAll = []
+                        if job_args.init_weight:
+                            lossAll.append(F.mse_loss(z, torch.zeros_like(z_orig)) * ((1/torch.tensor(i*2 + 1))*job_args.init_weight) / 2)
+                        for prompt in pMs:
+                            lossAll.append(prompt(iii[k]))
+
+                        if i % args.display_freq == 0:
+                            self.checkin(job_args, z, i, lossAll, out[k:k + 1].detach())
+
+                        loss = loss + sum(lossAll)
+
+                    scaler.scale(loss).backward()
+                    for job_args, z, z_orig, pMs, opt, rng in jobs:
+                        scaler.step(opt)
+                        with torch.inference_mode():
+                            z.copy_(z.maximum(self.z_min).minimum(self.z_max))
+                    scaler.update()
+
+                    pbar.update()
+        except KeyboardInterrupt:
+            pass
+
+
+def make_video(args, last_frame):
     init_frame = 1      # Initial video frame
-    if args.make_zoom_video:
-        last_frame = j
-    else:
-        last_frame = i  # This will raise an error if that number of frames does not exist.
 
     length = args.video_length # Desired time of the video in seconds
 
@@ -993,3 +1158,51 @@ if args.make_video or args.make_zoom_video:
             im.save(p.stdin, 'PNG')
         p.stdin.close()
         p.wait()
+
+
+# Entry point for a resident worker process (see make_art.py): keeps the
+# models of the last job loaded and runs each job's argv (or list of argvs,
+# for a batch) from job_queue until it receives None, reporting every job on
+# result_queue
+def serve(job_queue, result_queue):
+    generator = None
+    while True:
+        argv = job_queue.get()
+        if argv is None:
+            break
+
+        start_time = time.time()
+        ok = True
+        try:
+            # a batch of jobs is a list of argvs
+            if len(argv) > 0 and isinstance(argv[0], list):
+                jobs = [parse_args(job_argv) for job_argv in argv]
+            else:
+                jobs = [parse_args(argv)]
+            args = jobs[0]
+            if generator is None or generator.key != VQGANGenerator.key_for(args):
+                # free the old models before loading new ones
+                generator = None
+                gc.collect()
+                torch.cuda.empty_cache()
+                generator = VQGANGenerator(args.vqgan_config, args.vqgan_checkpoint, args.clip_model, args.cuda_device)
+            if len(jobs) > 1:
+                generator.generate_batch(jobs)
+            else:
+                generator.generate(args)
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            ok = False
+            gc.collect()
+            torch.cuda.empty_cache()
+        # the job's images are only done once they're written
+        image_writer.get_writer().flush()
+        result_queue.put({'ok': ok, 'time': time.time() - start_time, 'embed_cache': embed_cache.get_cache().take_stats()})
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    generator = VQGANGenerator(args.vqgan_config, args.vqgan_checkpoint, args.clip_model, args.cuda_device)
+    generator.generate(args)
+    image_writer.get_writer().flush()
+    embed_cache.report_stats()